@@ -0,0 +1,545 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import datetime
+import gzip
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import common
+import parse_scrubs
+import parse_slow_requests
+import parse_suicides
+
+from subprocess import check_output
+
+from common import (
+    decode_lines,
+    find_logs,
+    get_multi,
+    get_events,
+    get_hostname_from_path,
+    grep_log,
+    parse_timestamp,
+    TimeWindow,
+    TopK,
+)
+
+QUERIES = {'scrubs': parse_scrubs.QUERY,
+           'slow_requests': parse_slow_requests.QUERY,
+           'suicides': parse_suicides.QUERY}
+
+
+def make_log(path, num_lines, osd=0, seed=0):
+    """
+    Write a synthetic ceph-osd log with a mix of scrub, slow request, suicide
+    and unrelated lines.
+    """
+    rand = random.Random(seed)
+    t = datetime.datetime(2016, 5, 1)
+    with open(path, 'w') as fd:
+        for i in xrange(num_lines):
+            t += datetime.timedelta(microseconds=rand.randint(1, 2000000))
+            ts = t.strftime('%Y-%m-%d %H:%M:%S.%f')
+            thread = '7f%010x' % rand.randint(0, 2 ** 36)
+            r = rand.random()
+            if r < 0.2:
+                pg = '%d.%x' % (rand.randint(1, 3), rand.randint(0, 255))
+                fd.write("%s %s  0 log_channel(cluster) log [INF] : %s %s "
+                         "%s\n" % (ts, thread, pg,
+                                   rand.choice(['scrub', 'deep-scrub']),
+                                   rand.choice(['starts', 'ok'])))
+            elif r < 0.3:
+                fd.write("%s %s  0 log_channel(cluster) log [WRN] : %d slow "
+                         "requests, 1 included below; oldest blocked for > "
+                         "%.6f secs\n" % (ts, thread, rand.randint(1, 50),
+                                          rand.uniform(30, 500)))
+            elif r < 0.31:
+                fd.write("%s %s  1 heartbeat_map is_healthy 'OSD::osd_op_tp "
+                         "thread 0x%s' had suicide timed out after 150\n" %
+                         (ts, thread, thread))
+            else:
+                fd.write("%s %s  0 osd.%d pg_epoch: %d handle_osd_map "
+                         "epochs [%d,%d]\n" % (ts, thread, osd, i, i, i))
+
+    return path
+
+
+def make_sosreport(root, host='host0'):
+    """
+    Return the ceph log directory of a fake sosreport under root.
+    """
+    path = os.path.join(root, 'sosreport-%s.1234-567890' % host, 'var', 'log',
+                        'ceph')
+    os.makedirs(path)
+    return path
+
+
+def legacy_decode_lines(lines, queries):
+    """
+    Line decoding as it was done before decode_lines() i.e. uncompiled
+    regexes and strptime.
+    """
+    for line in lines:
+        if re.search(r":\s+-[0-9]*>", line):
+            continue
+
+        for name in sorted(queries.keys()):
+            if not re.search(queries[name].keywords, line, re.IGNORECASE):
+                continue
+
+            res = re.search(queries[name].filter, line)
+            if res:
+                groups = list(res.groups())
+                groups[1] = datetime.datetime.strptime(groups[1],
+                                                       '%Y-%m-%d %H:%M:%S.%f')
+                yield name, groups
+
+
+def legacy_get(path, query):
+    """
+    Events as they were returned before LogQuery records i.e. a dict per
+    event holding a re match object.
+    """
+    events = []
+    for line in grep_log(path, query.keywords):
+        if not re.search(r":\s+-[0-9]*>", line):
+            res = re.search(query.filter, line)
+            if res:
+                events.append({'host': get_hostname_from_path(path),
+                               'data': res})
+
+    return events
+
+
+def get_rss():
+    with open('/proc/self/statm') as fd:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure_rss(func, args, queue):
+    start = get_rss()
+    result = func(*args)
+    queue.put((len(result), get_rss() - start))
+
+
+def measure_rss(func, *args):
+    """
+    Return the number of results returned by func and the growth in resident
+    memory it caused, measured in a separate process.
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure_rss,
+                                   args=(func, args, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def make_scrub_events(num_events, num_osds=100, seed=0):
+    """
+    Return a list of num_events ScrubEvent records where roughly half of the
+    events complete an action started by an earlier event.
+    """
+    rand = random.Random(seed)
+    t = datetime.datetime(2016, 5, 1)
+    inflight = []
+    events = []
+    for i in xrange(num_events):
+        t += datetime.timedelta(microseconds=rand.randint(1, 2000000))
+        if inflight and rand.random() < 0.5:
+            index = rand.randrange(len(inflight))
+            inflight[index], inflight[-1] = inflight[-1], inflight[index]
+            osd, pg, action = inflight.pop()
+            status = 'ok'
+        else:
+            osd = 'ceph-osd.%d' % rand.randint(0, num_osds - 1)
+            pg = '%d.%x' % (rand.randint(1, 3), rand.randint(0, 4095))
+            action = rand.choice(['scrub', 'deep-scrub'])
+            inflight.append((osd, pg, action))
+            status = 'starts'
+
+        events.append(parse_scrubs.ScrubEvent('host0', osd, t, pg, action,
+                                              status))
+
+    return events
+
+
+def make_slow_request_columns(num_events, num_osds=500, seed=0):
+    """
+    Return a CephSlowRequestStatsCollection holding num_events slow requests
+    spread over num_osds OSDs and a month.
+    """
+    rand = random.Random(seed)
+    start = common.to_epoch_us(datetime.datetime(2016, 5, 1))
+    collection = parse_slow_requests.CephSlowRequestStatsCollection([])
+    collection.osds = ['ceph-osd.%d' % i for i in xrange(num_osds)]
+    for i, osd in enumerate(collection.osds):
+        collection.osd_index[osd] = i
+        collection.osd_stats[osd] = {'host': 'host%d' % (i % 10)}
+
+    for i in xrange(num_events):
+        collection.osd_ids.append(rand.randrange(num_osds))
+        collection.times.append(start + rand.randrange(31 * 86400000000))
+        collection.blocked.append(round(rand.uniform(30, 500), 6))
+
+    return collection
+
+
+def bench_slow_request_aggregation(args, tmpdir):
+    collection = make_slow_request_columns(args.max_events)
+    print "Slow request aggregation over %d events" % args.max_events
+
+    def aggregate():
+        collection.get_stats('osd')
+        collection.get_stats('host')
+        collection.get_stats('day')
+        collection.get_stats('hour')
+        collection.get_timestamp_avg_stats('month')
+        collection.get_timestamp_avg_stats('day')
+
+    results = []
+    for name, backend in [('python', None), ('numpy', common.numpy)]:
+        if name == 'numpy' and not backend:
+            print "  numpy: not available"
+            continue
+
+        saved = common.numpy
+        common.numpy = backend
+        try:
+            results.append(timeit(aggregate))
+        finally:
+            common.numpy = saved
+
+        print "  %s: %.3fs" % (name, results[-1])
+
+    if len(results) == 2:
+        print "  speedup: %.2fx" % (results[0] / results[1])
+
+
+def bench_scrub_scaling(args, tmpdir):
+    print "CephScrubStatsCollection parse() and totals by number of events"
+    num_events = 1000
+    while num_events <= args.max_events:
+        events = make_scrub_events(num_events)
+        start = time.time()
+        collection = parse_scrubs.CephScrubStatsCollection(5, events)
+        collection.parse()
+        osds = collection.total_osds
+        pgs = collection.total_pgs
+        elapsed = time.time() - start
+        print "  %8d events: %8.3fs (%.2f us/event, osds=%d, pgs=%d)" % \
+            (num_events, elapsed, elapsed * 1000000 / num_events, osds, pgs)
+        num_events *= 10
+
+
+def legacy_keep_top_maxs(tops, osd, val, k):
+    """
+    The sort-on-every-insert top list previously used by
+    CephSlowRequestStatsCollection.
+    """
+    if not tops:
+        tops.append((osd, val))
+        return tops
+
+    if val > max([e[1] for e in tops]) or val > float(tops[0][1]):
+        tops.append((osd, val))
+
+    tops = sorted(tops, key=lambda e: float(e[1]))
+    if len(tops) > k:
+        tops.pop(0)
+
+    return tops
+
+
+def bench_topk(args, tmpdir):
+    rand = random.Random(0)
+    vals = [("ceph-osd.%d" % i, rand.random() * 500)
+            for i in xrange(args.max_events)]
+    print "Top %d of %d values" % (args.top, len(vals))
+
+    def before():
+        tops = []
+        for osd, val in vals:
+            tops = legacy_keep_top_maxs(tops, osd, val, args.top)
+
+    def after():
+        tops = TopK(args.top)
+        for osd, val in vals:
+            tops.push(osd, val)
+
+        tops.items()
+
+    before = timeit(before)
+    after = timeit(after)
+    print "  sorted list (before): %.3fs" % before
+    print "  TopK (after):         %.3fs" % after
+    print "  speedup: %.2fx" % (before / after)
+
+
+def bench_decode(args, tmpdir):
+    log = make_log(os.path.join(make_sosreport(tmpdir), 'ceph-osd.0.log'),
+                   args.lines)
+    with open(log) as fd:
+        lines = ["%s:%s" % (log, line.rstrip('\n')) for line in fd]
+
+    print "Decoding %s lines of %s" % (len(lines), log)
+    before = timeit(lambda: list(legacy_decode_lines(lines, QUERIES)))
+    after = timeit(lambda: list(decode_lines(lines, QUERIES,
+                                             skip=len(log) + 1)))
+    print "  line decoding (before): %d lines/sec" % (len(lines) / before)
+    print "  line decoding (after):  %d lines/sec" % (len(lines) / after)
+    print "  speedup: %.2fx" % (before / after)
+
+    timestamps = [line.partition(':')[2][:26] for line in lines]
+    before = timeit(lambda: [datetime.datetime.strptime(t, '%Y-%m-%d '
+                                                        '%H:%M:%S.%f')
+                             for t in timestamps])
+    after = timeit(lambda: [parse_timestamp(t) for t in timestamps])
+    print "  timestamps (strptime):        %d/sec" % (len(lines) / before)
+    print "  timestamps (parse_timestamp): %d/sec" % (len(lines) / after)
+    print "  speedup: %.2fx" % (before / after)
+
+
+def bench_seek(args, tmpdir):
+    log = make_log(os.path.join(make_sosreport(tmpdir), 'ceph-osd.0.log'),
+                   args.lines)
+    with open(log, 'rb') as fd:
+        with gzip.open(log + '.1.gz', 'wb') as gz:
+            shutil.copyfileobj(fd, gz)
+
+    query = QUERIES[args.query]
+    events = get_events(log, query)
+    middle = events[len(events) / 2].timestamp
+    window = TimeWindow(middle, middle + datetime.timedelta(hours=1))
+    print "One hour of %s from %s lines (%.1f MiB)" % \
+        (args.query, args.lines, os.path.getsize(log) / 1048576.0)
+    saved = common.CACHE_DIR
+    try:
+        # Keep the TimeIndex out of the real cache. It is removed along with
+        # tmpdir.
+        common.CACHE_DIR = os.path.join(tmpdir, 'cache')
+        for path in [log, log + '.1.gz']:
+            # The first cached windowed read of a compressed log builds its
+            # TimeIndex. Uncompressed logs are seeked without caching.
+            cache = common.is_compressed(path)
+            before = timeit(get_events, path, query)
+            build = timeit(get_events, path, query, cache, 1, False, window)
+            after = timeit(get_events, path, query, cache, 1, False, window)
+            print "  %s:" % os.path.basename(path)
+            print "    full scan:       %.3fs" % before
+            print "    window (first):  %.3fs" % build
+            print "    window:          %.3fs" % after
+    finally:
+        common.CACHE_DIR = saved
+
+
+def make_bundle(root, num_sosreports, num_files):
+    """
+    Create num_sosreports sosreports each holding a few ceph-osd logs and
+    num_files other files spread over directories outside var/log/ceph.
+    """
+    for i in xrange(num_sosreports):
+        sosreport = os.path.join(root, 'sosreport-host%d.%d-1234' % (i, i))
+        logdir = os.path.join(sosreport, 'var', 'log', 'ceph')
+        os.makedirs(logdir)
+        for osd in xrange(3):
+            for name in ['ceph-osd.%d.log', 'ceph-osd.%d.log.1.gz']:
+                open(os.path.join(logdir, name % (i * 3 + osd)), 'w').close()
+
+        for j in xrange(num_files):
+            d = os.path.join(sosreport, ['proc', 'sys', 'etc'][j % 3],
+                             str(j / 100))
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+            open(os.path.join(d, 'ceph-file%d' % j), 'w').close()
+
+
+def legacy_find_logs(path):
+    out = check_output(['find', path, '-type', 'f', '-name', 'ceph*'])
+    return [path for path in out.split('\n')
+            if re.search('var/log/ceph/ceph-osd.+', path)]
+
+
+def bench_discovery(args, tmpdir):
+    make_bundle(tmpdir, args.sosreports, args.lines / args.sosreports)
+    print "Finding logs in %s sosreports of %s files" % (args.sosreports,
+                                                        args.lines)
+    before = timeit(legacy_find_logs, tmpdir)
+    walk = timeit(find_logs, tmpdir)
+    find_logs(tmpdir, True)
+    cached = timeit(find_logs, tmpdir, True)
+    assert sorted(legacy_find_logs(tmpdir)) == sorted(find_logs(tmpdir))
+    os.unlink(common.LogManifest(tmpdir).manifestfile)
+    print "  find(1):                 %.3fs" % before
+    print "  walk_logs():             %.3fs" % walk
+    print "  walk_logs() (manifest):  %.3fs" % cached
+
+
+def bench_scheduling(args, tmpdir):
+    logdir = make_sosreport(tmpdir)
+    make_log(os.path.join(logdir, 'ceph-osd.0.log'), args.lines)
+    for osd in xrange(1, 8):
+        make_log(os.path.join(logdir, 'ceph-osd.%d.log' % osd),
+                 args.lines / 50, osd=osd, seed=osd)
+
+    print "Scanning 1 log of %s lines and 7 of %s lines with %s jobs" % \
+        (args.lines, args.lines / 50, args.jobs)
+    saved = common.CHUNK_SIZE
+    try:
+        # Never split so that the largest log is scanned by a single job.
+        common.CHUNK_SIZE = float('inf')
+        before = timeit(get_multi, tmpdir, QUERIES, False, args.jobs)
+    finally:
+        common.CHUNK_SIZE = saved
+
+    after = timeit(get_multi, tmpdir, QUERIES, False, args.jobs)
+    print "  per file:       %.3fs" % before
+    print "  size-aware:     %.3fs" % after
+    print "  speedup: %.2fx" % (before / after)
+
+
+COLLECTIONS = {'scrubs': parse_scrubs.CephScrubStatsCollection,
+               'slow_requests':
+               parse_slow_requests.CephSlowRequestStatsCollection,
+               'suicides': parse_suicides.CephSuicideStatsCollection}
+
+
+def new_collection(name, state=None):
+    cls = COLLECTIONS[name]
+    if name == 'slow_requests':
+        return cls.from_state(state) if state else cls([])
+
+    return cls.from_state(5, state) if state else cls(5, [])
+
+
+def parse_collections(path, states=()):
+    """
+    Return {name: collection} of the logs under path merged after those
+    saved to each of states, being a list of {name: statefile}.
+    """
+    collections = dict([(name, new_collection(name))
+                        for name in COLLECTIONS])
+    for state in states:
+        for name in collections:
+            collections[name].merge(new_collection(
+                name, common.load_state(state[name], name)))
+
+    events = get_multi(path, QUERIES)
+    for name in collections:
+        collections[name].update(events[name])
+
+    return collections
+
+
+def bench_merge(args, tmpdir):
+    hosts = 8
+    for host in xrange(hosts):
+        make_log(os.path.join(make_sosreport(tmpdir, 'host%d' % host),
+                              'ceph-osd.%d.log' % host),
+                 args.lines / hosts, osd=host, seed=host)
+
+    sosreports = sorted(os.listdir(tmpdir))
+    states = []
+    for sosreport in sosreports[:-1]:
+        collections = parse_collections(os.path.join(tmpdir, sosreport))
+        states.append({})
+        for name in collections:
+            states[-1][name] = os.path.join(tmpdir, '%s.%s' % (sosreport,
+                                                               name))
+            common.save_state(states[-1][name], name,
+                              collections[name].get_state())
+
+    print "Adding 1 sosreport to the saved states of %s others (%s lines " \
+        "each)" % (hosts - 1, args.lines / hosts)
+    before = timeit(parse_collections, tmpdir)
+    after = timeit(parse_collections, os.path.join(tmpdir, sosreports[-1]),
+                   states)
+    print "  parse all:            %.3fs" % before
+    print "  merge states + parse: %.3fs" % after
+    print "  speedup: %.2fx" % (before / after)
+
+
+def bench_memory(args, tmpdir):
+    log = make_log(os.path.join(make_sosreport(tmpdir), 'ceph-osd.0.log'),
+                   args.lines)
+    query = QUERIES[args.query]
+    print "Memory used by %s events from %s lines" % (args.query, args.lines)
+    for name, func in [('before', legacy_get), ('after', get_events)]:
+        count, rss = measure_rss(func, log, query)
+        print "  %s: %d events, %.1f MiB (%d bytes/event)" % \
+            (name, count, rss / 1048576.0, rss / max(count, 1))
+
+
+BENCHMARKS = {'decode': bench_decode,
+              'discovery': bench_discovery,
+              'memory': bench_memory,
+              'merge': bench_merge,
+              'scheduling': bench_scheduling,
+              'seek': bench_seek,
+              'scrub-scaling': bench_scrub_scaling,
+              'slow-request-aggregation': bench_slow_request_aggregation,
+              'topk': bench_topk}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--lines', type=int, default=200000,
+                        help="Number of synthetic log lines to generate.")
+    parser.add_argument('--query', choices=sorted(QUERIES.keys()),
+                        default='slow_requests',
+                        help="Query used by the memory benchmark.")
+    parser.add_argument('--max-events', type=int, default=1000000,
+                        help="Largest number of events used by scaling "
+                             "benchmarks.")
+    parser.add_argument('--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of jobs used by the scheduling "
+                             "benchmark.")
+    parser.add_argument('--sosreports', type=int, default=100,
+                        help="Number of sosreports used by the discovery "
+                             "benchmark.")
+    parser.add_argument('--top', type=int, default=100,
+                        help="Number of entries kept by the topk benchmark.")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        BENCHMARKS[args.benchmark](args, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
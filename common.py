@@ -18,11 +18,75 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+import bz2
+import csv
+import datetime
+import gzip
+import marshal
+import mmap
 import os
 import re
+import stat
+import struct
 import hashlib
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
 
-from subprocess import check_output, CalledProcessError
+from array import array
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Directory holding caches and indexes.
+CACHE_DIR = '/tmp/cephsosparser'
+# Amount of (decompressed) log data read and searched for keywords at once.
+READ_BLOCK_SIZE = 1024 * 1024
+# Uncompressed logs larger than this are split into line-aligned chunks of
+# about this size that are scanned in parallel when using more than one job.
+CHUNK_SIZE = 64 * 1024 * 1024
+# Approximate ratio of decompressed to compressed size for formats that do
+# not record it, used to estimate the cost of scanning them.
+COMPRESSION_RATIO = 8
+# Minimum amount of decompressed data between the points recorded in a
+# TimeIndex.
+TIME_INDEX_INTERVAL = 16 * 1024 * 1024
+# Timestamp at the start of each Ceph log entry. Timestamps in this format
+# sort the same as strings as they do as times.
+TIMESTAMP_RE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:'
+                          r'[0-9]{2}\.[0-9]+')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Format of the collection states written by save_state().
+STATE_VERSION = 1
+
+# Field types that can be used in a LogQuery and the array typecode used to
+# store each of them in an EventCache. Timestamps are stored as microseconds
+# since EPOCH and strings as indexes into a table of unique values.
+FIELD_TYPES = {'osd': 'l', 'timestamp': 'd', 'float': 'd', 'str': 'l'}
+
+# Matches lines logged by subthreads e.g. when an OSD dumps recent events.
+SUBTHREAD_FILTER = re.compile(r":\s+-[0-9]*>")
 
 
 class CacheNotReadyException(Exception):
@@ -30,73 +94,600 @@ class CacheNotReadyException(Exception):
 
 
 class ResultsCache(object):
-    def __init__(self, target, filter):
+    """
+    Cache of the lines of a logfile that matched a filter.
+
+    Caches are keyed on the host the logfile belongs to, its absolute path
+    and the filter so that logs with the same name from different sosreports
+    never collide. The identity of the logfile (inode, size, mtime and a
+    digest of its first block) is stored along with the offset up to which
+    it was scanned. If the logfile is unchanged the cache is a hit. If an
+    uncompressed logfile has only grown since it was cached, the cached
+    lines are reused and only data beyond the cached offset needs to be
+    scanned.
+    """
+    suffix = 'cache'
+
+    def __init__(self, target, filter, host=None):
         self.filter = filter
-        self.target = target
-        cachedir = os.path.join('/tmp/cephsosparser')
+        self.target = os.path.abspath(target)
+        self.host = host or get_hostname_from_path(target)
+        cachedir = CACHE_DIR
         if not os.path.isdir(cachedir):
             os.makedirs(cachedir, mode=0755)
 
-        self.cachefile = os.path.join(cachedir, '%s.cache' %
-                                      (os.path.basename(self.target)))
+        h = hashlib.sha256()
+        h.update('\0'.join([self.host, self.target, self.filter]))
+        self.key = h.hexdigest()
+        self.cachefile = os.path.join(cachedir, '%s-%s.%s' %
+                                      (os.path.basename(self.target),
+                                       self.key[:16], self.suffix))
+        self.checked = False
+        self.fd = None
+        self.tmpfile = None
         self.hit = False
+        self.offset = 0
+        self.size = 0
+        self.data = []
         self.header_index_hashsum = 0
         self.header_index_filter = 1
-        self.header_max_lines = 10
+        self.header_index_identity = 2
+        self.header_index_offset = 3
+        self.header_max_lines = 4
         self.cache_header = {}
 
-    def _get_header(self):
+    @staticmethod
+    def _format_identity(identity):
+        return format_identity(identity)
+
+    def _can_resume(self, old, new):
+        return can_resume(self.target, old, new)
+
+    def _read_data(self, fd):
+        return fd.read().splitlines()
+
+    def _write_data(self, data):
+        for line in data:
+            self.fd.write("%s\n" % line)
+
+    def check(self, identity=None):
+        """
+        Check cache against the current state of target.
+
+        @param identity: identity of target as returned by
+                         get_file_identity() if already known.
+        @return: True if the cache holds all results for target. Otherwise
+                 readlines() returns any results that are still valid and
+                 self.offset is the offset from which target must be scanned.
+        """
+        identity = identity or get_file_identity(self.target)
+        self.size = identity['size']
+        if not is_compressed(self.target):
+            # Only scan up to the last newline so that a line still being
+            # written is read in full when the scan is resumed.
+            with open(self.target, 'rb') as fd:
+                self.size = _complete_end(fd, 0, self.size)
+
         if os.path.isfile(self.cachefile):
-            with open(self.cachefile, 'r') as fd:
-                for i in xrange(0, 9):
+            with open(self.cachefile, 'rb') as fd:
+                for i in xrange(0, self.header_max_lines):
                     self.cache_header[i] = fd.readline().strip('\n')
 
-    def check(self):
-        self._get_header()
-        h = hashlib.sha256()
-        h.update(self.target)
-        if os.path.isfile(self.cachefile):
-            with open(self.cachefile, 'r') as fd:
-                if ((self.cache_header[self.header_index_hashsum] ==
-                     h.hexdigest()) and
-                    (self.cache_header[self.header_index_filter] ==
-                     self.filter)):
-                    self.data = fd.readlines()
-                    self.hit = True
+                if (self.cache_header[self.header_index_hashsum] ==
+                        self.key and
+                        self.cache_header[self.header_index_filter] ==
+                        self.filter):
+                    cached = self.cache_header[self.header_index_identity]
+                    if cached == self._format_identity(identity):
+                        self.hit = True
+                    elif self._can_resume(cached, identity):
+                        index = self.header_index_offset
+                        self.offset = int(self.cache_header[index])
 
+                if self.hit or self.offset:
+                    self.data = self._read_data(fd)
+
+        self.checked = True
         if not self.hit:
-            with open(self.cachefile, 'w') as fd:
-                fd.write("%s\n" % h.hexdigest())
-                fd.write("%s\n" % self.filter)
+            # New results are written to a temporary file which only replaces
+            # the cache once commit() is called so that an interrupted scan
+            # never leaves behind a cache that looks valid.
+            fd, self.tmpfile = tempfile.mkstemp(dir=os.path.dirname(
+                                                self.cachefile),
+                                                suffix='.tmp')
+            self.fd = os.fdopen(fd, 'wb')
+            self.fd.write("%s\n" % self.key)
+            self.fd.write("%s\n" % self.filter)
+            self.fd.write("%s\n" % self._format_identity(identity))
+            self.fd.write("%s\n" % self.size)
+            self._write_data(self.data)
 
         return self.hit
 
     def append(self, line):
-        if not self.hit:
-            with open(self.cachefile, 'a') as fd:
-                fd.write("%s\n" % line)
-        else:
+        if not self.fd:
             raise CacheNotReadyException("cache '%s' already populated - "
                                          "delete first before writing" %
                                          (self.cachefile))
 
+        self._write_data([line])
+
+    def commit(self):
+        """
+        Atomically replace the cache with everything appended so far.
+        """
+        self.fd.close()
+        self.fd = None
+        os.rename(self.tmpfile, self.cachefile)
+
+    def close(self):
+        """
+        Discard anything appended since check() that was not committed.
+        """
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+            os.unlink(self.tmpfile)
+
     def readlines(self):
-        if not self.hit:
+        if not self.checked:
             raise CacheNotReadyException("cache '%s' is not ready" %
                                          (self.cachefile))
 
         return self.data
 
 
+class TimeIndex(ResultsCache):
+    """
+    Sidecar index of the timestamps in a compressed logfile.
+
+    Compressed logs cannot be seeked without decompressing everything before
+    the target offset so the index records the timestamp of the first line
+    at least every TIME_INDEX_INTERVAL bytes of decompressed data, along with
+    the offset and timestamp of the last line that has one. When caching,
+    grep_log() uses this to skip logfiles that lie entirely outside a
+    TimeWindow and to stop reading once past the end of it without searching
+    data in between.
+    """
+    suffix = 'index'
+
+    def __init__(self, target, host=None):
+        super(TimeIndex, self).__init__(target, 'time-index', host)
+
+    def _read_data(self, fd):
+        points = []
+        for line in fd:
+            offset, _, timestamp = line.rstrip('\n').partition(' ')
+            points.append((int(offset), timestamp))
+
+        return points
+
+    def _write_data(self, data):
+        for offset, timestamp in data:
+            self.fd.write("%s %s\n" % (offset, timestamp))
+
+    def get_range(self, since=None, until=None):
+        """
+        Return (start, end) decompressed offsets between which all lines
+        from since until until are found, where end may be None, or None if
+        there are no such lines.
+
+        @param since: timestamp string as formatted by TimeWindow.bounds()
+        @param until: timestamp string as formatted by TimeWindow.bounds()
+        """
+        points = self.readlines()
+        if not points:
+            return 0, None
+
+        if ((until and points[0][1] >= until) or
+                (since and points[-1][1] < since)):
+            return None
+
+        start = 0
+        end = None
+        for offset, timestamp in points[:-1]:
+            if since and timestamp < since:
+                start = offset
+            elif until and timestamp >= until:
+                end = offset
+                break
+
+        return start, end
+
+
+class BundleIndex(object):
+    """
+    Persistent index of the lines matching a set of keywords in every
+    logfile under a directory, typically a collection of sosreports.
+
+    The index is built once (see index.py) after which get_multi(), when
+    caching, reads the lines matching any indexed keywords from it rather
+    than scanning logfiles. The identity of each logfile is recorded so
+    that logs that have since changed are scanned as usual, and rebuilding
+    only scans what is new.
+    """
+    suffix = 'bundle'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        h = hashlib.sha256()
+        h.update(self.root)
+        self.indexfile = os.path.join(CACHE_DIR, '%s-%s.%s' %
+                                      (os.path.basename(self.root),
+                                       h.hexdigest()[:16], self.suffix))
+        self.keywords = []
+        # {path: {'identity': identity, 'size': size,
+        #         'lines': {keywords: [line, ...]}}}
+        self.files = {}
+
+    @classmethod
+    def find(cls, path):
+        """
+        Return the index of path or of the nearest directory above it that
+        has one, or None.
+        """
+        path = os.path.abspath(path)
+        while True:
+            index = cls(path)
+            if os.path.isfile(index.indexfile):
+                return index.load()
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+
+            path = parent
+
+    def load(self):
+        with open(self.indexfile, 'rb') as fd:
+            data = marshal.load(fd)
+
+        self.keywords = data['keywords']
+        self.files = data['files']
+        return self
+
+    def save(self):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, mode=0755)
+
+        fd, tmpfile = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fd:
+            marshal.dump({'keywords': self.keywords, 'files': self.files}, fd)
+
+        os.rename(tmpfile, self.indexfile)
+
+    def build(self, keywords, jobs=1):
+        """
+        Add keywords to the index and bring it up to date with the logfiles
+        under root.
+
+        @param keywords: list of case-insensitive regular expressions.
+        @param jobs: number of worker processes used to scan logfiles.
+        """
+        for k in keywords:
+            if k not in self.keywords:
+                self.keywords.append(k)
+
+        tasks = [(path, self.keywords, self.files.get(path))
+                 for path in find_logs(self.root)]
+        self.files = dict(map_tasks(_index_log, tasks, jobs))
+        self.save()
+
+    def get_lines(self, path, keywords, identity=None):
+        """
+        Return {keywords: [line, ...]} for those of keywords that are indexed
+        for path, or None if path is not indexed or has changed since. Lines
+        are prefixed with path as for grep_log().
+        """
+        entry = self.files.get(os.path.abspath(path))
+        if not entry:
+            return None
+
+        identity = identity or get_file_identity(path)
+        if entry['identity'] != format_identity(identity):
+            return None
+
+        return dict([(k, ["%s:%s" % (path, line)
+                          for line in entry['lines'][k]])
+                     for k in keywords if k in entry['lines']])
+
+
+def _index_log(args):
+    """
+    Return (path, entry) for BundleIndex.files, reusing what is still valid
+    from the previous entry.
+    """
+    path, keywords, entry = args
+    identity = get_file_identity(path)
+    lines = {}
+    todo = keywords
+    start = 0
+    end = None
+    if entry and entry['identity'] == format_identity(identity):
+        lines = entry['lines']
+        end = entry['size']
+        todo = [k for k in keywords if k not in lines]
+    elif entry and can_resume(path, entry['identity'], identity):
+        lines = entry['lines']
+        start = entry['size']
+        todo = lines.keys()
+        for k in keywords:
+            if k not in lines:
+                return _index_log((path, keywords, None))
+
+    if end is None:
+        end = identity['size']
+        if not is_compressed(path):
+            # Only index up to the last newline so that a line still being
+            # written is indexed in full when the index is next updated.
+            try:
+                with open(path, 'rb') as fd:
+                    end = _complete_end(fd, start, end)
+            except IOError:
+                pass
+
+    if todo:
+        searches = [(k, re.compile(k, re.IGNORECASE).search) for k in todo]
+        for k in todo:
+            if k not in lines:
+                lines[k] = []
+
+        skip = len(path) + 1
+        try:
+            for line in grep_log(path, '|'.join(["(%s)" % k for k in todo]),
+                                 start, end):
+                # Only match keywords against the line, not its path.
+                line = line[skip:]
+                for k, search in searches:
+                    if search(line):
+                        lines[k].append(line)
+        except (IOError, EOFError):
+            pass
+
+    return os.path.abspath(path), {'identity': format_identity(identity),
+                                   'size': end,
+                                   'lines': lines}
+
+
+class EventCache(ResultsCache):
+    """
+    Cache of the decoded events a LogQuery found in a logfile.
+
+    Events are stored column by column as packed arrays (see FIELD_TYPES) so
+    that loading them requires no regex matching or timestamp parsing.
+    Identity checks and incremental updates are as for ResultsCache.
+    """
+    suffix = 'events'
+
+    def __init__(self, target, query, host=None):
+        self.fields = query.fields
+        signature = '\t'.join([query.keywords, query.filter] +
+                               [f[1] for f in self.fields])
+        super(EventCache, self).__init__(target, signature, host)
+        self.rows = []
+
+    @staticmethod
+    def _encode_column(ftype, values):
+        if ftype == 'osd':
+            return array(FIELD_TYPES[ftype],
+                         [get_osd_id(v) for v in values]).tostring()
+        elif ftype == 'timestamp':
+            return array(FIELD_TYPES[ftype],
+                         [to_epoch_us(v) for v in values]).tostring()
+        elif ftype == 'str':
+            table = {}
+            index = [table.setdefault(v, len(table)) for v in values]
+            return (array(FIELD_TYPES[ftype], index).tostring(),
+                    sorted(table, key=table.get))
+
+        return array(FIELD_TYPES[ftype], values).tostring()
+
+    @staticmethod
+    def _decode_column(ftype, column):
+        values = array(FIELD_TYPES[ftype])
+        if ftype == 'str':
+            values.fromstring(column[0])
+            return [column[1][i] for i in values]
+
+        values.fromstring(column)
+        if ftype == 'osd':
+            names = {}
+            return [names.get(v) or names.setdefault(v, 'ceph-osd.%d' % v)
+                    for v in values]
+        elif ftype == 'timestamp':
+            return [from_epoch_us(v) for v in values]
+
+        return values.tolist()
+
+    def _read_data(self, fd):
+        columns = marshal.loads(fd.read())
+        columns = [self._decode_column(f[1], c)
+                   for f, c in zip(self.fields, columns)]
+        return zip(*columns)
+
+    def _write_data(self, data):
+        self.rows += data
+
+    def reset(self):
+        """
+        Discard all cached events so that target is scanned from the start.
+        """
+        self.offset = 0
+        self.data = []
+        self.rows = []
+
+    def commit(self):
+        columns = zip(*self.rows) or [[] for f in self.fields]
+        self.fd.write(marshal.dumps([self._encode_column(f[1], c)
+                                     for f, c in zip(self.fields, columns)]))
+        super(EventCache, self).commit()
+
+
+def get_file_identity(path):
+    """
+    Return the identity of a logfile used to validate caches of it.
+    """
+    st = os.stat(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        h.update(fd.read(4096))
+
+    return {'inode': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime,
+            'head': h.hexdigest()}
+
+
+def format_identity(identity):
+    return "%(inode)s %(size)s %(mtime)r %(head)s" % identity
+
+
+def can_resume(path, old, new):
+    """
+    Return True if path is an uncompressed logfile that has only had data
+    appended to it since its identity was old.
+
+    @param old: identity formatted by format_identity()
+    @param new: identity as returned by get_file_identity()
+    """
+    if is_compressed(path):
+        return False
+
+    old = old.split()
+    if len(old) != 4:
+        return False
+
+    return (old[0] == str(new['inode']) and int(old[1]) <= new['size'] and
+            old[3] == new['head'])
+
+
+def get_osd_id(osd):
+    """
+    Return the integer id of an osd name e.g. 12 for ceph-osd.12
+    """
+    return int(osd.rpartition('.')[2] or -1)
+
+
+def to_epoch_us(t):
+    delta = t - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds)
+
+
+def from_epoch_us(us):
+    return EPOCH + datetime.timedelta(microseconds=us)
+
+
+def parse_timestamp(timestamp):
+    """
+    Decode a Ceph log timestamp e.g. 2016-05-03 10:11:12.123456
+
+    Timestamps in the fixed width format Ceph logs are decoded by slicing,
+    which is several times faster than strptime. Anything else falls back to
+    strptime.
+    """
+    if len(timestamp) == 26:
+        try:
+            return datetime.datetime(int(timestamp[0:4]),
+                                     int(timestamp[5:7]),
+                                     int(timestamp[8:10]),
+                                     int(timestamp[11:13]),
+                                     int(timestamp[14:16]),
+                                     int(timestamp[17:19]),
+                                     int(timestamp[20:26]))
+        except ValueError:
+            pass
+
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+
+
+def parse_time(value):
+    """
+    Decode a time given on the command line e.g. 2016-05-03, 2016-05-03 10:11
+    or 2016-05-03T10:11:12
+    """
+    value = value.strip().replace('T', ' ')
+    for fmt in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Invalid time '%s'" % (value))
+
+
+def parse_duration(value):
+    """
+    Decode a duration such as 30s, 5m, 1h or 1d into microseconds. A plain
+    number is taken as seconds.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = value.strip()
+    scale = units.get(value[-1:].lower())
+    if scale:
+        value = value[:-1]
+    else:
+        scale = 1
+
+    us = int(float(value) * scale * 1000000)
+    if us <= 0:
+        raise ValueError("Invalid duration '%s'" % (value))
+
+    return us
+
+
+def format_duration(us):
+    """
+    Inverse of parse_duration() e.g. 300000000 gives 5m
+    """
+    seconds = us / 1000000.0
+    for unit, scale in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if seconds >= scale and seconds % scale == 0:
+            return "%d%s" % (seconds / scale, unit)
+
+    return "%gs" % seconds
+
+
 def get_hostname_from_path(path):
     hostname = '<unknownhost>'
-    res = re.search(r".+sosreport-(.+)\.[0-9]+-[0-9]+/var.+", path)
+    res = re.search(r".+sosreport-(.+)\.[0-9]+-[0-9]+/(var|sos_commands).+",
+                    path)
     if res:
         hostname = res.group(1)
 
     return hostname
 
 
+def parse_shard(value):
+    """
+    Decode a shard given on the command line as INDEX/COUNT e.g. 0/4 into
+    (index, count). See in_shard().
+    """
+    index, _, count = value.partition('/')
+    try:
+        index = int(index)
+        count = int(count)
+    except ValueError:
+        raise ValueError("Invalid shard '%s'" % (value))
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Invalid shard '%s'" % (value))
+
+    return index, count
+
+
+def in_shard(host, shard):
+    """
+    Return True if host belongs to shard, being (index, count) as returned
+    by parse_shard(), or if shard is None. Hosts are assigned to shards by a
+    hash of their name so that separate processes or machines given each of
+    the shards of the same sosreports parse each host exactly once.
+    """
+    if not shard:
+        return True
+
+    return int(hashlib.md5(host).hexdigest()[:8], 16) % shard[1] == shard[0]
+
+
 def uniq(l):
     return list(set(l))
 
@@ -105,52 +696,1674 @@ def avg(vals):
     return reduce(lambda x, y: x + y, vals) / len(vals)
 
 
-def get(path, keywords, filter, cache_results=False):
+def to_numpy(values, dtype=None):
     """
-    @param path: path to logfile(s)
-    @param keywords: grep filter to find relevant log files.
-    @param filter: regular expression used to find relevant results.
-    @param cache_results: If True will attempt to load results from cache.
-                          A valid cache must have the same filter and sha256sum
-                          as the current query otherwise the original query is
-                          run on the target and the cache contents are
-                          overwritten.
+    Return values as a NumPy array. Packed arrays are wrapped rather than
+    copied.
     """
-    events = []
+    if isinstance(values, array):
+        return numpy.frombuffer(values, dtype=values.typecode)
 
-    if os.path.isfile(path):
-        paths = [path]
+    return numpy.asarray(values, dtype=dtype)
+
+
+def time_buckets(times, width):
+    """
+    Return the start of the bucket of the given width each timestamp falls
+    in, where buckets are aligned to the epoch.
+
+    @param times: sequence of microseconds since the epoch.
+    @param width: bucket width in microseconds.
+    """
+    if numpy is None:
+        return [int(t) // width * width for t in times]
+
+    return to_numpy(times).astype('int64') // width * width
+
+
+def time_histogram(times, width, values=None):
+    """
+    Return a sorted list of (datetime, (min, max, sum, count)) for each
+    bucket of the given width that holds at least one of times.
+
+    @param times: sequence of microseconds since the epoch.
+    @param width: bucket width in microseconds.
+    @param values: sequence of numbers the same length as times that are
+                   aggregated for each bucket. If not provided only the
+                   counts are meaningful.
+    """
+    if values is None:
+        values = times
+
+    stats = group_stats(time_buckets(times, width), values)
+    return [(from_epoch_us(k), stats[k]) for k in sorted(stats)]
+
+
+def time_keys(times, unit):
+    """
+    Return the month, day (of month) or hour of each timestamp in times.
+
+    @param times: sequence of microseconds since the epoch.
+    @param unit: one of 'month', 'day' or 'hour'.
+    """
+    if numpy is None:
+        return [getattr(from_epoch_us(t), unit) for t in times]
+
+    t = to_numpy(times, dtype='int64').astype('datetime64[us]')
+    if unit == 'month':
+        return t.astype('datetime64[M]').astype('int64') % 12 + 1
+    elif unit == 'day':
+        return (t.astype('datetime64[D]') -
+                t.astype('datetime64[M]')).astype('int64') + 1
+    elif unit == 'hour':
+        return t.astype('datetime64[h]').astype('int64') % 24
+
+    raise ValueError("Unknown time unit '%s'" % (unit))
+
+
+def _group_sort(keys, values):
+    """
+    Sort values by keys, which may be a tuple of key columns, returning the
+    sorted key columns, sorted values and the index at which each group
+    starts. The sort is stable.
+    """
+    if isinstance(keys, tuple):
+        columns = [to_numpy(k, dtype='int64') for k in keys]
+    else:
+        columns = [to_numpy(keys, dtype='int64')]
+
+    combined = numpy.zeros(len(columns[0]), dtype='int64')
+    for column in columns:
+        if len(column):
+            low = column.min()
+            combined = combined * (column.max() - low + 1) + (column - low)
+
+    order = numpy.argsort(combined, kind='mergesort')
+    combined = combined[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True],
+                                                  combined[1:] !=
+                                                  combined[:-1])))
+    if not len(combined):
+        starts = starts[:0]
+
+    return ([column[order] for column in columns],
+            to_numpy(values)[order], starts)
+
+
+def group_means(keys, values):
+    """
+    Return (keys, means) giving the mean of values for each distinct key.
+    Both are NumPy arrays if NumPy is available else lists.
+
+    @param keys: sequence of integer keys.
+    @param values: sequence of numbers the same length as keys.
+    """
+    if numpy is None:
+        stats = group_stats(keys, values)
+        keys = stats.keys()
+        return keys, [stats[k][2] / stats[k][3] for k in keys]
+
+    columns, values, starts = _group_sort(keys, values)
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    return (columns[0][starts],
+            numpy.add.reduceat(values, starts) / counts if len(starts)
+            else values[:0])
+
+
+def group_stats(keys, values):
+    """
+    Return {key: (min, max, sum, count)} of values grouped by keys.
+
+    Uses grouped NumPy reductions when NumPy is available. Values within a
+    group are summed in the order given either way.
+
+    @param keys: sequence of integer keys or a tuple of such sequences in
+                 which case results are keyed by tuples of their values.
+    @param values: sequence of numbers the same length as keys.
+    """
+    multi = isinstance(keys, tuple)
+    if numpy is None:
+        if multi:
+            keys = itertools.izip(*keys)
+
+        stats = {}
+        for key, val in itertools.izip(keys, values):
+            s = stats.get(key)
+            if s is None:
+                stats[key] = [val, val, val, 1]
+                continue
+
+            if val < s[0]:
+                s[0] = val
+            if val > s[1]:
+                s[1] = val
+            s[2] += val
+            s[3] += 1
+
+        return dict([(k, tuple(s)) for k, s in stats.iteritems()])
+
+    columns, values, starts = _group_sort(keys, values)
+    if not len(starts):
+        return {}
+
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    if multi:
+        keys = zip(*[column[starts].tolist() for column in columns])
     else:
-        out = check_output(['find', path, '-type', 'f', '-name', 'ceph*'])
-        paths = [path for path in out.split('\n')
-                 if re.search('var/log/ceph/ceph-osd.+', path)]
-
-    for path in paths:
-        if cache_results:
-            cache = ResultsCache(path, filter)
-            cache.check()
+        keys = columns[0][starts].tolist()
+
+    return dict(zip(keys,
+                    zip(numpy.minimum.reduceat(values, starts).tolist(),
+                        numpy.maximum.reduceat(values, starts).tolist(),
+                        numpy.add.reduceat(values, starts).tolist(),
+                        counts.tolist())))
+
+
+def add_stats(stats, key, val):
+    """
+    Add val to the running [min, max, sum, count] of key in stats, a dict of
+    the form returned by group_stats() but with lists for values so that it
+    can be kept up to date one value at a time.
+    """
+    s = stats.get(key)
+    if s is None:
+        stats[key] = [val, val, val, 1]
+        return
+
+    if val < s[0]:
+        s[0] = val
+    if val > s[1]:
+        s[1] = val
+    s[2] += val
+    s[3] += 1
+
+
+def find_values(keys, values, wanted):
+    """
+    Return {(key, value): [index, ...]} giving the positions at which each
+    (key, value) pair in wanted occurs.
+
+    @param keys: sequence of integer keys.
+    @param values: sequence of values the same length as keys.
+    @param wanted: iterable of (key, value) pairs.
+    """
+    found = dict([(w, []) for w in wanted])
+    if numpy is None:
+        for i, pair in enumerate(itertools.izip(keys, values)):
+            if pair in found:
+                found[pair].append(i)
+
+        return found
+
+    keys = to_numpy(keys)
+    values = to_numpy(values)
+    for key, value in found:
+        indexes = numpy.flatnonzero(keys == key)
+        found[(key, value)] = indexes[values[indexes] == value].tolist()
+
+    return found
+
+
+class TopK(object):
+    """
+    Bounded collection of the k largest (or smallest) values pushed to it.
+    Each push costs O(log k) so it can be fed any number of values. Where
+    values are equal the one pushed first is kept.
+    """
+    def __init__(self, k, largest=True):
+        """
+        @param k: maximum number of entries retained.
+        @param largest: keep the largest values if True else the smallest.
+        """
+        self.k = k
+        self.largest = largest
+        self.heap = []
+        self.count = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, item, val):
+        self.count += 1
+        if self.k <= 0:
+            return
+
+        key = val if self.largest else -val
+        # The heap root is the entry to evict next so for equal keys the
+        # most recently pushed entry must sort first.
+        entry = (key, -self.count, item, val)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        """
+        Return list of (item, val) ordered from highest to lowest rank i.e.
+        descending for largest and ascending for smallest.
+        """
+        return [(e[2], e[3]) for e in sorted(self.heap, reverse=True)]
+
+
+class QuantileSketch(object):
+    """
+    Streaming quantile sketch in the style of DDSketch.
+
+    Positive values are counted in bins whose bounds grow geometrically so
+    that quantile() is within relative_accuracy of the true value. Memory is
+    bounded by max_bins; beyond that the lowest bins are folded together,
+    which only affects accuracy of the lowest quantiles. Sketches with the
+    same relative_accuracy merge exactly.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        """
+        @param relative_accuracy: maximum relative error of quantiles.
+        @param max_bins: maximum number of bins kept.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        # Values <= 0 cannot be binned logarithmically.
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, val):
+        self.count += 1
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+
+        if val <= 0:
+            self.zero_count += 1
+            return
+
+        index = int(math.ceil(math.log(val) / self.log_gamma))
+        count = self.bins.get(index)
+        if count is None:
+            self.bins[index] = 1
+            if len(self.bins) > self.max_bins:
+                self._collapse()
         else:
-            cache = None
+            self.bins[index] = count + 1
 
-        hostname = get_hostname_from_path(path)
-        try:
-            cmd = ['zgrep', '-EHi', keywords, path]
-            if not (cache and cache.hit):
-                lines = check_output(' '.join(cmd), shell=True).split('\n')
-            else:
-                lines = cache.readlines()
+    def _collapse(self):
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        lowest = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[lowest] += self.bins.pop(index)
 
-            for line in lines:
-                if cache and not cache.hit:
-                    cache.append("%s\n" % line)
+    def merge(self, other):
+        """
+        Add the values counted by other to this sketch.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with relative accuracy "
+                             "%s and %s" % (self.relative_accuracy,
+                                            other.relative_accuracy))
 
-                # filter out subthread logs
-                if not re.search(r":\s+-[0-9]*>", line):
-                    res = re.search(filter, line)
-                    if res:
-                        events.append({'host': hostname, 'data': res})
+        if not other.count:
+            return
 
-        except CalledProcessError:
-            pass
+        for index, count in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0) + count
 
-    return events
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def get_state(self):
+        """
+        Return the contents of the sketch as a tuple of builtin types that
+        can be saved with save_state(). See from_state().
+        """
+        return (self.relative_accuracy, self.max_bins, self.bins,
+                self.zero_count, self.count, self.min, self.max)
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state[0], state[1])
+        (sketch.bins, sketch.zero_count, sketch.count, sketch.min,
+         sketch.max) = state[2:]
+        return sketch
+
+    def quantile(self, q):
+        """
+        Return the estimated value at quantile q (0 <= q <= 1) or None if
+        nothing has been added.
+        """
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return self.min
+
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                val = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(val, self.min), self.max)
+
+        return self.max
+
+
+def save_state(path, kind, state):
+    """
+    Save the state of a stats collection to path so that it can later be
+    loaded with load_state() and merged with others rather than parsing
+    the logs it was built from again.
+
+    @param kind: name of the type of collection the state belongs to.
+    @param state: builtin types supported by marshal.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fd:
+        marshal.dump({'version': STATE_VERSION, 'kind': kind,
+                      'state': state}, fd)
+
+    os.rename(tmpfile, path)
+
+
+def load_state(path, kind):
+    """
+    Return the state saved to path by save_state().
+
+    @param kind: name of the type of collection the state must belong to.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            data = marshal.load(fd)
+    except (EOFError, ValueError, TypeError):
+        data = None
+
+    if (not isinstance(data, dict) or data.get('version') != STATE_VERSION or
+            data.get('kind') != kind):
+        raise ValueError("'%s' is not a saved %s state" % (path, kind))
+
+    return data['state']
+
+
+class ResultTable(object):
+    """
+    Table of results with named fields, from which text reports are
+    formatted and which can be exported as JSON or CSV by write_results()
+    and export_results().
+    """
+    def __init__(self, name, fields):
+        """
+        @param name: name of the table e.g. 'day_avg_wait'.
+        @param fields: list of field names.
+        """
+        self.name = name
+        self.fields = fields
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def append(self, *row):
+        self.rows.append(row)
+
+    def get_dicts(self):
+        return [OrderedDict(zip(self.fields, row)) for row in self.rows]
+
+    def write_csv(self, writer):
+        """
+        Write the fields and rows of the table with a csv.writer. Lists are
+        written space separated.
+        """
+        writer.writerow(self.fields)
+        for row in self.rows:
+            writer.writerow([' '.join([str(_format_value(v)) for v in val])
+                             if isinstance(val, (list, tuple))
+                             else _format_value(val) for val in row])
+
+
+def _format_value(value):
+    """
+    Return value as a type supported by JSON and CSV.
+    """
+    if isinstance(value, datetime.datetime):
+        return str(value)
+
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+
+    return value
+
+
+def write_results(fd, tables, fmt='json'):
+    """
+    Write tables of results to fd as a JSON object of {table: [row]}, where
+    each row is an object of {field: value}, or as CSV with a section for
+    each table headed by its name and fields.
+
+    @param tables: list of ResultTable, or dict of {name: tables} in which
+                   case JSON is nested by name and CSV tables are named
+                   name.table.
+    """
+    if isinstance(tables, dict):
+        groups = sorted(tables.items())
+    else:
+        groups = [(None, tables)]
+
+    if fmt == 'json':
+        data = OrderedDict()
+        for name, _tables in groups:
+            results = OrderedDict([(t.name, t.get_dicts()) for t in _tables])
+            if name is None:
+                data = results
+            else:
+                data[name] = results
+
+        json.dump(data, fd, indent=2, separators=(',', ': '),
+                  default=_format_value)
+        fd.write('\n')
+        return
+
+    writer = csv.writer(fd, lineterminator='\n')
+    first = True
+    for name, _tables in groups:
+        for table in _tables:
+            if not first:
+                writer.writerow([])
+
+            first = False
+            writer.writerow(['# %s' % (table.name if name is None else
+                                       '%s.%s' % (name, table.name))])
+            table.write_csv(writer)
+
+
+def _dtype(values):
+    """
+    Return the numpy style dtype e.g. <i8 of the items of an array.
+    """
+    kind = 'f' if values.typecode in 'fd' else 'i'
+    if values.typecode in 'BHILc':
+        kind = 'u'
+
+    order = '<' if sys.byteorder == 'little' else '>'
+    return '%s%s%d' % (order, kind, values.itemsize)
+
+
+def export_columns(path, columns):
+    """
+    Export a table of events column-wise to directory path, with each column
+    written to its own file as raw binary values (readable with e.g.
+    numpy.fromfile) described by a columns.json manifest. Strings are
+    dictionary encoded with the distinct values listed in the manifest.
+
+    @param columns: list of (name, values, dictionary) where values is an
+                    array and dictionary is the list of strings indexed by
+                    values, or None if values are not dictionary encoded.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    manifest = OrderedDict([('rows', len(columns[0][1]) if columns else 0),
+                            ('columns', [])])
+    for name, values, dictionary in columns:
+        filename = '%s.bin' % name
+        with open(os.path.join(path, filename), 'wb') as fd:
+            values.tofile(fd)
+
+        column = OrderedDict([('name', name), ('file', filename),
+                              ('dtype', _dtype(values))])
+        if dictionary is not None:
+            column['dictionary'] = dictionary
+
+        manifest['columns'].append(column)
+
+    with open(os.path.join(path, 'columns.json'), 'w') as fd:
+        json.dump(manifest, fd, indent=2, separators=(',', ': '))
+        fd.write('\n')
+
+
+def encode_strings(values):
+    """
+    Return (array, dictionary) dictionary encoding a list of strings for
+    export_columns().
+    """
+    index = {}
+    dictionary = []
+    codes = array('l')
+    for val in values:
+        code = index.get(val)
+        if code is None:
+            code = index[val] = len(dictionary)
+            dictionary.append(val)
+
+        codes.append(code)
+
+    return codes, dictionary
+
+
+def export_results(path, tables, columns=None, prefix=''):
+    """
+    Write each of tables to a CSV file named after it under directory path
+    and, if provided, export a table of events with export_columns() to
+    the events subdirectory.
+
+    @param prefix: prefix added to the name of every file written.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for table in tables:
+        with open(os.path.join(path, '%s%s.csv' % (prefix, table.name)),
+                  'w') as fd:
+            table.write_csv(csv.writer(fd, lineterminator='\n'))
+
+    if columns is not None:
+        export_columns(os.path.join(path, '%sevents' % prefix), columns)
+
+
+class XZFile(object):
+    """
+    Minimal file-like reader that streams the output of xz(1) for use when
+    no lzma module is available.
+    """
+    def __init__(self, path):
+        self.proc = Popen(['xz', '-dc', path], stdout=PIPE)
+
+    def read(self, size):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in ['.gz', '.bz2', '.xz']
+
+
+def open_log(path):
+    """
+    Open a plain, gzip, bzip2 or xz compressed logfile for reading.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    elif path.endswith('.xz'):
+        if lzma:
+            return lzma.open(path, 'rb')
+
+        return XZFile(path)
+
+    return open(path, 'rb')
+
+
+def _line_start(data, pos, lo, hi):
+    """
+    Return the offset of the first line in data[lo:hi] that starts at or
+    after pos.
+    """
+    if pos <= lo:
+        return lo
+
+    pos = data.find('\n', pos - 1, hi)
+    if pos < 0:
+        return hi
+
+    return pos + 1
+
+
+def _line_timestamp(data, pos, hi):
+    """
+    Return the timestamp of the first line at or after the line starting at
+    pos that has one, or None.
+    """
+    while pos < hi:
+        res = TIMESTAMP_RE.match(data, pos, hi)
+        if res:
+            return res.group(0)
+
+        pos = data.find('\n', pos, hi)
+        if pos < 0:
+            break
+
+        pos += 1
+
+    return None
+
+
+def _match_last_timestamp(data, lo, hi):
+    """
+    Return the TIMESTAMP_RE match of the last line in data[lo:hi] that
+    starts with a timestamp, or None. hi must be the end of a line.
+    """
+    pos = hi
+    while pos > lo:
+        start = data.rfind('\n', lo, pos - 1) + 1 or lo
+        res = TIMESTAMP_RE.match(data, start, pos)
+        if res:
+            return res
+
+        pos = start
+
+    return None
+
+
+def find_time_offset(data, timestamp, lo=0, hi=None):
+    """
+    Binary search timestamp ordered log data for the offset of the first
+    line whose timestamp is not before timestamp. Lines without a timestamp
+    are taken to belong to the preceding entry.
+
+    @param data: string or mmap of log data.
+    @param timestamp: timestamp string as formatted by TimeWindow.bounds()
+    @param lo: offset of the start of a line at which to start searching.
+    @param hi: offset at which to stop searching.
+    """
+    if hi is None:
+        hi = len(data)
+
+    first, last = lo, hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        t = _line_timestamp(data, _line_start(data, mid, first, last), last)
+        if t is None or t >= timestamp:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return _line_start(data, lo, first, last)
+
+
+def get_log_range(path, window, start=0, end=None):
+    """
+    Return (start, end) offsets of the part of an uncompressed logfile that
+    holds the lines within window. The logfile is memory-mapped and binary
+    searched so only a few pages of it are read.
+
+    @param path: path to logfile
+    @param window: TimeWindow
+    @param start: offset of a line at which to start.
+    @param end: offset at which to stop or None for the end of the file.
+    """
+    since, until = window.bounds()
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if end is None or end > size:
+            end = size
+
+        if not size or start >= end:
+            return start, end
+
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if since:
+                start = find_time_offset(data, since, start, end)
+            if until:
+                end = find_time_offset(data, until, start, end)
+        finally:
+            data.close()
+
+    return start, end
+
+
+def grep_log(path, keywords, start=0, end=None, window=None, cache=False):
+    """
+    Generator yielding each line of logfile that matches keywords, prefixed
+    with the path of the logfile as with grep -H. Decompressed data is read
+    and searched in blocks so only lines that match are ever split out and
+    memory usage is bounded by READ_BLOCK_SIZE regardless of the size of the
+    logfile. A final line without a newline is not searched.
+
+    @param path: path to logfile
+    @param keywords: case-insensitive regular expression.
+    @param start: offset at which to start reading (ignored for compressed
+                  logs).
+    @param end: offset at which to stop reading (ignored for compressed
+                logs).
+    @param window: TimeWindow. If provided, uncompressed logs are only read
+                   between the offsets found by get_log_range() and
+                   compressed logs are only searched where a TimeIndex or
+                   the timestamps of each block show they may hold lines
+                   within it. Lines outside of window may still be yielded.
+    @param cache: if True, the TimeIndex of a compressed log read with a
+                  window is loaded from CACHE_DIR, or built and saved there.
+                  Otherwise only the timestamps of each block are used.
+    """
+    since, until = window.bounds() if window else (None, None)
+    compressed = is_compressed(path)
+    index = None
+    if compressed:
+        start = 0
+        end = None
+        if window and cache:
+            index = TimeIndex(path)
+            if index.check():
+                bounds = index.get_range(since, until)
+                index.close()
+                index = None
+                if bounds is None:
+                    return
+
+                start, end = bounds
+    elif window:
+        start, end = get_log_range(path, window, start, end)
+        if start >= end:
+            return
+
+    points = []
+    last_point = None
+    regex = re.compile(keywords, re.IGNORECASE)
+    try:
+        with open_log(path) as fd:
+            if start and not compressed:
+                fd.seek(start)
+
+            # Offset of the next data to be read from fd and of the next
+            # decompressed data to be searched.
+            pos = 0 if compressed else start
+            remainder = ''
+            while True:
+                size = READ_BLOCK_SIZE
+                if end is not None and not index:
+                    size = min(size, end - pos)
+
+                block = fd.read(size) if size > 0 else ''
+                offset = pos - len(remainder)
+                pos += len(block)
+                if block:
+                    data = remainder + block
+                    # Only search complete lines, keeping any trailing
+                    # partial line for the next block.
+                    complete = data.rfind('\n') + 1
+                    remainder = data[complete:]
+                else:
+                    # A final line without a newline may still be being
+                    # written so is left for a later scan.
+                    data = remainder
+                    complete = 0
+
+                search = (offset + complete > start and
+                          (end is None or offset < end))
+                if complete and window:
+                    first = TIMESTAMP_RE.match(data, 0, complete)
+                    last = _match_last_timestamp(data, 0, complete)
+                    if index and first and (not points or offset >=
+                                            points[-1][0] +
+                                            TIME_INDEX_INTERVAL):
+                        points.append((offset, first.group(0)))
+                    if last:
+                        last_point = (offset + last.start(), last.group(0))
+
+                    if until and first and first.group(0) >= until:
+                        if not index:
+                            break
+
+                        search = False
+                    elif since and last and last.group(0) < since:
+                        search = False
+
+                i = 0
+                while search and i < complete:
+                    res = regex.search(data, i, complete)
+                    if not res:
+                        break
+
+                    line = data.rfind('\n', 0, res.start()) + 1
+                    i = data.find('\n', res.end(), complete)
+                    if i < 0:
+                        i = complete
+
+                    yield "%s:%s" % (path, data[line:i])
+                    i += 1
+
+                if not block:
+                    break
+
+            if index:
+                if last_point and (not points or points[-1] != last_point):
+                    points.append(last_point)
+
+                for point in points:
+                    index.append(point)
+
+                index.commit()
+    finally:
+        if index:
+            index.close()
+
+
+def cache_lines(cache, lines):
+    """
+    Generator adding each of lines to cache as it is consumed.
+    """
+    for line in lines:
+        cache.append(line)
+        yield line
+
+
+def _ceph_log_dir_state(path):
+    """
+    Return how far path has got towards a var/log/ceph directory, being the
+    number of trailing components of path that match var/log/ceph.
+    """
+    parts = path.rstrip(os.sep).split(os.sep)[-3:]
+    for n in (3, 2, 1):
+        if parts[-n:] == ['var', 'log', 'ceph'][:n]:
+            return n
+
+    return 0
+
+
+def _prune_log_dirs(dirpath, dirnames):
+    """
+    Return those of dirnames in dirpath that may lead to ceph-osd logs.
+    """
+    state = _ceph_log_dir_state(dirpath)
+    if 'var/log/ceph/ceph-osd' in dirpath:
+        return dirnames
+    elif state == 3:
+        return [d for d in dirnames if d.startswith('ceph-osd')]
+    elif state:
+        return [d for d in dirnames if d == ['log', 'ceph'][state - 1]]
+    elif 'var' in dirnames:
+        return ['var']
+    elif os.path.basename(dirpath).startswith('sosreport-'):
+        return []
+
+    return dirnames
+
+
+def walk_logs(root, dirs=None):
+    """
+    Generator yielding (dirpath, filename) for each regular file under root
+    whose path contains var/log/ceph/ceph-osd, as found by
+    find root -type f -name 'ceph*'. Only directories that may lead to
+    such a file are listed, so the rest of each sosreport is never walked.
+
+    @param root: directory to search.
+    @param dirs: optional dict that is filled with {dirpath: mtime} of every
+                 directory listed.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirs is not None:
+            dirs[dirpath] = os.stat(dirpath).st_mtime
+
+        dirnames[:] = _prune_log_dirs(dirpath, dirnames)
+        if (_ceph_log_dir_state(dirpath) != 3 and
+                'var/log/ceph/ceph-osd' not in dirpath):
+            continue
+
+        for f in filenames:
+            if not f.startswith('ceph'):
+                continue
+
+            path = os.path.join(dirpath, f)
+            match = path.find('var/log/ceph/ceph-osd')
+            if match < 0 or len(path) <= match + len('var/log/ceph/ceph-osd'):
+                continue
+
+            try:
+                if stat.S_ISREG(os.lstat(path).st_mode):
+                    yield dirpath, f
+            except OSError:
+                pass
+
+
+def _log_order(path):
+    """
+    Sort key ordering the rotations of each logfile oldest first e.g.
+    ceph-osd.0.log.2.gz, ceph-osd.0.log.1.gz, ceph-osd.0.log
+    """
+    dirname, basename = os.path.split(path)
+    name, _, rotation = basename.partition('.log.')
+    rotation = rotation.partition('.')[0]
+    if rotation.isdigit():
+        rotation = int(rotation)
+    else:
+        rotation = 0 if not rotation else -1
+
+    return (dirname, name, -rotation, basename)
+
+
+class LogManifest(object):
+    """
+    The ceph-osd logfiles found under a path along with the host each belongs
+    to and its size, ordered by directory and oldest rotation first.
+
+    Manifests can be cached along with the modification time of every
+    directory that was walked so that they only need to be rebuilt when a
+    directory has changed. File sizes are refreshed each time a manifest is
+    loaded.
+    """
+    suffix = 'manifest'
+
+    def __init__(self, path):
+        self.path = path
+        h = hashlib.sha256()
+        h.update(os.path.abspath(path))
+        self.manifestfile = os.path.join(CACHE_DIR, '%s-%s.%s' %
+                                         (os.path.basename(
+                                          os.path.abspath(path)),
+                                          h.hexdigest()[:16], self.suffix))
+        # [(path, host, size)]
+        self.logs = []
+        # {directory: mtime}
+        self.dirs = {}
+
+    @classmethod
+    def get(cls, path, cache=False):
+        """
+        Return an up to date manifest of path.
+
+        @param cache: if True, load the cached manifest and save it if it had
+                      to be rebuilt. Otherwise path is always walked and
+                      nothing is written to CACHE_DIR.
+        """
+        manifest = cls(path)
+        if not cache:
+            manifest.scan()
+        elif not manifest.load():
+            manifest.scan()
+            manifest.save()
+
+        return manifest
+
+    def scan(self):
+        hosts = {}
+        logs = []
+        self.dirs = {}
+        for dirpath, filename in walk_logs(self.path, self.dirs):
+            path = os.path.join(dirpath, filename)
+            if dirpath not in hosts:
+                hosts[dirpath] = intern(get_hostname_from_path(path))
+
+            logs.append((path, hosts[dirpath], os.stat(path).st_size))
+
+        self.logs = sorted(logs, key=lambda log: _log_order(log[0]))
+
+    def load(self):
+        """
+        Load the cached manifest, returning False if there is none or any of
+        the directories it was built from have changed.
+        """
+        try:
+            with open(self.manifestfile, 'rb') as fd:
+                data = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+
+        for dirpath, mtime in data['dirs'].iteritems():
+            try:
+                if os.stat(dirpath).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+
+        self.dirs = data['dirs']
+        self.logs = []
+        for path, host, _ in data['logs']:
+            try:
+                self.logs.append((path, intern(host), os.stat(path).st_size))
+            except OSError:
+                return False
+
+        return True
+
+    def save(self):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, mode=0755)
+
+        fd, tmpfile = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fd:
+            marshal.dump({'logs': self.logs, 'dirs': self.dirs}, fd)
+
+        os.rename(tmpfile, self.manifestfile)
+
+
+def get_logs(path, cache=False):
+    """
+    Return list of (path, host, size) for the ceph-osd logs found under path
+    or of path itself if it is a file.
+
+    @param cache: see LogManifest.get()
+    """
+    if os.path.isfile(path):
+        return [(path, intern(get_hostname_from_path(path)),
+                 os.stat(path).st_size)]
+
+    return LogManifest.get(path, cache).logs
+
+
+def find_logs(path, cache=False):
+    """
+    Return list of ceph-osd logs found under path or [path] if path is a file.
+
+    @param cache: see LogManifest.get()
+    """
+    return [log[0] for log in get_logs(path, cache)]
+
+
+class LogMatch(object):
+    """
+    Event for queries that have no record type. Only the groups captured by
+    the query filter are kept, rather than a re match object and the line it
+    references, and it can be returned from worker processes.
+    """
+    __slots__ = ('host', '_groups')
+
+    def __init__(self, host, groups):
+        self.host = host
+        self._groups = groups
+
+    def group(self, index):
+        return self._groups[index - 1]
+
+    def groups(self):
+        return self._groups
+
+
+class TimeWindow(object):
+    """
+    Interval of time from since (inclusive) until (exclusive), either of which
+    may be None to leave that end open.
+    """
+    def __init__(self, since=None, until=None):
+        """
+        @param since: datetime or None.
+        @param until: datetime or None.
+        """
+        self.since = since
+        self.until = until
+
+    def __nonzero__(self):
+        return self.since is not None or self.until is not None
+
+    def bounds(self):
+        """
+        Return (since, until) formatted as log timestamps for comparison
+        with those found in logfiles, or None for open ends.
+        """
+        return tuple([t and t.strftime(TIMESTAMP_FORMAT)
+                      for t in (self.since, self.until)])
+
+    def contains(self, t):
+        if self.since is not None and t < self.since:
+            return False
+
+        if self.until is not None and t >= self.until:
+            return False
+
+        return True
+
+
+class LogQuery(object):
+    """
+    Describes the log lines to extract from ceph-osd logs and how to decode
+    them.
+
+    @param keywords: case-insensitive regular expression used to find
+                     candidate lines.
+    @param filter: regular expression used to find relevant results.
+    @param fields: list of (name, type) describing the tuple returned by
+                   decode, where type is a key of FIELD_TYPES. Only queries
+                   with fields can have their events cached with
+                   cache_events.
+    @param decode: function converting the groups matched by filter into a
+                   tuple of fields. Defaults to using the groups as they are.
+    @param record: class used for events, called with the host followed by
+                   the decoded fields e.g. a namedtuple. Must be defined at
+                   module level so that events can be returned from worker
+                   processes. Defaults to LogMatch.
+    """
+    def __init__(self, keywords, filter, fields=None, decode=tuple,
+                 record=None):
+        self.keywords = keywords
+        self.filter = filter
+        self.fields = fields
+        self.decode = decode
+        self.record = record
+        self.keywords_re = re.compile(keywords, re.IGNORECASE)
+        self.filter_re = re.compile(filter)
+        # Position of the timestamp field in decoded events, if any, used to
+        # restrict events to a TimeWindow.
+        self.timestamp_index = None
+        for i, field in enumerate(fields or []):
+            if field[1] == 'timestamp':
+                self.timestamp_index = i
+                break
+
+    def make_event(self, host, data):
+        if self.record:
+            return self.record(host, *data)
+
+        return LogMatch(host, data)
+
+
+def decode_lines(lines, queries, names=None, skip=0):
+    """
+    Generator yielding (name, data) for every query that matches each of
+    lines, where data is the decoded event.
+
+    @param lines: log lines prefixed with the path of their logfile.
+    @param queries: dict of {name: LogQuery}
+    @param names: names of the queries to match in order. Defaults to all
+                  queries sorted by name.
+    @param skip: length of the path prefix of lines, which is not searched
+                 for the keywords of queries.
+    """
+    if names is None:
+        names = sorted(queries.keys())
+
+    queries = [(name, queries[name].keywords_re.search,
+                queries[name].filter_re.search, queries[name].decode)
+               for name in names]
+    subthread = SUBTHREAD_FILTER.search
+    for line in lines:
+        # filter out subthread logs
+        if subthread(line):
+            continue
+
+        for name, keywords, filter, decode in queries:
+            if not keywords(line, skip):
+                continue
+
+            res = filter(line)
+            if res:
+                yield name, decode(res.groups())
+
+
+def scan_log(path, queries, cache_results=False, cache_events=False,
+             window=None, indexed=None, host=None, chunk=None):
+    """
+    Scan a single logfile and dispatch every matching line to all queries.
+
+    @param path: path to logfile
+    @param queries: see get_multi()
+    @param cache_results: see get_multi()
+    @param cache_events: see get_multi()
+    @param window: see get_multi()
+    @param indexed: {keywords: lines} for path from a BundleIndex. Used
+                    instead of scanning path if it covers all queries.
+    @param host: host path belongs to. Found from path if not provided.
+    @param chunk: (start, end) offsets of the part of an uncompressed
+                  logfile to scan, as returned by split_log(). Cannot be
+                  used with caching.
+    @return: dict of {name: events}
+    """
+    events = {}
+    in_window = {}
+    for name in queries:
+        events[name] = []
+        index = queries[name].timestamp_index
+        if window and index is not None:
+            in_window[name] = (lambda data, index=index:
+                               window.contains(data[index]))
+
+    hostname = host or intern(get_hostname_from_path(path))
+    caches = {}
+    if cache_events:
+        identity = get_file_identity(path)
+        for name in queries:
+            if queries[name].fields:
+                caches[name] = EventCache(path, queries[name], hostname)
+                caches[name].check(identity)
+
+    names = sorted([name for name in queries
+                    if not (name in caches and caches[name].hit)])
+    start, end = chunk or (0, None)
+    if names and all([name in caches for name in names]):
+        # Resume from the earliest offset any outstanding cache was left at
+        # and rebuild any cache that is ahead of it.
+        start = min([caches[name].offset for name in names])
+        end = caches[names[0]].size
+        for name in names:
+            if caches[name].offset != start:
+                caches[name].reset()
+    else:
+        for name in names:
+            if name in caches:
+                caches[name].reset()
+
+        if caches:
+            # Only scan as far as the caches record having scanned so that
+            # anything appended meanwhile is scanned when they are resumed.
+            end = caches.values()[0].size
+
+    for name in caches:
+        make_event = queries[name].make_event
+        data = caches[name].readlines()
+        if name in in_window:
+            data = itertools.ifilter(in_window[name], data)
+
+        for d in data:
+            events[name].append(make_event(hostname, d))
+
+    # The index holds every matching line of path so cannot be used to
+    # resume from the offset a cache was left at.
+    if indexed is not None and (start or
+                                not all([queries[name].keywords in indexed
+                                         for name in names])):
+        indexed = None
+
+    keywords = '|'.join(["(%s)" % queries[name].keywords for name in names])
+    if (cache_results and not caches and indexed is None and
+            not (window and is_compressed(path))):
+        cache = ResultsCache(path, keywords, hostname)
+        cache.check()
+    else:
+        # A windowed scan of a compressed log only decompresses the part
+        # that its cached TimeIndex shows the window covers.
+        cache = None
+
+    try:
+        try:
+            if not names:
+                lines = []
+            elif indexed is not None:
+                lines = None
+            elif not cache:
+                # Logs can only be partially read if nothing is being cached.
+                lines = grep_log(path, keywords, start, end,
+                                 None if caches else window, cache_results)
+            elif cache.hit:
+                lines = cache.readlines()
+            else:
+                # Only scan data that is not already cached and record
+                # anything new that is found.
+                lines = itertools.chain(cache.readlines(),
+                                        cache_lines(cache,
+                                                    grep_log(path, keywords,
+                                                             cache.offset,
+                                                             cache.size)))
+
+            skip = len(path) + 1
+            if lines is None:
+                matches = itertools.chain(*[decode_lines(
+                    indexed[queries[name].keywords], queries, [name], skip)
+                    for name in names])
+            else:
+                matches = decode_lines(lines, queries, names, skip)
+
+            for name, data in matches:
+                if name in caches:
+                    caches[name].append(data)
+
+                if name in in_window and not in_window[name](data):
+                    continue
+
+                events[name].append(queries[name].make_event(hostname,
+                                                             data))
+
+        except (IOError, EOFError):
+            # Truncated or corrupt logfile - keep whatever was read before
+            # the error.
+            pass
+
+        for c in caches.values() + [cache]:
+            if c and not c.hit:
+                c.commit()
+    finally:
+        for c in caches.values() + [cache]:
+            if c:
+                c.close()
+
+    return events
+
+
+def _scan_log(args):
+    return scan_log(*args)
+
+
+def get_scan_size(path, size):
+    """
+    Return the estimated amount of data that must be read to scan a logfile
+    of the given (on disk) size. gzip records the decompressed size (modulo
+    4GiB) in its trailer; other compressed formats are estimated using
+    COMPRESSION_RATIO.
+    """
+    if path.endswith('.gz') and size >= 4:
+        try:
+            with open(path, 'rb') as fd:
+                fd.seek(-4, os.SEEK_END)
+                return max(struct.unpack('<I', fd.read(4))[0], size)
+        except (IOError, ValueError):
+            pass
+
+    if is_compressed(path):
+        return size * COMPRESSION_RATIO
+
+    return size
+
+
+def split_log(path, size, chunk_size=CHUNK_SIZE):
+    """
+    Return list of (start, end) offsets dividing an uncompressed logfile
+    into chunks of about chunk_size that each start at the beginning of a
+    line.
+    """
+    offsets = [0]
+    with open(path, 'rb') as fd:
+        while offsets[-1] + chunk_size < size:
+            fd.seek(offsets[-1] + chunk_size - 1)
+            fd.readline()
+            offset = fd.tell()
+            if offset >= size:
+                break
+
+            offsets.append(offset)
+
+    return zip(offsets, offsets[1:] + [size])
+
+
+def map_tasks(func, tasks, jobs=1, sizes=None):
+    """
+    Return an iterable of func applied to each of tasks in order, using a
+    pool of jobs worker processes if jobs > 1.
+
+    @param sizes: estimated cost of each task. If provided, the largest tasks
+                  are started first so that a large task started late does
+                  not leave the other workers idle.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        order = range(len(tasks))
+        if sizes:
+            order.sort(key=lambda i: sizes[i], reverse=True)
+
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(func, [tasks[i] for i in order], chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        ordered = [None] * len(tasks)
+        for i, result in zip(order, results):
+            ordered[i] = result
+
+        return ordered
+
+    return (func(task) for task in tasks)
+
+
+def get_multi(path, queries, cache_results=False, jobs=1,
+              cache_events=False, window=None, shard=None):
+    """
+    Scan each logfile once and dispatch every matching line to all queries.
+
+    @param path: path to logfile(s)
+    @param queries: dict of {name: LogQuery}
+    @param cache_results: see get(). The cache is keyed on the combined
+                          keywords of all queries.
+    @param jobs: number of worker processes used to scan logfiles. The
+                 largest logfiles are scanned first and uncompressed logfiles
+                 larger than CHUNK_SIZE are scanned in chunks in parallel.
+                 Results are merged in logfile order regardless of the
+                 number of jobs.
+    @param cache_events: If True, cache the decoded events of each query that
+                         has fields instead of the matched lines. Takes
+                         precedence over cache_results.
+    @param window: TimeWindow outside of which events of queries with a
+                   timestamp field are dropped. Caches still hold every
+                   event so they can be reused with other windows.
+    @param shard: (index, count) of the shard of hosts to scan the logs of.
+                  See in_shard().
+    @return: dict of {name: events}
+
+    If caching and path, or a directory above it, has a BundleIndex
+    covering the keywords of all queries, matching lines are read from it
+    rather than scanning logfiles that have not changed since it was built.
+    """
+    events = {}
+    for name in queries:
+        events[name] = []
+
+    index = None
+    if cache_results or cache_events:
+        index = BundleIndex.find(path)
+
+    keywords = [q.keywords for q in queries.values()]
+    tasks = []
+    sizes = []
+    for log, host, size in get_logs(path, cache_results or cache_events):
+        if not in_shard(host, shard):
+            continue
+
+        indexed = index and index.get_lines(log, keywords)
+        chunks = [None]
+        if (jobs > 1 and size > CHUNK_SIZE and not is_compressed(log) and
+                not (cache_results or cache_events or indexed)):
+            chunks = split_log(log, size, CHUNK_SIZE)
+
+        for chunk in chunks:
+            tasks.append((log, queries, cache_results, cache_events, window,
+                          indexed, host, chunk))
+            if chunk:
+                sizes.append(chunk[1] - chunk[0])
+            else:
+                sizes.append(get_scan_size(log, size))
+
+    for result in map_tasks(_scan_log, tasks, jobs, sizes):
+        for name in result:
+            events[name] += result[name]
+
+    return events
+
+
+def get_events(path, query, cache_results=False, jobs=1, cache_events=False,
+               window=None):
+    """
+    Return the events found by a single LogQuery. See get_multi().
+    """
+    return get_multi(path, {'events': query}, cache_results, jobs,
+                     cache_events, window)['events']
+
+
+def _complete_end(fd, start, end):
+    """
+    Return the offset just after the last newline of fd between start and
+    end, or start if there is none, so that a line still being written is
+    not read.
+    """
+    pos = end
+    while pos > start:
+        size = min(READ_BLOCK_SIZE, pos - start)
+        fd.seek(pos - size)
+        i = fd.read(size).rfind('\n')
+        if i >= 0:
+            return pos - size + i + 1
+
+        pos -= size
+
+    return start
+
+
+class LogFollower(object):
+    """
+    Follows the current (uncompressed) ceph-osd logs under a path, as
+    tail -F would, so that only lines appended since the last poll are read.
+
+    The inode and offset reached in each log are kept so that when a log is
+    rotated the remainder of the old file is read, if it has not yet been
+    compressed, before starting on the new one. A log that shrinks or whose
+    first few KiB have changed is taken to have been truncated and is read
+    again from the start.
+    """
+    def __init__(self, path, queries, window=None):
+        """
+        @param path: path to logfile(s) e.g. /var/log/ceph or a sosreport.
+        @param queries: dict of {name: LogQuery}
+        @param window: TimeWindow outside of which events of queries with a
+                       timestamp field are dropped. Logs present at the first
+                       poll are read from window.since if set, otherwise only
+                       lines appended after the first poll are read.
+        """
+        self.path = path
+        self.queries = queries
+        self.window = window
+        self.names = sorted(queries.keys())
+        self.keywords = '|'.join(["(%s)" % queries[name].keywords
+                                  for name in self.names])
+        # {path: (inode, offset, head)}
+        self.offsets = {}
+        self.hosts = {}
+        self.polled = False
+
+    def _get_host(self, path):
+        dirpath = os.path.dirname(path)
+        if dirpath not in self.hosts:
+            host = get_hostname_from_path(path)
+            if host == '<unknownhost>':
+                # Live logs rather than a sosreport.
+                host = socket.gethostname()
+
+            self.hosts[dirpath] = intern(host)
+
+        return self.hosts[dirpath]
+
+    @staticmethod
+    def _get_head(path, size):
+        try:
+            with open(path, 'rb') as fd:
+                return fd.read(min(size, 4096))
+        except IOError:
+            return ''
+
+    def _read(self, path, start, end, events, window=None):
+        """
+        Add the events found in the complete lines of path between start and
+        end to events and return the offset reached.
+        """
+        try:
+            with open(path, 'rb') as fd:
+                end = _complete_end(fd, start, end)
+
+            if end <= start:
+                return start
+
+            host = self._get_host(path)
+            for name, data in decode_lines(grep_log(path, self.keywords, start,
+                                                    end, window),
+                                           self.queries, self.names,
+                                           len(path) + 1):
+                index = self.queries[name].timestamp_index
+                if (self.window and index is not None and
+                        not self.window.contains(data[index])):
+                    continue
+
+                events[name].append(self.queries[name].make_event(host, data))
+        except IOError:
+            # Removed before it could be read.
+            return start
+
+        return end
+
+    def poll(self):
+        """
+        Return dict of {name: events} found in lines appended to the logs
+        since the last poll.
+        """
+        events = {}
+        for name in self.queries:
+            events[name] = []
+
+        current = {}
+        rotated = {}
+        for dirpath, filename in walk_logs(self.path):
+            path = os.path.join(dirpath, filename)
+            if is_compressed(path):
+                continue
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            if filename.endswith('.log'):
+                current[path] = st
+            else:
+                rotated[st.st_ino] = (path, st.st_size)
+
+        offsets = {}
+        for path in sorted(current):
+            st = current[path]
+            window = None
+            if path in self.offsets:
+                inode, start, head = self.offsets[path]
+                if inode != st.st_ino:
+                    if inode in rotated:
+                        self._read(rotated[inode][0], start,
+                                   rotated[inode][1], events)
+
+                    start = 0
+                elif (st.st_size < start or
+                      self._get_head(path, len(head)) != head):
+                    start = 0
+            elif self.polled:
+                # Created since the last poll.
+                start = 0
+            elif self.window and self.window.since:
+                start = 0
+                window = TimeWindow(self.window.since)
+            else:
+                start = st.st_size
+
+            end = self._read(path, start, st.st_size, events, window)
+            offsets[path] = (st.st_ino, end, self._get_head(path, end))
+
+        self.offsets = offsets
+        self.polled = True
+        return events
+
+
+def follow_logs(path, queries, interval, callback, window=None):
+    """
+    Poll the logs under path every interval microseconds, calling callback
+    with the dict of {name: events} found in newly appended lines each time,
+    until interrupted. See LogFollower.
+    """
+    follower = LogFollower(path, queries, window)
+    try:
+        while True:
+            callback(follower.poll())
+            time.sleep(interval / 1000000.0)
+    except KeyboardInterrupt:
+        pass
+
+
+def get(path, keywords, filter, cache_results=False, jobs=1):
+    """
+    @param path: path to logfile(s)
+    @param keywords: grep filter to find relevant log files.
+    @param filter: regular expression used to find relevant results.
+    @param cache_results: If True will attempt to load results from cache.
+                          A valid cache must have the same filter and sha256sum
+                          as the current query otherwise the original query is
+                          run on the target and the cache contents are
+                          overwritten.
+    @param jobs: number of worker processes used to scan logfiles.
+    """
+    return get_events(path, LogQuery(keywords, filter), cache_results, jobs)
@@ -2,6 +2,9 @@
 DATAPATH=""
 REPORT=report.txt
 MONTH=""
+JOBS=1
+SHARDS=1
+PARTIALS=()
 
 usage ()
 {
@@ -9,6 +12,9 @@ usage ()
                  '--month <int>'
                  '--datapath <path>'
                  '[--output-file <path>]'
+                 '[--jobs <int>]'
+                 '[--shards <int>]'
+                 '[--partial <path>]...'
                 )
     echo -n 'USAGE:'
     for opt in "${opts[@]}"; do
@@ -31,6 +37,22 @@ do
         DATAPATH="$2"
         shift
         ;;
+    --jobs)
+        JOBS="$2"
+        shift
+        ;;
+    --shards)
+        # Parse the hosts of datapath in this many separate processes, as
+        # would be done on as many machines with report.py --shard.
+        SHARDS="$2"
+        shift
+        ;;
+    --partial)
+        # Partial results saved by report.py --save-partial e.g. on another
+        # machine.
+        PARTIALS+=(--merge-partial "$2")
+        shift
+        ;;
     *)
         echo "ERROR: unknown option '$1'"
         usage
@@ -40,48 +62,32 @@ do
     shift
 done
 
-if [ -z "$DATAPATH" ] || [ -z "$MONTH" ]; then usage; exit 1; fi
+if [ -z "$MONTH" ]; then usage; exit 1; fi
+if [ -z "$DATAPATH" ] && ((${#PARTIALS[@]} == 0)); then usage; exit 1; fi
 
 rm -f $REPORT
 
-#echo -n "Parsing smart recovery data..."
-#cat << EOF > $REPORT
-#=======================================================
-#================= Smart Recovery Data =================
-#=======================================================
-#
-#EOF
-#./parse_smart_data.py >> $REPORT
-#echo "done"
-
-echo -n "Parsing scrub data..."
-cat << EOF >> $REPORT
-========================================================
-===================== Scrubs Data ======================
-========================================================
-
-EOF
-./parse_scrubs.py --month $MONTH --path $DATAPATH >> $REPORT
-echo "done"
-
-echo -n "Parsing slow request data..."
-cat << EOF >> $REPORT
-========================================================
-================== Slow Request Data ===================
-========================================================
-
-EOF
-./parse_slow_requests.py --path $DATAPATH >> $REPORT
-echo "done"
-
-echo -n "Parsing suicide timeout data..."
-cat << EOF >> $REPORT
-========================================================
-================== Suicide Timeout Data ================
-========================================================
-
-EOF
-./parse_suicides.py --month $MONTH --path $DATAPATH >> $REPORT
-echo "done"
+if [ -n "$DATAPATH" ] && ((SHARDS > 1)); then
+    echo -n "Parsing ceph logs in $SHARDS shards..."
+    tmpdir=$(mktemp -d)
+    trap "rm -rf $tmpdir" EXIT
+    pids=()
+    for ((i = 0; i < SHARDS; i++)); do
+        ./report.py --path $DATAPATH --shard $i/$SHARDS --jobs $JOBS \
+            --save-partial $tmpdir/$i.partial &
+        pids+=($!)
+        PARTIALS+=(--merge-partial $tmpdir/$i.partial)
+    done
+    for pid in "${pids[@]}"; do
+        wait $pid
+    done
+    ./report.py --month $MONTH "${PARTIALS[@]}" >> $REPORT
+    echo "done"
+else
+    echo -n "Parsing ceph logs..."
+    ./report.py --month $MONTH ${DATAPATH:+--path $DATAPATH} --jobs $JOBS \
+        ${PARTIALS[@]+"${PARTIALS[@]}"} >> $REPORT
+    echo "done"
+fi
 
 echo -e "\nReport written to $REPORT."
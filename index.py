@@ -0,0 +1,102 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+
+import parse_scrubs
+import parse_slow_requests
+import parse_suicides
+
+from common import BundleIndex, find_logs, grep_log
+
+# Keywords indexed by default, which cover every parser.
+KEYWORDS = [parse_scrubs.KEYWORDS, parse_slow_requests.KEYWORDS,
+            parse_suicides.KEYWORDS]
+
+
+def build(args):
+    """
+    Build or update the index of args.path.
+    """
+    index = BundleIndex(args.path)
+    if os.path.isfile(index.indexfile):
+        index.load()
+
+    index.build(KEYWORDS + (args.keywords or []), args.jobs)
+    total = sum([len(lines) for entry in index.files.itervalues()
+                 for lines in entry['lines'].itervalues()])
+    print "Indexed %s lines from %s logfiles in %s" % \
+        (total, len(index.files), index.indexfile)
+
+
+def query(args):
+    """
+    Print the lines of each logfile under args.path that match
+    args.keywords, as grep -H would, reading them from the index if it has
+    them.
+    """
+    index = BundleIndex.find(args.path)
+    if args.add and (not index or args.keywords not in index.keywords):
+        index = index or BundleIndex(args.path)
+        index.build([args.keywords], args.jobs)
+
+    for log in find_logs(args.path):
+        lines = index and index.get_lines(log, [args.keywords])
+        if lines and args.keywords in lines:
+            lines = lines[args.keywords]
+        else:
+            lines = grep_log(log, args.keywords)
+
+        for line in lines:
+            print line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    build_parser = subparsers.add_parser('build',
+                                         help="Index the logfiles under "
+                                              "--path.")
+    build_parser.add_argument('--path', type=str, default=None,
+                              required=True)
+    build_parser.add_argument('--keywords', type=str, action='append',
+                              help="Additional keywords to index. May be "
+                                   "given more than once.")
+    build_parser.add_argument('--jobs', type=int, default=1,
+                              help="Number of logfiles to scan in parallel.")
+    build_parser.set_defaults(func=build)
+    query_parser = subparsers.add_parser('query',
+                                         help="Print lines matching "
+                                              "keywords.")
+    query_parser.add_argument('keywords', type=str)
+    query_parser.add_argument('--path', type=str, default=None,
+                              required=True)
+    query_parser.add_argument('--add', action='store_true', default=False,
+                              help="Add keywords to the index if they are "
+                                   "not already indexed.")
+    query_parser.add_argument('--jobs', type=int, default=1,
+                              help="Number of logfiles to scan in parallel.")
+    query_parser.set_defaults(func=query)
+    args = parser.parse_args()
+    args.func(args)
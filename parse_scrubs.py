@@ -21,10 +21,140 @@
 # along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import copy
-import datetime
-
-from common import get, avg
+import sys
+
+from array import array
+from collections import namedtuple
+
+from common import (
+    encode_strings,
+    export_results,
+    format_duration,
+    from_epoch_us,
+    get_events,
+    load_state,
+    parse_duration,
+    parse_time,
+    parse_timestamp,
+    save_state,
+    time_histogram,
+    to_epoch_us,
+    write_results,
+    LogQuery,
+    ResultTable,
+    TimeWindow,
+)
+
+KEYWORDS = ' scrub | deep-scrub '
+FILTER = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9]"
+          "[0-9][0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:"
+          "[0-9]+:[0-9]+\.[0-9]*).+ : ([0-9]*\."
+          "[0-9]*[a-z]*.+)")
+FIELDS = [('osd', 'osd'), ('timestamp', 'timestamp'), ('pg', 'str'),
+          ('action', 'str'), ('status', 'str')]
+ScrubEvent = namedtuple('ScrubEvent', ['host'] + [f[0] for f in FIELDS])
+
+
+def decode(groups):
+    info = groups[2].split()
+    return (intern(groups[0]), parse_timestamp(groups[1]), intern(info[0]),
+            intern(info[1]), intern(info[2]))
+
+
+QUERY = LogQuery(KEYWORDS, FILTER, FIELDS, decode, ScrubEvent)
+
+# Kind of state saved by --save-state.
+STATE_KIND = 'scrubs'
+
+ACTIONS = ['scrub', 'deep-scrub']
+ACTION_INDEX = {'scrub': 0, 'deep-scrub': 1}
+
+
+class PGScrubState(object):
+    """
+    Start time of the in-flight action of each type, indexed by
+    ACTION_INDEX, for a PG on an OSD.
+
+    Also records whether each action has been seen to start and the first
+    time each completed without having been seen to start, so that an
+    action in flight at the end of one collection can be completed by
+    another that is merged with it.
+    """
+    __slots__ = ('pg_id', 'starts', 'started', 'ends')
+
+    def __init__(self, pg_id):
+        self.pg_id = pg_id
+        self.starts = [None, None]
+        self.started = [False, False]
+        self.ends = [None, None]
+
+    def get_state(self):
+        return ([t and to_epoch_us(t) for t in self.starts], self.started,
+                [t and to_epoch_us(t) for t in self.ends])
+
+    @classmethod
+    def from_state(cls, pg_id, state):
+        pg_state = cls(pg_id)
+        pg_state.starts = [t and from_epoch_us(t) for t in state[0]]
+        pg_state.started = list(state[1])
+        pg_state.ends = [t and from_epoch_us(t) for t in state[2]]
+        return pg_state
+
+
+class ScrubColumns(object):
+    """
+    Completed actions of an OSD stored column-wise. Start and end times are
+    microseconds since the epoch.
+    """
+    __slots__ = ('pgs', 'actions', 'starts', 'ends')
+
+    def __init__(self):
+        self.pgs = []
+        self.actions = array('b')
+        self.starts = array('d')
+        self.ends = array('d')
+
+    def __len__(self):
+        return len(self.pgs)
+
+    def append(self, pg, action, start, end):
+        self.pgs.append(pg)
+        self.actions.append(ACTION_INDEX[action])
+        self.starts.append(to_epoch_us(start))
+        self.ends.append(to_epoch_us(end))
+
+    def extend(self, other):
+        self.pgs.extend(other.pgs)
+        self.actions.extend(other.actions)
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+
+    def get_state(self):
+        return (self.pgs, self.actions.tostring(), self.starts.tostring(),
+                self.ends.tostring())
+
+    @classmethod
+    def from_state(cls, state):
+        columns = cls()
+        columns.pgs = [intern(pg) for pg in state[0]]
+        columns.actions.fromstring(state[1])
+        columns.starts.fromstring(state[2])
+        columns.ends.fromstring(state[3])
+        return columns
+
+    def get_actions(self, action=None):
+        """
+        Generator yielding (pg, action, start, end) for completed actions.
+        """
+        index = None
+        if action:
+            index = ACTION_INDEX[action]
+
+        for i in xrange(len(self.pgs)):
+            if index is None or self.actions[i] == index:
+                yield (self.pgs[i], ACTIONS[self.actions[i]],
+                       from_epoch_us(self.starts[i]),
+                       from_epoch_us(self.ends[i]))
 
 
 class CephScrubStatsCollection(object):
@@ -33,199 +163,401 @@ class CephScrubStatsCollection(object):
         self.aggrs_by_osd = {}
         self.aggrs_by_date = {}
         self.epoc = None
-        self.scrub_stats = {'osds': {}, 'pgs': {}}
+        # {osd: {pg: PGScrubState}}
+        self.pg_states = {}
+        # {osd: ScrubColumns}
+        self.completed = {}
+        # {osd: host}
+        self.hosts = {}
+        self._scrub_stats = None
         self.mins = []
         self.maxs = []
         self.avgs = []
         self.date_avgs = []
         self.events = events
         self.repeats = []
+        # {osd: {'pg': pg, 'count': int}} of the last deep-scrub completed
+        # on each osd, used to track repeats.
+        self.last_completed = {}
+        # Indexes of completed actions built by parse() so that per-day
+        # queries are lookups rather than walks of scrub_stats.
+        # {(action, month, day): {'count': int, 'osds': set, 'pgs': set,
+        #                         'longest': (length, pg),
+        #                         'osd_lengths': {osd: [sum, count]}}}
+        self.start_index = {}
+        # {(action, month, day): {osd: count}}
+        self.end_index = {}
+        # {month: set} of OSDs/PGs with completed actions started in month.
+        self.osds_by_month = {}
+        self.pgs_by_month = {}
+        # {action: count} of all completed actions.
+        self.action_counts = {'scrub': 0, 'deep-scrub': 0}
+
+    def _index_action(self, osd, pg, action, start, end):
+        length = end - start
+        self.action_counts[action] += 1
+        if start.month not in self.osds_by_month:
+            self.osds_by_month[start.month] = set()
+            self.pgs_by_month[start.month] = set()
+
+        self.osds_by_month[start.month].add(osd)
+        self.pgs_by_month[start.month].add(pg)
+
+        key = (action, start.month, start.day)
+        if key not in self.start_index:
+            self.start_index[key] = {'count': 0, 'osds': set(),
+                                     'pgs': set(), 'longest': None,
+                                     'osd_lengths': {}}
+
+        day = self.start_index[key]
+        day['count'] += 1
+        day['osds'].add(osd)
+        day['pgs'].add(pg)
+        if not day['longest'] or day['longest'][0] < length:
+            day['longest'] = (length, pg)
+
+        if osd not in day['osd_lengths']:
+            day['osd_lengths'][osd] = [length, 1]
+        else:
+            day['osd_lengths'][osd][0] += length
+            day['osd_lengths'][osd][1] += 1
+
+        key = (action, end.month, end.day)
+        if key not in self.end_index:
+            self.end_index[key] = {}
+
+        counts = self.end_index[key]
+        counts[osd] = counts.get(osd, 0) + 1
+
+    def _index_columns(self, osd, columns):
+        for pg, action, start, end in columns.get_actions():
+            self._index_action(osd, pg, action, start, end)
+
+    def _track_repeat(self, osd, pg):
+        """
+        Track repeats - http://tracker.ceph.com/issues/16474
+
+        Called for each deep-scrub completed on osd in order.
+        """
+        last = self.last_completed.get(osd)
+        if last is None:
+            self.last_completed[osd] = {'pg': pg, 'count': 1}
+        elif last['pg'] == pg:
+            last['count'] += 1
+        else:
+            if last['count'] > 1:
+                self.repeats.append({'osd': osd, 'pg': pg,
+                                     'count': last['count']})
+            self.last_completed[osd] = {'pg': pg, 'count': 1}
 
     def parse(self):
-        last_completed = {}
-
-        for event in self.events:
-            data = event['data']
-            osd = data.group(1)
-            t = datetime.datetime.strptime(data.group(2),
-                                           '%Y-%m-%d %H:%M:%S.%f')
-
-            info = data.group(3)
-            pg = info.split()[0]
-            action = info.split()[1]
-            status = info.split()[2]
-
-            empty = {'start': None, 'end': None}
-            empty_actions = {'scrub': empty,
-                             'deep-scrub': copy.deepcopy(empty)}
-            empty_pg = {pg: {'pg_id': pg,
-                             'actions': empty_actions,
-                             'shelved_actions': {'deep-scrub': [],
-                                                 'scrub': []}}}
-
-            if osd not in self.scrub_stats['osds']:
-                self.scrub_stats['osds'][osd] = {'pgs': empty_pg}
-            elif pg not in self.scrub_stats['osds'][osd]['pgs']:
-                self.scrub_stats['osds'][osd]['pgs'].update(empty_pg)
-
-            _pg = self.scrub_stats['osds'][osd]['pgs'][pg]
-            if pg not in self.scrub_stats['pgs']:
-                self.scrub_stats['pgs'][pg] = {osd: _pg}
-            else:
-                self.scrub_stats['pgs'][pg][osd] = _pg
-
-            pg_action = _pg['actions'][action]
+        self.update(self.events)
+
+    def update(self, events):
+        """
+        Add events to the collection, which may be done repeatedly with
+        events that follow on from those already added.
+
+        @param events: iterable of ScrubEvent.
+        """
+        self._scrub_stats = None
+
+        for event in events:
+            osd = event.osd
+            t = event.timestamp
+            pg = event.pg
+            action = event.action
+            status = event.status
+
+            states = self.pg_states.get(osd)
+            if states is None:
+                states = self.pg_states[osd] = {}
+                self.completed[osd] = ScrubColumns()
+                self.hosts[osd] = event.host
+
+            state = states.get(pg)
+            if state is None:
+                state = states[pg] = PGScrubState(pg)
+
+            index = ACTION_INDEX[action]
             if status == "starts":
-                pg_action['start'] = t
+                state.starts[index] = t
+                state.started[index] = True
             elif status == "ok":
-                if not pg_action['start']:
+                start = state.starts[index]
+                if not start:
                     # Ignore this event since it probably started before the
-                    # beginning of the current analysis window
+                    # beginning of the current analysis window, but keep it
+                    # in case that is covered by a collection merged later.
+                    if not state.started[index] and state.ends[index] is None:
+                        state.ends[index] = t
+
                     continue
 
-                pg_action['end'] = t
-                pg_action['length'] = t - pg_action['start']
-                if all(pg_action):
-                    # Track repeats - http://tracker.ceph.com/issues/16474
-                    if action == 'deep-scrub':
-                        if osd not in last_completed:
-                            last_completed[osd] = {'pg': pg, 'count': 1}
-                        elif last_completed[osd]['pg'] == pg:
-                            last_completed[osd]['count'] += 1
-                        else:
-                            if last_completed[osd]['count'] > 1:
-                                count = last_completed[osd]['count']
-                                self.repeats.append({'osd': osd, 'pg': pg,
-                                                     'count': count})
-                            last_completed[osd] = {'pg': pg, 'count': 1}
-
-                    actions = _pg['shelved_actions'][action]
-                    actions.append(pg_action)
-                    _pg['actions'][action] = copy.deepcopy(empty)
+                state.starts[index] = None
+                if action == 'deep-scrub':
+                    self._track_repeat(osd, pg)
 
+                self.completed[osd].append(pg, action, start, t)
+                self._index_action(osd, pg, action, start, t)
             else:
                 raise Exception("Unknown status '%s'" % (status))
 
+    def merge(self, other):
+        """
+        Add the actions of another collection to this one e.g. one restored
+        from the state saved after parsing another sosreport. Where both
+        have events from the same OSDs those of other must follow on from
+        those of this collection, in which case actions still in flight
+        here are completed by other.
+        """
+        self._scrub_stats = None
+        # {osd: [(end, pg)]} of the deep-scrubs completed in other, including
+        # those started here, which are replayed in order so that a run of
+        # repeats open at the end of this collection is carried on by other.
+        deep_scrubs = {}
+        for osd, _states in other.pg_states.iteritems():
+            states = self.pg_states.get(osd)
+            if states is None:
+                states = self.pg_states[osd] = {}
+                self.completed[osd] = ScrubColumns()
+                self.hosts[osd] = other.hosts[osd]
+
+            for pg, _state in _states.iteritems():
+                state = states.get(pg)
+                if state is None:
+                    state = states[pg] = PGScrubState(pg)
+
+                for index, action in enumerate(ACTIONS):
+                    end = _state.ends[index]
+                    if end is not None:
+                        start = state.starts[index]
+                        if start:
+                            state.starts[index] = None
+                            self.completed[osd].append(pg, action, start,
+                                                       end)
+                            self._index_action(osd, pg, action, start, end)
+                            if action == 'deep-scrub':
+                                deep_scrubs.setdefault(osd, []).append(
+                                    (end, pg))
+                        elif (not state.started[index] and
+                              state.ends[index] is None):
+                            state.ends[index] = end
+
+                    if _state.started[index]:
+                        state.starts[index] = _state.starts[index]
+                        state.started[index] = True
+
+        for osd, columns in other.completed.iteritems():
+            self.completed[osd].extend(columns)
+            self._index_columns(osd, columns)
+            deep_scrubs.setdefault(osd, []).extend(
+                [(end, pg) for pg, _, _, end in
+                 columns.get_actions('deep-scrub')])
+
+        for osd, completions in deep_scrubs.iteritems():
+            completions.sort(key=lambda c: c[0])
+            for end, pg in completions:
+                self._track_repeat(osd, pg)
+
+    def get_state(self):
+        """
+        Return the parsed state of the collection for common.save_state().
+        See from_state().
+        """
+        return {'pg_states': dict([(osd, dict([(pg, state.get_state())
+                                               for pg, state in
+                                               states.iteritems()]))
+                                   for osd, states in
+                                   self.pg_states.iteritems()]),
+                'completed': dict([(osd, columns.get_state())
+                                   for osd, columns in
+                                   self.completed.iteritems()]),
+                'hosts': self.hosts,
+                'repeats': self.repeats,
+                'last_completed': self.last_completed}
+
+    @classmethod
+    def from_state(cls, month, state):
+        """
+        Return a collection restored from the output of get_state().
+        """
+        collection = cls(month, [])
+        for osd, states in state['pg_states'].iteritems():
+            osd = intern(osd)
+            collection.pg_states[osd] = dict([(intern(pg),
+                                               PGScrubState.from_state(
+                                                   intern(pg), pg_state))
+                                              for pg, pg_state in
+                                              states.iteritems()])
+
+        for osd, columns in state['completed'].iteritems():
+            osd = intern(osd)
+            collection.completed[osd] = ScrubColumns.from_state(columns)
+            collection._index_columns(osd, collection.completed[osd])
+
+        collection.hosts = dict([(intern(osd), intern(host)) for osd, host in
+                                 state['hosts'].iteritems()])
+        collection.repeats = state['repeats']
+        collection.last_completed = state['last_completed']
+        return collection
+
+    @property
+    def scrub_stats(self):
+        """
+        Nested dict view of pg_states and completed in the form:
+
+        {'osds': {osd: {'pgs': {pg: PG}}}, 'pgs': {pg: {osd: PG}}}
+
+        where PG is {'pg_id': pg,
+                     'actions': {action: {'start': t, 'end': None}},
+                     'shelved_actions': {action: [{'start': t, 'end': t,
+                                                   'length': td}]}}
+
+        Built on first access after parse().
+        """
+        if self._scrub_stats is not None:
+            return self._scrub_stats
+
+        stats = {'osds': {}, 'pgs': {}}
+        for osd in self.pg_states:
+            pgs = {}
+            for pg, state in self.pg_states[osd].iteritems():
+                pgs[pg] = {'pg_id': pg,
+                           'actions': dict([(action,
+                                             {'start':
+                                              state.starts[ACTION_INDEX[
+                                                  action]],
+                                              'end': None})
+                                            for action in ACTIONS]),
+                           'shelved_actions': {'scrub': [],
+                                               'deep-scrub': []}}
+                if pg not in stats['pgs']:
+                    stats['pgs'][pg] = {}
+
+                stats['pgs'][pg][osd] = pgs[pg]
+
+            for pg, action, start, end in self.completed[osd].get_actions():
+                pgs[pg]['shelved_actions'][action].append({'start': start,
+                                                           'end': end,
+                                                           'length':
+                                                           end - start})
+
+            stats['osds'][osd] = {'pgs': pgs}
+
+        self._scrub_stats = stats
+        return stats
+
+    def get_histogram(self, width, action):
+        """
+        Return a sorted list of (datetime, (min, max, sum, count)) of the
+        length in seconds of actions completed in each bucket of width
+        microseconds.
+        """
+        index = ACTION_INDEX[action]
+        ends = array('d')
+        lengths = array('d')
+        for columns in self.completed.itervalues():
+            for i in xrange(len(columns)):
+                if columns.actions[i] == index:
+                    ends.append(columns.ends[i])
+                    lengths.append((columns.ends[i] - columns.starts[i]) /
+                                   1000000)
+
+        return time_histogram(ends, width, lengths)
+
+    def get_days(self, action):
+        """
+        Return sorted list of days of self.month on which action started.
+        """
+        return sorted([key[2] for key in self.start_index
+                       if key[0] == action and key[1] == self.month])
+
     def get_stats(self, action):
         stats = {}
-        for osd in self.scrub_stats['osds']:
-            pgs = self.scrub_stats['osds'][osd]['pgs']
-            for pg in pgs:
-                for s in pgs[pg]['shelved_actions'][action]:
-                    action_start = s['start']
-                    month = action_start.month
-                    if int(month) == self.month:
-                        day = action_start.day
-                        if day in stats:
-                            stats[day]['count'] += 1
-                            stats[day]['osds'].append(osd)
-                            stats[day]['pgs'].append(pg)
-                            length = {'pg': pg, 'length': s['length']}
-                            current_length = stats[day]['max_length']
-                            if not current_length:
-                                stats[day]['max_length'] = length
-                            elif current_length['length'] < s['length']:
-                                stats[day]['max_length'] = length
-                        else:
-                            stats[day] = {'count': 1,
-                                          'osds': [osd],
-                                          'pgs': [pg],
-                                          'max_length': None}
+        for day in self.get_days(action):
+            index = self.start_index[(action, self.month, day)]
+            stats[day] = {'count': index['count'],
+                          'osds': index['osds'],
+                          'pgs': index['pgs'],
+                          'max_length': {'pg': index['longest'][1],
+                                         'length': index['longest'][0]}}
 
         return sorted(stats.keys()), stats
 
+    def get_total_osds(self, month=None):
+        """
+        Return number of OSDs that completed an action started in month.
+        Defaults to self.month.
+        """
+        return len(self.osds_by_month.get(month or self.month, ()))
+
+    def get_total_pgs(self, month=None):
+        """
+        Return number of PGs that completed an action started in month.
+        Defaults to self.month.
+        """
+        return len(self.pgs_by_month.get(month or self.month, ()))
+
     @property
     def total_osds(self):
-        osds = []
-        for pg in collection.scrub_stats['pgs']:
-            for pg_osd in collection.scrub_stats['pgs'][pg]:
-                _pg = collection.scrub_stats['pgs'][pg]
-                for action in ['scrub', 'deep-scrub']:
-                    for event in _pg[pg_osd]['shelved_actions'][action]:
-                        if event['start'].month == args.month:
-                            if pg_osd not in osds:
-                                osds.append(pg_osd)
-        return len(osds)
+        return self.get_total_osds()
 
     @property
     def total_pgs(self):
-        pgs = []
-        for pg in collection.scrub_stats['pgs']:
-            for pg_osd in collection.scrub_stats['pgs'][pg]:
-                _pg = collection.scrub_stats['pgs'][pg]
-                for action in ['scrub', 'deep-scrub']:
-                    for event in _pg[pg_osd]['shelved_actions'][action]:
-                        if event['start'].month == args.month:
-                            if pg not in pgs:
-                                pgs.append(pg)
-
-        return len(pgs)
+        return self.get_total_pgs()
+
+    def day_most_scrubs(self, day, action):
+        """
+        Return (osd, count) of the osd that completed the most of action on
+        day of self.month.
+        """
+        counts = self.end_index.get((action, int(self.month), int(day)), {})
+        highest = []
+        for osd in self.pg_states:
+            stat = counts.get(osd, 0)
+            if not highest or highest[0] < stat:
+                highest = [stat, osd]
+
+        return highest[1], highest[0]
 
     def osd_most_pg_scrubs(self, day, action, osd=None):
-        highest = []
-        if not osd:
-            for osd in self.scrub_stats['osds']:
-                stat = self.osd_most_pg_scrubs(day, action, osd)
-                if not highest or highest[0] < stat:
-                    highest = [stat, osd]
+        if osd:
+            counts = self.end_index.get((action, int(self.month), int(day)),
+                                        {})
+            return counts.get(osd, 0)
 
-            return "%s(%s)" % (highest[1], highest[0])
-        else:
-            total = 0
-            pgs = self.scrub_stats['osds'][osd]['pgs']
-            for pg in pgs:
-                for s in pgs[pg]['shelved_actions'][action]:
-                    _day = s['end'].day
-                    _month = s['end'].month
-                    if (int(_month) == int(self.month) and
-                            int(_day) == int(day)):
-                        total += 1
-
-            return total
+        return "%s(%s)" % self.day_most_scrubs(day, action)
 
     def day_osd_actions(self, day, action):
         day_actions = {}
-        for pg in self.scrub_stats['pgs']:
-            for pg_osd in self.scrub_stats['pgs'][pg]:
-                _pg = self.scrub_stats['pgs'][pg][pg_osd]
-                for s in _pg['shelved_actions'][action]:
-                    _day = s['start'].day
-                    _month = s['start'].month
-                    if int(_month) != int(self.month) or day != _day:
-                        continue
-
-                    if pg not in day_actions:
-                        day_actions[pg_osd] = [s]
-                    else:
-                        day_actions[pg_osd].append(s)
+        for osd in self.completed:
+            for pg, _, start, end in self.completed[osd].get_actions(action):
+                if int(start.month) != int(self.month) or day != start.day:
+                    continue
+
+                s = {'start': start, 'end': end, 'length': end - start}
+                if osd not in day_actions:
+                    day_actions[osd] = [s]
+                else:
+                    day_actions[osd].append(s)
 
         return day_actions
 
     def day_longest_scrubaction(self, day, action):
-        days = {}
-        for pg in self.scrub_stats['pgs']:
-            for pg_osd in self.scrub_stats['pgs'][pg]:
-                _pg = self.scrub_stats['pgs'][pg][pg_osd]
-                for s in _pg['shelved_actions'][action]:
-                    _day = s['start'].day
-                    _month = s['start'].month
-                    if int(_month) != int(self.month) or day != _day:
-                        continue
-
-                    if _day not in days:
-                        days[_day] = {'length': s['length'], 'pg': _pg}
-                    elif days[_day]['length'] < s['length']:
-                        days[_day] = {'length': s['length'], 'pg': _pg}
-
-        _day = days.get(day, {'pg': 'n/a', 'length': 'n/a'})
-        return "pg=%s,length=%s" % (_day['pg']['pg_id'], _day['length'])
+        index = self.start_index.get((action, int(self.month), day))
+        if not index:
+            return "pg=n/a,length=n/a"
+
+        return "pg=%s,length=%s" % (index['longest'][1], index['longest'][0])
 
     def day_highest_osd_avg(self, day, action):
         day_highest = {}
-        day_actions = self.day_osd_actions(day, action)
-        if day_actions:
-            for osd in day_actions:
-                a = avg([s['end'] - s['start'] for s in day_actions[osd]])
+        index = self.start_index.get((action, int(self.month), day))
+        if index:
+            lengths = index['osd_lengths']
+            for osd in sorted(lengths):
+                a = lengths[osd][0] / lengths[osd][1]
                 if not day_highest:
                     day_highest = {'osd': osd, 'avg': a}
                 elif day_highest['avg'] < a:
@@ -233,82 +565,222 @@ class CephScrubStatsCollection(object):
 
         return day_highest
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--path', type=str, default=None, required=True)
-    parser.add_argument('--month', type=int, default=None, required=True)
-    parser.add_argument('--cache', action='store_true', default=False)
-    args = parser.parse_args()
 
-    filter = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9]"
-              "[0-9][0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:"
-              "[0-9]+:[0-9]+\.[0-9]*).+ : ([0-9]*\."
-              "[0-9]*[a-z]*.+)")
-    keywords = '" scrub | deep-scrub "'
-    collection = CephScrubStatsCollection(args.month,
-                                          get(args.path, keywords, filter,
-                                              args.cache))
-    collection.parse()
+def get_collection(args, events, states=()):
+    """
+    Return a collection of events added after merging each of states, as
+    saved by --save-state, in order.
+
+    @param args: parsed command line arguments.
+    @param events: events returned by common.get_events() for QUERY.
+    @param states: list of states returned by common.load_state().
+    """
+    collection = CephScrubStatsCollection(args.month, [])
+    for state in states:
+        collection.merge(CephScrubStatsCollection.from_state(
+            args.month, state))
+
+    collection.update(events)
+    return collection
+
+
+def get_results(args, collection):
+    """
+    Return list of common.ResultTable of the scrub stats of a parsed
+    collection for args.month.
+    """
+    summary = ResultTable('summary', ['month', 'osds', 'pgs', 'scrubs',
+                                      'deep_scrubs'])
+    summary.append(args.month, collection.total_osds, collection.total_pgs,
+                   collection.action_counts['scrub'],
+                   collection.action_counts['deep-scrub'])
+
+    days = ResultTable('days', ['action', 'day', 'count', 'osds', 'pgs',
+                                'most_scrubs_osd', 'most_scrubs',
+                                'longest_pg', 'longest'])
+    for action in ACTIONS:
+        _days, stats = collection.get_stats(action)
+        for day in _days:
+            osd, count = collection.day_most_scrubs(day, action)
+            days.append(action, day, stats[day]['count'],
+                        len(set(stats[day]['osds'])),
+                        len(set(stats[day]['pgs'])), osd, count,
+                        stats[day]['max_length']['pg'],
+                        stats[day]['max_length']['length'])
+
+    repeats = ResultTable('repeats', ['osd', 'pg', 'count'])
+    # Ordered by host and osd, as the logs are read, so that the order does
+    # not depend on that of any merged states.
+    for r in sorted(collection.repeats,
+                    key=lambda r: (collection.hosts[r['osd']], r['osd'])):
+        repeats.append(r['osd'], r['pg'], r['count'])
+
+    highest_avg = ResultTable('day_highest_avg', ['action', 'day', 'osd',
+                                                  'avg'])
+    for action in ACTIONS:
+        for day in collection.get_days(action):
+            h = collection.day_highest_osd_avg(day, action)
+            if h:
+                highest_avg.append(action, day, h['osd'], h['avg'])
+
+    tables = [summary, days, repeats, highest_avg]
+    if args.histogram:
+        histogram = ResultTable('histogram', ['action', 'time', 'count',
+                                              'shortest', 'longest',
+                                              'total'])
+        for action in ACTIONS:
+            for t, s in collection.get_histogram(args.histogram, action):
+                histogram.append(action, t, s[3], s[0], s[1], s[2])
+
+        tables.append(histogram)
+
+    return tables
+
+
+def get_columns(collection):
+    """
+    Return the completed actions of a parsed collection as columns for
+    common.export_columns().
+    """
+    osds = sorted(collection.completed)
+    osd_codes = array('l')
+    pgs = []
+    actions = array('b')
+    starts = array('d')
+    ends = array('d')
+    for code, osd in enumerate(osds):
+        columns = collection.completed[osd]
+        osd_codes.extend([code] * len(columns))
+        pgs += columns.pgs
+        actions.extend(columns.actions)
+        starts.extend(columns.starts)
+        ends.extend(columns.ends)
+
+    pg_codes, pgs = encode_strings(pgs)
+    return [('osd', osd_codes, osds), ('pg', pg_codes, pgs),
+            ('action', actions, ACTIONS), ('start_us', starts, None),
+            ('end_us', ends, None)]
+
+
+def print_report(args, collection, tables=None):
+    """
+    Print the scrub stats of a parsed collection.
+
+    @param tables: results of collection returned by get_results().
+    """
+    if tables is None:
+        tables = get_results(args, collection)
+
+    tables = dict([(t.name, t) for t in tables])
     print "Scrubbing stats for month %s:\n" % (args.month)
 
-    print "%s OSDs scrubbed" % collection.total_osds
-    print "%s PGs scrubbed" % collection.total_pgs
-
-    scrubs = 0
-    for pg in collection.scrub_stats['pgs']:
-        for pg_osd in collection.scrub_stats['pgs'][pg]:
-            _pg = collection.scrub_stats['pgs'][pg]
-            scrubs += len(_pg[pg_osd]['shelved_actions']['scrub'])
+    for month, osds, pgs, scrubs, deep_scrubs in tables['summary']:
+        print "%s OSDs scrubbed" % osds
+        print "%s PGs scrubbed" % pgs
 
-    print "%s scrubs" % scrubs
+        print "%s scrubs" % scrubs
+        print "%s deep-scrubs" % deep_scrubs
 
-    deepscrubs = 0
-    for pg in collection.scrub_stats['pgs']:
-        for pg_osd in collection.scrub_stats['pgs'][pg]:
-            _pg = collection.scrub_stats['pgs'][pg]
-            deepscrubs += len(_pg[pg_osd]['shelved_actions']['deep-scrub'])
-
-    print "%s deep-scrubs" % deepscrubs
-
-    days, stats = collection.get_stats('scrub')
-    data = ["\n    %s - %s scrubs (osds=%s, pgs=%s, mostscrubs=%s, "
-            "longest=%s))" %
-            (day, stats[day]['count'], len(set(stats[day]['osds'])),
-             len(set(stats[day]['pgs'])),
-             collection.osd_most_pg_scrubs(day, 'scrub'),
-             collection.day_longest_scrubaction(day, 'scrub')) for day in days]
+    days = [r for r in tables['days'] if r[0] == 'scrub']
+    data = ["\n    %s - %s scrubs (osds=%s, pgs=%s, mostscrubs=%s(%s), "
+            "longest=pg=%s,length=%s))" % r[1:] for r in days]
     data = data or ["\n    none"]
     print "\n  No. scrubs by day: %s" % ' '.join(data)
 
-    days, stats = collection.get_stats('deep-scrub')
-    data = ["\n    %s - %s deep-scrubs (osds=%s, pgs=%s, mostscrubs=%s, "
-            "longest=%s)" %
-            (day, stats[day]['count'], len(set(stats[day]['osds'])),
-             len(set(stats[day]['pgs'])),
-             collection.osd_most_pg_scrubs(day, 'deep-scrub'),
-             collection.day_longest_scrubaction(day, 'deep-scrub'))
-            for day in days]
+    days = [r for r in tables['days'] if r[0] == 'deep-scrub']
+    data = ["\n    %s - %s deep-scrubs (osds=%s, pgs=%s, mostscrubs=%s(%s), "
+            "longest=pg=%s,length=%s)" % r[1:] for r in days]
     data = data or ["\n    none"]
     print "\n  No. deep-scrubs by day: %s" % ' '.join(data)
 
     print "\n  Repeated deep-scrubs:"
-    if collection.repeats:
-        for r in collection.repeats:
-            print "    %s repeated %s times on osd %s" % (r['pg'], r['count'],
-                                                          r['osd'])
+    if tables['repeats']:
+        for osd, pg, count in tables['repeats']:
+            print "    %s repeated %s times on osd %s" % (pg, count, osd)
     else:
         print "    No repeated deep-scrubs detected"
 
-    print "\n  Highest avg scrub time for OSD by day:"
-    for day in xrange(1, 31):
-        h = collection.day_highest_osd_avg(day, 'scrub')
-        if h:
-            print "    %s - %s avg=%s" % (day, h['osd'], h['avg'])
+    for action in ACTIONS:
+        print "\n  Highest avg %s time for OSD by day:" % action
+        for r in tables['day_highest_avg']:
+            if r[0] == action:
+                print "    %s - %s avg=%s" % r[1:]
+
+    if args.histogram:
+        for action in ACTIONS:
+            print "\n  No. %ss completed per %s:" % \
+                (action, format_duration(args.histogram))
+            histogram = [r for r in tables['histogram'] if r[0] == action]
+            for r in histogram:
+                print "    %s - %s (longest=%.3fs)" % (r[1], r[2], r[4])
 
-    print "\n  Highest avg deep-scrub time for OSD by day:"
-    for day in xrange(1, 31):
-        h = collection.day_highest_osd_avg(day, 'deep-scrub')
-        if h:
-            print "    %s - %s avg=%s" % (day, h['osd'], h['avg'])
+            if not histogram:
+                print "    none"
 
     print ""
+
+
+def output(args, collection):
+    """
+    Print the stats of a parsed collection in args.format and export them
+    to args.export if set.
+    """
+    tables = get_results(args, collection)
+    if args.export:
+        export_results(args.export, tables, get_columns(collection))
+
+    if args.format == 'text':
+        print_report(args, collection, tables)
+    else:
+        write_results(sys.stdout, tables, args.format)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, default=None)
+    parser.add_argument('--month', type=int, default=None, required=True)
+    parser.add_argument('--cache', action='store_true', default=False)
+    parser.add_argument('--cache-events', action='store_true', default=False,
+                        help="Cache decoded events rather than log lines.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of logfiles to scan in parallel.")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="Ignore events before this time e.g. "
+                             "'2016-05-03 10:00'.")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="Ignore events from this time onwards.")
+    parser.add_argument('--histogram', type=parse_duration, default=None,
+                        help="Also print a histogram with buckets of this "
+                             "width e.g. 1m, 5m or 1h.")
+    parser.add_argument('--merge-state', action='append', default=[],
+                        help="Merge the state saved to this file by "
+                             "--save-state, which may be given more than "
+                             "once. States are merged in the order given "
+                             "followed by whatever is parsed from --path.")
+    parser.add_argument('--save-state', type=str, default=None,
+                        help="Save the state of the (merged) stats to this "
+                             "file.")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text',
+                        help="Format of the stats printed.")
+    parser.add_argument('--export', type=str, default=None,
+                        help="Also write each table of stats to a CSV file "
+                             "and the completed actions to columnar files "
+                             "in this directory.")
+    args = parser.parse_args()
+    if not args.path and not args.merge_state:
+        parser.error("--path or --merge-state is required")
+
+    collection = get_collection(args, [],
+                                [load_state(path, STATE_KIND)
+                                 for path in args.merge_state])
+
+    if args.path:
+        collection.update(get_events(args.path, QUERY, args.cache, args.jobs,
+                                     args.cache_events,
+                                     TimeWindow(args.since, args.until)))
+
+    if args.save_state:
+        save_state(args.save_state, STATE_KIND, collection.get_state())
+
+    output(args, collection)
@@ -22,130 +22,533 @@
 
 import argparse
 import datetime
-import re
-
-from common import avg, uniq, get
+import itertools
+import sys
+
+from array import array
+from collections import namedtuple
+
+from common import (
+    add_stats,
+    encode_strings,
+    export_results,
+    find_values,
+    follow_logs,
+    format_duration,
+    from_epoch_us,
+    get_events,
+    get_osd_id,
+    group_means,
+    group_stats,
+    load_state,
+    parse_duration,
+    parse_time,
+    parse_timestamp,
+    save_state,
+    time_buckets,
+    time_histogram,
+    time_keys,
+    to_epoch_us,
+    uniq,
+    write_results,
+    LogQuery,
+    QuantileSketch,
+    ResultTable,
+    TimeWindow,
+    TopK,
+)
+
+KEYWORDS = 'slow requests'
+FILTER = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9]"
+          "[0-9][0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:"
+          "[0-9]+:[0-9]+\.[0-9]*)\s.+blocked for > "
+          "([0-9\.]*) secs")
+FIELDS = [('osd', 'osd'), ('timestamp', 'timestamp'),
+          ('blocked', 'float')]
+SlowRequestEvent = namedtuple('SlowRequestEvent',
+                              ['host'] + [f[0] for f in FIELDS])
+
+
+def decode(groups):
+    return (intern(groups[0]), parse_timestamp(groups[1]), float(groups[2]))
+
+
+QUERY = LogQuery(KEYWORDS, FILTER, FIELDS, decode, SlowRequestEvent)
+
+# Kind of state saved by --save-state.
+STATE_KIND = 'slow-requests'
+
+# Default number of OSDs listed in each of the top mins/maxs/avgs.
+TOP = 10
+# Percentiles of seconds blocked reported from the quantile sketches.
+PERCENTILES = [50, 90, 99, 99.9]
+# Once track_totals() is called, the seconds blocked at each distinct
+# timestamp are only kept for timestamps this many microseconds before the
+# newest so that following logs does not keep an entry for every event.
+TIMESTAMP_HORIZON = 10 * 60 * 1000000
+
+
+def get_percentiles(sketch):
+    return [sketch.quantile(p / 100.0) for p in PERCENTILES]
 
 
 class CephSlowRequestStatsCollection(object):
-    def __init__(self, events):
+    def __init__(self, events, top=TOP):
+        """
+        @param events: iterable of SlowRequestEvent.
+        @param top: number of OSDs retained in each of mins, maxs and avgs.
+        """
         self.events = events
-        self.MAX_TOPS = 10
-        self.aggrs_by_osd = {}
-        self.aggrs_by_date = {}
-        self.aggrs_by_host = {}
+        self.top = top
         self.epoc = None
         self.osd_stats = {}
-        self.mins = []
-        self.maxs = []
-        self.avgs = []
-        self.date_avgs = []
-        self.date_maxs = []
+        # Events are stored column-wise as the index of the osd in self.osds,
+        # microseconds since the epoch and seconds blocked. Aggregates are
+        # grouped reductions over these (see common.group_stats).
+        self.osds = []
+        self.osd_index = {}
+        self.osd_ids = array('l')
+        self.times = array('l')
+        self.blocked = array('d')
+        # {day: set(osd)} and {(day, hour): set(osd)} of the osds with slow
+        # requests in each window, where day is the day of the month.
+        self.day_osds = {}
+        self.hour_osds = {}
+        # Mergeable distributions of seconds blocked by osd, host and day.
+        self.osd_sketches = {}
+        self.host_sketches = {}
+        self.day_sketches = {}
+        self.top_mins = TopK(top, largest=False)
+        self.top_maxs = TopK(top)
+        self.top_avgs = TopK(top)
+        # Aggregates kept up to date as events are added once track_totals()
+        # is called rather than computed from every event when fetched.
+        self.running = False
+        # {osd: [min, max, sum, count]} of seconds blocked and likewise by
+        # day of the month.
+        self.osd_totals = {}
+        self.day_totals = {}
+        # {osd: [datetime, ...]} of when each osd had its min and max.
+        self.min_times = {}
+        self.max_times = {}
+        # {timestamp_us: [sum, count]} of seconds blocked at each recent
+        # distinct timestamp (see TIMESTAMP_HORIZON) and {unit: {key: [sum,
+        # count]}} of the means at each distinct timestamp by 'month' and
+        # 'day'.
+        self.timestamp_totals = {}
+        self.timestamp_avgs = {'month': {}, 'day': {}}
+        self.newest = None
+        # {bucket: [min, max, sum, count]} for buckets of histogram width.
+        self.histogram = None
+        self.buckets = {}
+
+    def _add_osd(self, osd, host):
+        index = self.osd_index[osd] = len(self.osds)
+        self.osds.append(osd)
+        self.osd_stats[osd] = {'host': host}
+        self.osd_sketches[osd] = QuantileSketch()
+        if host not in self.host_sketches:
+            self.host_sketches[host] = QuantileSketch()
+
+        return index
 
     def parse(self):
-        for event in self.events:
-            osd = event['data'].group(1)
-            timestamp = event['data'].group(2)
-            info = float(event['data'].group(3))
-
-            t = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-            data = (t, info)
-            if osd in self.osd_stats:
-                self.osd_stats[osd]['slow_requests'].append(data)
-            else:
-                self.osd_stats[osd] = {'host': event['host'],
-                                       'slow_requests': [data]}
-
-    def aggregate(self, osd):
-        host = self.osd_stats[osd]['host']
-        vals = self.osd_stats[osd]['slow_requests']
-        for d, v in vals:
-            if d in self.aggrs_by_date:
-                self.aggrs_by_date[d].append((osd, v))
-            else:
-                self.aggrs_by_date[d] = [(osd, v)]
-
-            if host not in self.aggrs_by_host:
-                self.aggrs_by_host[host] = []
-
-            self.aggrs_by_host[host].append(v)
-
-        if osd not in self.aggrs_by_osd:
-            self.aggrs_by_osd[osd] = vals
+        self.update(self.events)
+
+    def update(self, events):
+        """
+        Add events to the collection, which may be done repeatedly e.g. as
+        they are found by common.follow_logs().
+
+        @param events: iterable of SlowRequestEvent.
+        """
+        for event in events:
+            osd = event.osd
+            index = self.osd_index.get(osd)
+            if index is None:
+                index = self._add_osd(osd, event.host)
+
+            t = event.timestamp
+            blocked = event.blocked
+            self.osd_sketches[osd].add(blocked)
+            self.host_sketches[self.osd_stats[osd]['host']].add(blocked)
+            sketch = self.day_sketches.get(t.day)
+            if sketch is None:
+                sketch = self.day_sketches[t.day] = QuantileSketch()
+
+            sketch.add(blocked)
+            osds = self.day_osds.get(t.day)
+            if osds is None:
+                osds = self.day_osds[t.day] = set()
+
+            osds.add(osd)
+            osds = self.hour_osds.get((t.day, t.hour))
+            if osds is None:
+                osds = self.hour_osds[(t.day, t.hour)] = set()
+
+            osds.add(osd)
+            t_us = to_epoch_us(t)
+            self.osd_ids.append(index)
+            self.times.append(t_us)
+            self.blocked.append(blocked)
+            if self.running:
+                self._add_totals(osd, t, t_us, blocked)
+
+        if self.running:
+            self._evict_timestamps()
+
+    def _add_totals(self, osd, t, t_us, blocked):
+        s = self.osd_totals.get(osd)
+        if s is None:
+            self.osd_totals[osd] = [blocked, blocked, blocked, 1]
+            self.min_times[osd] = [t]
+            self.max_times[osd] = [t]
         else:
-            self.aggrs_by_osd[osd] += vals
-
-    def keep_top_avgs(self, osd, val):
-        if not self.avgs:
-            self.avgs.append((osd, val))
+            if blocked < s[0]:
+                s[0] = blocked
+                self.min_times[osd] = [t]
+            elif blocked == s[0]:
+                self.min_times[osd].append(t)
+
+            if blocked > s[1]:
+                s[1] = blocked
+                self.max_times[osd] = [t]
+            elif blocked == s[1]:
+                self.max_times[osd].append(t)
+
+            s[2] += blocked
+            s[3] += 1
+
+        add_stats(self.day_totals, t.day, blocked)
+        if self.histogram:
+            add_stats(self.buckets, t_us // self.histogram * self.histogram,
+                      blocked)
+
+        if self.newest is None or t_us > self.newest:
+            self.newest = t_us
+
+        s = self.timestamp_totals.get(t_us)
+        if s is None:
+            self.timestamp_totals[t_us] = [blocked, 1]
+            for unit, key in [('month', t.month), ('day', t.day)]:
+                avgs = self.timestamp_avgs[unit]
+                if key in avgs:
+                    avgs[key][0] += blocked
+                    avgs[key][1] += 1
+                else:
+                    avgs[key] = [blocked, 1]
+        else:
+            # The mean at this timestamp changes.
+            old = s[0] / s[1]
+            s[0] += blocked
+            s[1] += 1
+            for unit, key in [('month', t.month), ('day', t.day)]:
+                self.timestamp_avgs[unit][key][0] += s[0] / s[1] - old
+
+    def _evict_timestamps(self):
+        """
+        Stop keeping the seconds blocked at timestamps older than
+        TIMESTAMP_HORIZON before the newest. Any later event at one of them
+        is averaged as if at another distinct timestamp.
+        """
+        if self.newest is None:
             return
 
-        if (val > max([e[1] for e in self.avgs]) or
-                val > float(self.avgs[0][1])):
-            self.avgs.append((osd, val))
+        cutoff = self.newest - TIMESTAMP_HORIZON
+        for t_us in [t_us for t_us in self.timestamp_totals
+                     if t_us < cutoff]:
+            del self.timestamp_totals[t_us]
+
+    def track_totals(self, histogram=None):
+        """
+        Keep the stats returned by get_stats(), get_times(),
+        get_timestamp_avg_stats() and get_histogram() for get_results() up to
+        date as events are added from now on, e.g. when following logs, so
+        that fetching them does not need a pass over every event.
+
+        @param histogram: width in microseconds of the histogram buckets.
+        """
+        self.running = False
+        osd_stats = self.get_stats('osd')
+        times = self.get_times([(osd, s[i]) for osd, s in
+                                osd_stats.iteritems() for i in (0, 1)])
+        self.osd_totals = {}
+        for osd, s in osd_stats.iteritems():
+            self.osd_totals[osd] = list(s)
+            self.min_times[osd] = times[(osd, s[0])]
+            self.max_times[osd] = times[(osd, s[1])]
+
+        self.day_totals = dict([(day, list(s)) for day, s in
+                                self.get_stats('day').iteritems()])
+        for unit in self.timestamp_avgs:
+            self.timestamp_avgs[unit] = dict(
+                [(key, [s[2], s[3]]) for key, s in
+                 self.get_timestamp_avg_stats(unit).iteritems()])
+
+        self.timestamp_totals = {}
+        self.newest = max(self.times) if self.times else None
+        if self.newest is not None:
+            cutoff = self.newest - TIMESTAMP_HORIZON
+            for t_us, blocked in itertools.izip(self.times, self.blocked):
+                if t_us < cutoff:
+                    continue
+
+                s = self.timestamp_totals.get(t_us)
+                if s is None:
+                    self.timestamp_totals[t_us] = [blocked, 1]
+                else:
+                    s[0] += blocked
+                    s[1] += 1
+
+        self.histogram = histogram
+        self.buckets = {}
+        if histogram:
+            self.buckets = dict([(k, list(s)) for k, s in
+                                 group_stats(time_buckets(self.times,
+                                                          histogram),
+                                             self.blocked).iteritems()])
+
+        self.running = True
+
+    def merge(self, other):
+        """
+        Add the slow requests of another collection to this one e.g. one
+        restored from the state saved after parsing another sosreport.
+        """
+        mapping = []
+        for osd in other.osds:
+            index = self.osd_index.get(osd)
+            if index is None:
+                index = self._add_osd(osd, other.osd_stats[osd]['host'])
+
+            mapping.append(index)
+
+        self.osd_ids.extend(array('l', [mapping[i] for i in other.osd_ids]))
+        self.times.extend(other.times)
+        self.blocked.extend(other.blocked)
+        for windows, _windows in [(self.day_osds, other.day_osds),
+                                  (self.hour_osds, other.hour_osds)]:
+            for key, osds in _windows.iteritems():
+                if key not in windows:
+                    windows[key] = set()
+
+                windows[key].update(osds)
+
+        for sketches, _sketches in [(self.osd_sketches, other.osd_sketches),
+                                    (self.host_sketches, other.host_sketches),
+                                    (self.day_sketches, other.day_sketches)]:
+            for key, sketch in _sketches.iteritems():
+                if key not in sketches:
+                    sketches[key] = QuantileSketch()
+
+                sketches[key].merge(sketch)
+
+        if self.running:
+            self.track_totals(self.histogram)
+
+    def get_state(self):
+        """
+        Return the parsed state of the collection for common.save_state().
+        See from_state().
+        """
+        return {'osds': self.osds,
+                'hosts': [self.osd_stats[osd]['host'] for osd in self.osds],
+                'osd_ids': self.osd_ids.tostring(),
+                'times': self.times.tostring(),
+                'blocked': self.blocked.tostring(),
+                'day_osds': dict([(k, list(v)) for k, v in
+                                  self.day_osds.iteritems()]),
+                'hour_osds': dict([(k, list(v)) for k, v in
+                                   self.hour_osds.iteritems()]),
+                'osd_sketches': dict([(k, v.get_state()) for k, v in
+                                      self.osd_sketches.iteritems()]),
+                'host_sketches': dict([(k, v.get_state()) for k, v in
+                                       self.host_sketches.iteritems()]),
+                'day_sketches': dict([(k, v.get_state()) for k, v in
+                                      self.day_sketches.iteritems()])}
+
+    @classmethod
+    def from_state(cls, state, top=TOP):
+        """
+        Return a collection restored from the output of get_state().
+        """
+        collection = cls([], top)
+        for osd, host in zip(state['osds'], state['hosts']):
+            collection._add_osd(intern(osd), intern(host))
+
+        collection.osd_ids.fromstring(state['osd_ids'])
+        collection.times.fromstring(state['times'])
+        collection.blocked.fromstring(state['blocked'])
+        for windows, _windows in [(collection.day_osds, state['day_osds']),
+                                  (collection.hour_osds,
+                                   state['hour_osds'])]:
+            for key, osds in _windows.iteritems():
+                windows[key] = set([intern(osd) for osd in osds])
+
+        for sketches, _sketches in [(collection.osd_sketches,
+                                     state['osd_sketches']),
+                                    (collection.host_sketches,
+                                     state['host_sketches']),
+                                    (collection.day_sketches,
+                                     state['day_sketches'])]:
+            for key, sketch in _sketches.iteritems():
+                sketches[key] = QuantileSketch.from_state(sketch)
+
+        return collection
+
+    def get_stats(self, by):
+        """
+        Return {key: (min, max, sum, count)} of seconds blocked.
+
+        @param by: one of 'osd', 'host', 'timestamp', 'month', 'day' or
+                   'hour' with results keyed by osd name, hostname, datetime
+                   or integer respectively.
+        """
+        if self.running and by in ['osd', 'day']:
+            totals = self.osd_totals if by == 'osd' else self.day_totals
+            return dict([(k, tuple(s)) for k, s in totals.iteritems()])
+
+        if by == 'osd':
+            stats = group_stats(self.osd_ids, self.blocked)
+            return dict([(self.osds[k], v) for k, v in stats.iteritems()])
+        elif by == 'host':
+            stats = {}
+            for osd, s in self.get_stats('osd').iteritems():
+                host = self.osd_stats[osd]['host']
+                if host not in stats:
+                    stats[host] = s
+                else:
+                    h = stats[host]
+                    stats[host] = (min(h[0], s[0]), max(h[1], s[1]),
+                                   h[2] + s[2], h[3] + s[3])
+
+            return stats
+        elif by == 'timestamp':
+            stats = group_stats(self.times, self.blocked)
+            return dict([(from_epoch_us(k), v) for k, v in stats.iteritems()])
+
+        return group_stats(time_keys(self.times, by), self.blocked)
+
+    def get_times(self, wanted):
+        """
+        Return {(osd, val): [datetime, ...]} giving when each osd had a slow
+        request blocked for val seconds. Once track_totals() is called only
+        the times of the min and max of each osd are known.
+
+        @param wanted: iterable of (osd, val) pairs.
+        """
+        if self.running:
+            return dict([((osd, val), self.min_times[osd]
+                          if val == self.osd_totals[osd][0]
+                          else self.max_times[osd])
+                         for osd, val in wanted])
+
+        wanted = [(self.osd_index[osd], val) for osd, val in wanted]
+        found = find_values(self.osd_ids, self.blocked, wanted)
+        return dict([((self.osds[k], val),
+                      [from_epoch_us(self.times[i]) for i in indexes])
+                     for (k, val), indexes in found.iteritems()])
+
+    def get_timestamp_avg_stats(self, by):
+        """
+        Return {key: (min, max, sum, count)} of the average seconds blocked
+        at each distinct timestamp, grouped by 'month', 'day' or 'hour'.
+        Once track_totals() is called min and max are None for 'month' and
+        'day'.
+        """
+        if self.running and by in self.timestamp_avgs:
+            return dict([(k, (None, None, s[0], s[1])) for k, s in
+                         self.timestamp_avgs[by].iteritems()])
+
+        times, avgs = group_means(self.times, self.blocked)
+        return group_stats(time_keys(times, by), avgs)
+
+    def get_histogram(self, width):
+        """
+        Return a sorted list of (datetime, (min, max, sum, count)) of seconds
+        blocked for each bucket of width microseconds.
+        """
+        if self.running and width == self.histogram:
+            return [(from_epoch_us(k), tuple(self.buckets[k]))
+                    for k in sorted(self.buckets)]
+
+        return time_histogram(self.times, width, self.blocked)
+
+    def update_top(self):
+        """
+        (Re)compute the min, max and avg of each osd in osd_stats along with
+        the top mins, maxs and avgs.
+        """
+        self.top_mins = TopK(self.top, largest=False)
+        self.top_maxs = TopK(self.top)
+        self.top_avgs = TopK(self.top)
+        osd_stats = self.get_stats('osd')
+        for osd in sorted(osd_stats, key=get_osd_id):
+            m, x, total, count = osd_stats[osd]
+            self.keep_top_mins(osd, m)
+            self.osd_stats[osd]['min'] = m
+            self.keep_top_maxs(osd, x)
+            self.osd_stats[osd]['max'] = x
+            a = total / count
+            self.keep_top_avgs(osd, a)
+            self.osd_stats[osd]['avg'] = a
 
-        self.avgs = sorted(self.avgs, key=lambda e: float(e[1]))
-        if len(self.avgs) > self.MAX_TOPS:
-            self.avgs.pop(0)
+    def keep_top_avgs(self, osd, val):
+        self.top_avgs.push(osd, val)
 
     def keep_top_mins(self, osd, val):
-        if not self.mins:
-            self.mins.append((osd, val))
-            return
-
-        if (val < min([e[1] for e in self.mins]) or
-                val < float(self.maxs[-1][1])):
-            self.mins.append((osd, val))
-
-        self.mins = sorted(self.mins, key=lambda e: float(e[1]))
-        if len(self.mins) > self.MAX_TOPS:
-            self.mins.pop(self.MAX_TOPS)
+        self.top_mins.push(osd, val)
 
     def keep_top_maxs(self, osd, val):
-        if not self.maxs:
-            self.maxs.append((osd, val))
-            return
-
-        if (val > max([e[1] for e in self.maxs]) or
-                val > float(self.maxs[0][1])):
-            self.maxs.append((osd, val))
-
-        self.maxs = sorted(self.maxs, key=lambda e: float(e[1]))
-        if len(self.maxs) > self.MAX_TOPS:
-            self.maxs.pop(0)
-
-    def date_avg(self):
-        for d in self.aggrs_by_date:
-            a = avg([a[1] for a in self.aggrs_by_date[d]])
-            self.date_avgs.append((d, a))
-
-    def date_max(self):
-        for d in self.aggrs_by_date:
-            a = max([a[1] for a in self.aggrs_by_date[d]])
-            self.date_maxs.append((d, a))
+        self.top_maxs.push(osd, val)
+
+    @property
+    def avgs(self):
+        return self.top_avgs.items()
+
+    @property
+    def mins(self):
+        return self.top_mins.items()
+
+    @property
+    def maxs(self):
+        return self.top_maxs.items()
+
+    def _highest_osd(self, osds, key):
+        """
+        Return the osd in osds with the highest value of key in osd_stats or
+        None if osds is empty. Ties go to the lowest numbered osd.
+        """
+        highest = None
+        for osd in osds:
+            if highest is None:
+                highest = osd
+                continue
+
+            val = self.osd_stats[osd][key]
+            _val = self.osd_stats[highest][key]
+            if (val > _val or (val == _val and
+                               get_osd_id(osd) < get_osd_id(highest))):
+                highest = osd
+
+        return highest
 
     def day_highest_osd(self, d, key):
-        equals = []
-        _osd = None
-        for osd in self.osd_stats:
-            for e in self.osd_stats[osd]['slow_requests']:
-                if str(e[0].day) == str(d):
-                    if (not _osd or
-                            self.osd_stats[_osd][key] <
-                            self.osd_stats[osd][key]):
-                        _osd = osd
-                        equals = []
-                    elif self.osd_stats[_osd][key] == self.osd_stats[osd][key]:
-                        equals.append(osd)
-
-        return list(set([_osd] + equals))[0]
+        """
+        Return the osd with the highest value of key ('min', 'max' or 'avg')
+        among those with slow requests on day d of the month.
+        """
+        return self._highest_osd(self.day_osds.get(int(d), ()), key)
+
+    def hour_highest_osd(self, d, hour, key):
+        """
+        As day_highest_osd() for the given hour of day d.
+        """
+        return self._highest_osd(self.hour_osds.get((int(d), int(hour)), ()),
+                                 key)
 
     def total_slow_requests(self):
-        total = 0
-        for osd in self.osd_stats:
-            total += len(self.osd_stats[osd]['slow_requests'])
-
-        return total
+        return len(self.blocked)
 
     def get_osds_by_host(self):
         hosts = {}
@@ -162,132 +565,279 @@ class CephSlowRequestStatsCollection(object):
         return hosts
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--path', type=str, default=None, required=True)
-    parser.add_argument('--cache', action='store_true', default=False)
-    args = parser.parse_args()
-
-    filter = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9]"
-              "[0-9][0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:"
-              "[0-9]+:[0-9]+\.[0-9]*)\s.+blocked for > "
-              "([0-9\.]*) secs")
-    keywords = '"slow requests"'
-
-    collection = CephSlowRequestStatsCollection(get(args.path, keywords,
-                                                    filter, args.cache))
-    collection.parse()
-
-    osds = list(collection.osd_stats.keys())
-    osds = sorted(osds, key=lambda s: float(s.partition('.')[2]))
-    print "Slow request stats for %s OSDs" % len(osds)
-    print "Total slow requests: %s" % collection.total_slow_requests()
-
-    for osd in osds:
-        delays = [e[1] for e in collection.osd_stats[osd]['slow_requests']]
-        m = min(delays)
-        collection.keep_top_mins(osd, m)
-        collection.osd_stats[osd]['min'] = m
-        m = max(delays)
-        collection.keep_top_maxs(osd, m)
-        collection.osd_stats[osd]['max'] = m
-        a = avg(delays)
-        collection.keep_top_avgs(osd, a)
-        collection.osd_stats[osd]['avg'] = a
-        collection.aggregate(osd)
-
-    collection.date_avg()
-    collection.date_max()
-
-    _collection = {}
-    for a in collection.date_avgs:
-        d = str(a[0].month)
-        if d not in _collection:
-            _collection[d] = [a[1]]
-        else:
-            _collection[d].append(a[1])
-
-    month_avgs = sorted([(d, avg(v)) for d, v in _collection.iteritems()],
-                        key=lambda e: int(e[0]))
+def get_collection(args, events, states=()):
+    """
+    Return a collection of events added after merging each of states, as
+    saved by --save-state, in order.
 
-    _collection = {}
-    for a in collection.date_avgs:
-        d = str(a[0].day)
-        if d not in _collection:
-            _collection[d] = [a[1]]
-        else:
-            _collection[d].append(a[1])
+    @param args: parsed command line arguments.
+    @param events: events returned by common.get_events() for QUERY.
+    @param states: list of states returned by common.load_state().
+    """
+    collection = CephSlowRequestStatsCollection([], args.top)
+    for state in states:
+        collection.merge(CephSlowRequestStatsCollection.from_state(
+            state, args.top))
 
-    day_avgs = sorted([(d, avg(v)) for d, v in _collection.iteritems()],
-                      key=lambda e: int(e[0]))
+    collection.update(events)
+    return collection
 
-    _collection = {}
-    for a in collection.date_maxs:
-        d = str(a[0].day)
-        if d not in _collection:
-            _collection[d] = [a[1]]
-        else:
-            _collection[d].append(a[1])
 
-    day_maxs = sorted([(d, max(v)) for d, v in _collection.iteritems()],
-                      key=lambda e: int(e[0]))
+def get_results(args, collection):
+    """
+    Return list of common.ResultTable of the slow request stats of a parsed
+    collection.
+    """
+    collection.update_top()
+    summary = ResultTable('summary', ['osds', 'slow_requests'])
+    summary.append(len(collection.osd_stats),
+                   collection.total_slow_requests())
 
+    osds = ResultTable('osds', ['host', 'osd'])
     hosts = collection.get_osds_by_host()
     for host in hosts:
+        for osd in sorted(hosts[host], key=get_osd_id):
+            osds.append(host, osd)
+
+    times = collection.get_times(collection.mins + collection.maxs)
+    top_min_wait = ResultTable('top_min_wait', ['osd', 'wait', 'times'])
+    for e in collection.mins:
+        top_min_wait.append(e[0], e[1], uniq([str(t) for t in times[e]]))
+
+    top_max_wait = ResultTable('top_max_wait', ['osd', 'wait', 'times'])
+    for e in sorted(collection.maxs, key=lambda e: e[1], reverse=True):
+        top_max_wait.append(e[0], e[1], uniq([str(t) for t in times[e]]))
+
+    host_total_wait = ResultTable('host_total_wait', ['host', 'total_wait'])
+    host_stats = collection.get_stats('host')
+    for host in sorted(host_stats, key=lambda h: int(host_stats[h][2]),
+                       reverse=True):
+        host_total_wait.append(host, host_stats[host][2])
+
+    top_avg_wait = ResultTable('top_avg_wait', ['osd', 'avg_wait'])
+    for e in sorted(collection.avgs, key=lambda e: e[1], reverse=True):
+        top_avg_wait.append(e[0], e[1])
+
+    month_avg_wait = ResultTable('month_avg_wait', ['month', 'avg_wait'])
+    stats = collection.get_timestamp_avg_stats('month')
+    for month in sorted(stats):
+        month_avg_wait.append(month, stats[month][2] / stats[month][3])
+
+    day_avg_wait = ResultTable('day_avg_wait', ['day', 'avg_wait',
+                                                'highest_avg_osd'])
+    stats = collection.get_timestamp_avg_stats('day')
+    for day in sorted(stats):
+        day_avg_wait.append(day, stats[day][2] / stats[day][3],
+                            collection.day_highest_osd(day, 'avg'))
+
+    day_max_wait = ResultTable('day_max_wait', ['day', 'max_wait',
+                                                'highest_max_osd'])
+    stats = collection.get_stats('day')
+    for day in sorted(stats):
+        day_max_wait.append(day, stats[day][1],
+                            collection.day_highest_osd(day, 'max'))
+
+    percentiles = ['p%s' % p for p in PERCENTILES]
+    host_percentiles = ResultTable('host_wait_percentiles',
+                                   ['host'] + percentiles)
+    sketches = collection.host_sketches
+    for host in sorted(sketches):
+        host_percentiles.append(host, *get_percentiles(sketches[host]))
+
+    day_percentiles = ResultTable('day_wait_percentiles',
+                                  ['day'] + percentiles)
+    sketches = collection.day_sketches
+    for day in sorted(sketches):
+        day_percentiles.append(day, *get_percentiles(sketches[day]))
+
+    tables = [summary, osds, top_min_wait, top_max_wait, host_total_wait,
+              top_avg_wait, month_avg_wait, day_avg_wait, day_max_wait,
+              host_percentiles, day_percentiles]
+    if args.histogram:
+        histogram = ResultTable('histogram', ['time', 'count', 'min_wait',
+                                              'max_wait', 'total_wait'])
+        for t, s in collection.get_histogram(args.histogram):
+            histogram.append(t, s[3], s[0], s[1], s[2])
+
+        tables.append(histogram)
+
+    return tables
+
+
+def get_columns(collection):
+    """
+    Return the slow requests of a parsed collection as columns for
+    common.export_columns().
+    """
+    codes, hosts = encode_strings([collection.osd_stats[osd]['host']
+                                   for osd in collection.osds])
+    return [('osd', collection.osd_ids, collection.osds),
+            ('host', array('l', [codes[i] for i in collection.osd_ids]),
+             hosts),
+            ('timestamp_us', collection.times, None),
+            ('blocked', collection.blocked, None)]
+
+
+def format_percentiles(values):
+    return ' '.join(["p%s=%.3f" % (p, val)
+                     for p, val in zip(PERCENTILES, values)])
+
+
+def print_report(args, collection, tables=None):
+    """
+    Print the slow request stats of a parsed collection.
+
+    @param tables: results of collection returned by get_results().
+    """
+    if tables is None:
+        tables = get_results(args, collection)
+
+    tables = dict([(t.name, t) for t in tables])
+    for osds, total in tables['summary']:
+        print "Slow request stats for %s OSDs" % osds
+        print "Total slow requests: %s" % total
+
+    for host, rows in itertools.groupby(tables['osds'], lambda r: r[0]):
         print "\n%s:" % host
-        osds = sorted(hosts[host], key=lambda e: int(e.partition('.')[2]))
-        data = ["    %s" % osd for osd in osds]
-        print "%s" % '\n'.join(data)
-
-    aggrs_by_osd = collection.aggrs_by_osd
-    print "\nTop %s:" % collection.MAX_TOPS
-    data = ["\n      %s - %s (%s)" %
-            (e[0], e[1], ' '.join(uniq([str(a[0]) for a in aggrs_by_osd[e[0]]
-                                        if e[1] == a[1]])))
-            for e in collection.mins]
+        print "%s" % '\n'.join(["    %s" % r[1] for r in rows])
+
+    print "\nTop %s:" % collection.top
+    data = ["\n      %s - %s (%s)" % (osd, val, ' '.join(times))
+            for osd, val, times in tables['top_min_wait']]
     print "\n    Min Wait (s): %s" % ' '.join(data)
 
-    data = ["\n      %s - %s (%s)" %
-            (e[0], e[1], ' '.join(uniq([str(a[0]) for a in aggrs_by_osd[e[0]]
-                                        if e[1] == a[1]])))
-            for e in collection.maxs]
-    data = sorted(data,
-                  key=lambda v:
-                  float(re.search(".+ - ([0-9]*\.[0-9]*).+", v).group(1)),
-                  reverse=True)
+    data = ["\n      %s - %s (%s)" % (osd, val, ' '.join(times))
+            for osd, val, times in tables['top_max_wait']]
     print "\n    Max Wait (s): %s" % ' '.join(data)
 
-    aggrs_by_host = collection.aggrs_by_host
-    for host in aggrs_by_host:
-        aggrs_by_host[host] = sum(aggrs_by_host[host])
-
-    data = ["\n      %s - %d" %
-            (host, aggrs_by_host[host]) for host in aggrs_by_host]
-    data = sorted(data, key=lambda v: int(v.partition(' - ')[2]),
-                  reverse=True)
+    data = ["\n      %s - %d" % r for r in tables['host_total_wait']]
     data = data or ["\n    none"]
     print "\n    Total Wait By Host (s): %s" % ' '.join(data)
 
-    data = ["\n      %s - %s" % (e[0], e[1]) for e in collection.avgs]
-    data = sorted(data, key=lambda v: float(v.partition(' - ')[2]),
-                  reverse=True)
+    data = ["\n      %s - %s" % r for r in tables['top_avg_wait']]
     data = data or ["\n    none"]
     print "\n    Avg Wait (s): %s" % ' '.join(data)
 
-    data = ["\n      %s - %s" % (e[0], e[1]) for e in month_avgs]
+    data = ["\n      %s - %s" % r for r in tables['month_avg_wait']]
     data = data or ["\n    none"]
     print "\n    Avg Wait By Month (s): %s" % ' '.join(data)
 
-    data = ["\n      %s - %s (max=%s)" %
-            (e[0], e[1], collection.day_highest_osd(e[0], 'avg'))
-            for e in day_avgs]
+    data = ["\n      %s - %s (max=%s)" % r for r in tables['day_avg_wait']]
     data = data or ["\n    none"]
     print "\n    Avg Wait By Day (s): %s" % ' '.join(data)
 
-    data = ["\n      %s - %s (max=%s)" %
-            (e[0], e[1], collection.day_highest_osd(e[0], 'max'))
-            for e in day_maxs]
+    data = ["\n      %s - %s (max=%s)" % r for r in tables['day_max_wait']]
     data = data or ["\n    none"]
     print "\n    Max Wait By Day (s): %s" % ' '.join(data)
 
+    data = ["\n      %s - %s" % (r[0], format_percentiles(r[1:]))
+            for r in tables['host_wait_percentiles']]
+    data = data or ["\n    none"]
+    print "\n    Wait Percentiles By Host (s): %s" % ' '.join(data)
+
+    data = ["\n      %s - %s" % (r[0], format_percentiles(r[1:]))
+            for r in tables['day_wait_percentiles']]
+    data = data or ["\n    none"]
+    print "\n    Wait Percentiles By Day (s): %s" % ' '.join(data)
+
+    if args.histogram:
+        data = ["\n      %s - %s (max=%s)" % (r[0], r[1], r[3])
+                for r in tables['histogram']]
+        data = data or ["\n    none"]
+        print "\n    Slow Requests Per %s: %s" % \
+            (format_duration(args.histogram), ' '.join(data))
+
     print ''
+
+
+def output(args, collection, export=True):
+    """
+    Print the stats of a parsed collection in args.format and, if export,
+    export them to args.export if set.
+    """
+    tables = get_results(args, collection)
+    if export and args.export:
+        export_results(args.export, tables, get_columns(collection))
+
+    if args.format == 'text':
+        print_report(args, collection, tables)
+    else:
+        write_results(sys.stdout, tables, args.format)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, default=None)
+    parser.add_argument('--cache', action='store_true', default=False)
+    parser.add_argument('--top', type=int, default=TOP,
+                        help="Number of OSDs listed in top mins/maxs/avgs.")
+    parser.add_argument('--cache-events', action='store_true', default=False,
+                        help="Cache decoded events rather than log lines.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of logfiles to scan in parallel.")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="Ignore events before this time e.g. "
+                             "'2016-05-03 10:00'.")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="Ignore events from this time onwards.")
+    parser.add_argument('--histogram', type=parse_duration, default=None,
+                        help="Also print a histogram with buckets of this "
+                             "width e.g. 1m, 5m or 1h.")
+    parser.add_argument('--follow', type=parse_duration, default=None,
+                        help="Follow the current logs under --path, "
+                             "printing refreshed stats at this interval "
+                             "e.g. 10s. Only lines appended after starting "
+                             "(or since --since) are read.")
+    parser.add_argument('--merge-state', action='append', default=[],
+                        help="Merge the state saved to this file by "
+                             "--save-state, which may be given more than "
+                             "once. States are merged in the order given "
+                             "followed by whatever is parsed from --path.")
+    parser.add_argument('--save-state', type=str, default=None,
+                        help="Save the state of the (merged) stats to this "
+                             "file.")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text',
+                        help="Format of the stats printed.")
+    parser.add_argument('--export', type=str, default=None,
+                        help="Also write each table of stats to a CSV file "
+                             "and the events to columnar files in this "
+                             "directory.")
+    args = parser.parse_args()
+    if not args.path and not args.merge_state:
+        parser.error("--path or --merge-state is required")
+
+    window = TimeWindow(args.since, args.until)
+    collection = get_collection(args, [],
+                                [load_state(path, STATE_KIND)
+                                 for path in args.merge_state])
+
+    if args.follow and args.path:
+        def refresh(events):
+            collection.update(events['events'])
+            if args.format == 'text':
+                print "Updated %s\n" % datetime.datetime.now()
+
+            output(args, collection, export=False)
+
+        collection.track_totals(args.histogram)
+        follow_logs(args.path, {'events': QUERY}, args.follow, refresh,
+                    window)
+        # Saving the state and exporting the stats cost a pass over
+        # everything parsed so are only done once following stops.
+        if args.save_state:
+            save_state(args.save_state, STATE_KIND, collection.get_state())
+
+        if args.export:
+            export_results(args.export, get_results(args, collection),
+                           get_columns(collection))
+    else:
+        if args.path:
+            collection.update(get_events(args.path, QUERY, args.cache,
+                                         args.jobs, args.cache_events,
+                                         window))
+
+        if args.save_state:
+            save_state(args.save_state, STATE_KIND, collection.get_state())
+
+        output(args, collection)
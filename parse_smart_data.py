@@ -20,61 +20,312 @@
 # You should have received a copy of the GNU General Public License
 # along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
 
+
+import argparse
+import itertools
+import os
 import re
+import sys
+
+from common import (
+    export_results,
+    get_hostname_from_path,
+    in_shard,
+    write_results,
+    ResultTable,
+    TopK,
+)
+
+# Error counter log rows of smartctl -a output for SCSI/SAS devices, which
+# give errors corrected by ECC (fast, delayed), by rereads/rewrites, in
+# total, correction algorithm invocations, gigabytes processed and total
+# uncorrected errors e.g.
+#
+# read:          0        0         0         0          0       2285.921   0
+COUNTER_RE = re.compile(r"^(read|write|verify):\s+(.*)$")
+COUNTERS = ['read', 'write', 'verify']
+# Columns of each error counter row.
+COLUMNS = ['ecc_fast', 'ecc_delayed', 'rereads', 'corrected', 'invocations',
+           'gigabytes', 'uncorrected']
+# A device named on a line of its own in combined data files.
+DEVICE_RE = re.compile(r"^(/dev/\S+)\s*$")
+# A host named on a line of its own in combined data files, as written by
+# e.g. for h in $hosts; do echo $h; ssh $h 'for d in ...; do echo $d;
+# smartctl -a $d; done'; done
+HOST_RE = re.compile(r"^([A-Za-z0-9][A-Za-z0-9.-]*)\s*$")
+# Default number of devices listed in each of the worst device rankings.
+TOP = 10
+
+
+def decode_counters(values):
+    """
+    Decode the columns of an error counter row, ignoring any that are
+    missing or malformed.
+    """
+    row = {}
+    for name, value in zip(COLUMNS, values.split()):
+        try:
+            if name == 'gigabytes':
+                row[name] = float(value)
+            else:
+                row[name] = int(value)
+        except ValueError:
+            break
 
-from common import avg
+    return row
 
-env = {}
-current = None
 
+def read_smart_data(path, host=None, dev=None):
+    """
+    Generator yielding (host, device, counter, row) for each error counter
+    row in a file of smartctl output. The file is read a line at a time.
 
-def parse(filename):
-    with open(filename, 'r') as fd:
-        dev = None
-        for line in fd.readlines():
-            res = re.search("^.+\.bskyb.com", line)
+    @param path: path to the file.
+    @param host: host the output belongs to. If None hosts are taken from
+                 lines naming them, as written to a combined data file.
+    @param dev: device the output belongs to. Devices are also taken from
+                lines naming them.
+    """
+    match_host = host is None
+    with open(path, 'r') as fd:
+        for line in fd:
+            res = COUNTER_RE.match(line)
             if res:
-                env[res.group(0)] = {'read': [], 'write': [], 'verify': []}
-                current = res.group(0)
+                row = decode_counters(res.group(2))
+                if row and dev:
+                    yield host, dev, res.group(1), row
+
                 continue
 
-            res = re.search("^/dev/.*$", line)
+            res = DEVICE_RE.match(line)
             if res:
-                dev = res.group(0)
+                dev = res.group(1)
                 continue
 
-            for t in ['read', 'write', 'verify']:
-                res = re.search("^%s:\s*(.*?)\s" % (t), line)
+            if match_host:
+                res = HOST_RE.match(line)
                 if res:
-                    env[current][t].append((dev, int(res.group(1))))
-                    continue
+                    host = intern(res.group(1))
+                    dev = None
+
+
+def find_smart_files(path):
+    """
+    Return list of (path, host, device) for the smartctl output collected in
+    the sos_commands of each sosreport under path. Other files, such as the
+    ceph logs, are never taken for smartctl output.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        if 'sos_commands' in dirnames:
+            # Only sos_commands of a sosreport hold smartctl output.
+            dirnames[:] = ['sos_commands']
+        elif os.path.basename(dirpath).startswith('sosreport-'):
+            dirnames[:] = []
+
+        if os.sep + 'sos_commands' not in dirpath:
+            continue
+
+        for f in sorted(filenames):
+            if not f.startswith('smartctl'):
+                continue
+
+            # e.g. smartctl_-a_.dev.sda
+            dev = None
+            name = f.rpartition('_')[2]
+            if name.startswith('.dev.'):
+                dev = '/dev/%s' % name[5:].replace('.', '/')
+
+            f = os.path.join(dirpath, f)
+            files.append((f, intern(get_hostname_from_path(f)), dev))
+
+    return sorted(files)
+
+
+def get_smart_data(path, shard=None):
+    """
+    Generator yielding (host, device, counter, row) for all smartctl output
+    found by find_smart_files().
+
+    @param shard: (index, count) of the shard of hosts to read the output
+                  of. See common.in_shard().
+    """
+    for f, host, dev in find_smart_files(path):
+        if not in_shard(host, shard):
+            continue
+
+        for record in read_smart_data(f, host, dev):
+            yield record
+
+
+class SmartStatsCollection(object):
+    def __init__(self, records, top=TOP):
+        """
+        @param records: iterable of (host, device, counter, row).
+        @param top: number of devices retained in each worst device ranking.
+        """
+        self.records = records
+        self.top = top
+        # {host: {device: {counter: row}}}
+        self.devices = {}
+        # {host: {counter: {'sum', 'count', 'max', 'worst'}}} of errors
+        # corrected by ECC (fast).
+        self.host_stats = {}
+        # {counter: TopK} of (host, device) by errors corrected by ECC (fast)
+        self.worst = dict([(c, TopK(top)) for c in COUNTERS])
+        self.uncorrected = TopK(top)
+
+    def parse(self):
+        for host, dev, counter, row in self.records:
+            if host not in self.devices:
+                self.devices[host] = {}
+                self.host_stats[host] = dict([(c, {'sum': 0, 'count': 0,
+                                                   'max': None,
+                                                   'worst': None})
+                                              for c in COUNTERS])
+
+            if dev not in self.devices[host]:
+                self.devices[host][dev] = {}
 
+            self.devices[host][dev][counter] = row
+            val = row['ecc_fast']
+            stats = self.host_stats[host][counter]
+            stats['sum'] += val
+            stats['count'] += 1
+            if stats['max'] is None or val > stats['max']:
+                stats['max'] = val
+                stats['worst'] = dev
 
-def findworst(data):
-    maxdev = None
-    maxval = 0
-    for d in data:
-        if d[1] > maxval:
-            maxdev = d[0]
+            self.worst[counter].push((host, dev), val)
 
-    return maxdev
+        for host in sorted(self.devices):
+            for dev in sorted(self.devices[host]):
+                total = sum([row.get('uncorrected', 0) for row in
+                             self.devices[host][dev].itervalues()])
+                self.uncorrected.push((host, dev), total)
+
+    def total_devices(self):
+        return sum([len(d) for d in self.devices.itervalues()])
+
+
+def get_collection(args, records):
+    """
+    Return a parsed collection of records.
+
+    @param args: parsed command line arguments.
+    @param records: records returned by get_smart_data().
+    """
+    collection = SmartStatsCollection(records, args.top)
+    collection.parse()
+    return collection
+
+
+def get_results(args, collection):
+    """
+    Return list of common.ResultTable of the SMART error recovery stats of
+    a parsed collection.
+    """
+    summary = ResultTable('summary', ['devices', 'hosts'])
+    summary.append(collection.total_devices(), len(collection.devices))
+
+    host_stats = ResultTable('host_stats', ['host', 'counter', 'sum', 'avg',
+                                            'max', 'worst'])
+    for host in sorted(collection.host_stats):
+        for counter in COUNTERS:
+            stats = collection.host_stats[host][counter]
+            if stats['count']:
+                host_stats.append(host, counter, stats['sum'],
+                                  stats['sum'] / stats['count'],
+                                  stats['max'], stats['worst'])
+
+    worst = ResultTable('worst', ['counter', 'host', 'device', 'errors'])
+    for counter in COUNTERS:
+        for (host, dev), val in collection.worst[counter].items():
+            worst.append(counter, host, dev, val)
+
+    uncorrected = ResultTable('uncorrected', ['host', 'device', 'errors'])
+    for (host, dev), val in collection.uncorrected.items():
+        if val:
+            uncorrected.append(host, dev, val)
+
+    devices = ResultTable('devices', ['host', 'device', 'counter'] + COLUMNS)
+    for host in sorted(collection.devices):
+        for dev in sorted(collection.devices[host]):
+            for counter in COUNTERS:
+                row = collection.devices[host][dev].get(counter)
+                if row:
+                    devices.append(host, dev, counter,
+                                   *[row.get(c) for c in COLUMNS])
+
+    return [summary, host_stats, worst, uncorrected, devices]
+
+
+def print_report(args, collection, tables=None):
+    """
+    Print the SMART error recovery stats of a parsed collection.
+
+    @param tables: results of collection returned by get_results().
+    """
+    if tables is None:
+        tables = get_results(args, collection)
+
+    tables = dict([(t.name, t) for t in tables])
+    for devices, hosts in tables['summary']:
+        print "SMART error recovery stats for %s devices on %s hosts" % \
+            (devices, hosts)
+        if not hosts:
+            print ''
+            return
+
+    for host, rows in itertools.groupby(tables['host_stats'],
+                                        lambda r: r[0]):
+        print "\n%s recovery stats" % host
+        for r in rows:
+            print "  %s" % r[1]
+            print "      sum: %s avg: %s max: %s" % r[2:5]
+            print "      worst: %s" % r[5]
+
+    print "\nTop %s:" % collection.top
+    for counter in COUNTERS:
+        data = ["\n      %s:%s - %s" % r[1:] for r in tables['worst']
+                if r[0] == counter]
+        data = data or ["\n      none"]
+        print "\n    Corrected %s errors: %s" % (counter, ' '.join(data))
+
+    data = ["\n      %s:%s - %s" % r for r in tables['uncorrected']]
+    data = data or ["\n      none"]
+    print "\n    Uncorrected errors: %s" % ' '.join(data)
+
+    print ''
 
 
 if __name__ == "__main__":
-    parse('smart_recovery_data')
-    for k in env:
-        print "{} recovery stats".format(k)
-        for t in ['read', 'write', 'verify']:
-            data = env[k][t]
-            vals = [d[1] for d in data]
-            a = avg(vals)
-            print "  {}".format(t)
-            print "      sum: {} avg: {} max: {}".format(sum(vals),
-                                                         a, max(vals))
-            worst = findworst(data)
-            if worst is None:
-                worst = 'n/a'
-
-            print "      worst: {}".format(worst)
-
-        print ''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, default='smart_recovery_data',
+                        help="Combined smartctl data file or path to "
+                             "sosreport(s).")
+    parser.add_argument('--top', type=int, default=TOP,
+                        help="Number of devices listed in worst device "
+                             "rankings.")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text',
+                        help="Format of the stats printed.")
+    parser.add_argument('--export', type=str, default=None,
+                        help="Also write each table of stats to a CSV file "
+                             "in this directory.")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.path):
+        records = read_smart_data(args.path)
+    else:
+        records = get_smart_data(args.path)
+
+    collection = get_collection(args, records)
+    tables = get_results(args, collection)
+    if args.export:
+        export_results(args.export, tables)
+
+    if args.format == 'text':
+        print_report(args, collection, tables)
+    else:
+        write_results(sys.stdout, tables, args.format)
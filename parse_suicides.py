@@ -22,33 +22,175 @@
 
 import argparse
 import datetime
+import sys
 
-from common import get
+from array import array
+from collections import namedtuple
+
+from common import (
+    add_stats,
+    encode_strings,
+    export_results,
+    follow_logs,
+    format_duration,
+    from_epoch_us,
+    get_events,
+    load_state,
+    parse_duration,
+    parse_time,
+    parse_timestamp,
+    save_state,
+    time_histogram,
+    to_epoch_us,
+    write_results,
+    LogQuery,
+    ResultTable,
+    TimeWindow,
+)
+
+KEYWORDS = 'had suicide timed out'
+FILTER = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9][0-9]"
+          "[0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:[0-9]+:"
+          "[0-9]+\.[0-9]*)\s*([a-z0-9]*)\s*.+had suicide timed out "
+          "after (.+)")
+FIELDS = [('osd', 'osd'), ('timestamp', 'timestamp'), ('thread', 'str'),
+          ('timeout', 'str')]
+SuicideEvent = namedtuple('SuicideEvent', ['host'] + [f[0] for f in FIELDS])
+
+
+def decode(groups):
+    return (intern(groups[0]), parse_timestamp(groups[1]), groups[2],
+            intern(groups[3]))
+
+
+QUERY = LogQuery(KEYWORDS, FILTER, FIELDS, decode, SuicideEvent)
+
+# Kind of state saved by --save-state.
+STATE_KIND = 'suicides'
 
 
 class CephSuicideStatsCollection(object):
     def __init__(self, month, events):
         self.suicide_stats = {}
-        self.thread_index = {}
         self.month = month
         self.events = events
+        # Counts computed by get_stats() or, once track_totals() is called,
+        # kept up to date as suicides are added.
+        self.running = False
+        # {osd: {day: [(datetime, thread)]}} of all suicides and
+        # {day: {osd: count}} of those in month.
+        self.thread_index = {}
+        self.day_counters = {}
+        # {bucket: [min, max, sum, count]} for buckets of histogram width.
+        self.histogram = None
+        self.buckets = {}
 
     def parse(self):
-        for event in self.events:
-            osd = event['data'].group(1)
-            t = datetime.datetime.strptime(event['data'].group(2),
-                                           '%Y-%m-%d %H:%M:%S.%f')
-            thread = event['data'].group(3)
-            timeout = event['data'].group(4)
-
-            suicide = {'timestamp': t,
-                       'timeout': timeout,
-                       'thread': thread}
+        self.update(self.events)
+
+    def update(self, events):
+        """
+        Add events to the collection, which may be done repeatedly e.g. as
+        they are found by common.follow_logs().
+
+        @param events: iterable of SuicideEvent.
+        """
+        for event in events:
+            osd = event.osd
+            suicide = {'timestamp': event.timestamp,
+                       'timeout': event.timeout,
+                       'thread': event.thread}
             if osd in self.suicide_stats:
                 self.suicide_stats[osd]['suicides'].append(suicide)
             else:
                 self.suicide_stats[osd] = {'suicides': [suicide],
-                                           'host': event['host']}
+                                           'host': event.host}
+
+            if self.running:
+                self._add_totals(osd, suicide)
+
+    def _add_totals(self, osd, suicide):
+        t = suicide['timestamp']
+        if osd not in self.thread_index:
+            self.thread_index[osd] = {}
+
+        if t.day not in self.thread_index[osd]:
+            self.thread_index[osd][t.day] = []
+
+        self.thread_index[osd][t.day].append((t, suicide['thread']))
+        if int(t.month) == self.month:
+            if t.day not in self.day_counters:
+                self.day_counters[t.day] = {}
+
+            counters = self.day_counters[t.day]
+            counters[osd] = counters.get(osd, 0) + 1
+
+        if self.histogram:
+            t_us = to_epoch_us(t)
+            add_stats(self.buckets, t_us // self.histogram * self.histogram,
+                      t_us)
+
+    def _count_suicides(self):
+        self.thread_index = {}
+        self.day_counters = {}
+        self.buckets = {}
+        for osd in self.suicide_stats:
+            for suicide in self.suicide_stats[osd]['suicides']:
+                self._add_totals(osd, suicide)
+
+    def track_totals(self, histogram=None):
+        """
+        Keep the stats returned by get_stats() and get_histogram() up to date
+        as suicides are added from now on, e.g. when following logs, so that
+        fetching them does not need a pass over every suicide.
+
+        @param histogram: width in microseconds of the histogram buckets.
+        """
+        self.histogram = histogram
+        self._count_suicides()
+        self.running = True
+
+    def merge(self, other):
+        """
+        Add the suicides of another collection to this one e.g. one restored
+        from the state saved after parsing another sosreport.
+        """
+        for osd, stats in other.suicide_stats.iteritems():
+            if osd in self.suicide_stats:
+                self.suicide_stats[osd]['suicides'] += stats['suicides']
+            else:
+                self.suicide_stats[osd] = {'suicides':
+                                           list(stats['suicides']),
+                                           'host': stats['host']}
+
+            if self.running:
+                for suicide in stats['suicides']:
+                    self._add_totals(osd, suicide)
+
+    def get_state(self):
+        """
+        Return the parsed state of the collection for common.save_state().
+        See from_state().
+        """
+        return dict([(osd, (stats['host'],
+                            [(to_epoch_us(s['timestamp']), s['timeout'],
+                              s['thread']) for s in stats['suicides']]))
+                     for osd, stats in self.suicide_stats.iteritems()])
+
+    @classmethod
+    def from_state(cls, month, state):
+        """
+        Return a collection restored from the output of get_state().
+        """
+        collection = cls(month, [])
+        for osd, (host, suicides) in state.iteritems():
+            collection.suicide_stats[intern(osd)] = {
+                'host': intern(host),
+                'suicides': [{'timestamp': from_epoch_us(t),
+                              'timeout': intern(timeout), 'thread': thread}
+                             for t, timeout, thread in suicides]}
+
+        return collection
 
     def get_osds_by_host(self):
         hosts = {}
@@ -65,80 +207,230 @@ class CephSuicideStatsCollection(object):
         return hosts
 
     def get_stats(self):
+        if not self.running:
+            self._count_suicides()
+
         stats = {}
-        day_counters = {}
+        for day, counters in self.day_counters.iteritems():
+            _max = []
+            for osd in counters:
+                if not _max or _max[1] < counters[osd]:
+                    _max = (osd, counters[osd])
+
+            stats[day] = {'count': sum(counters.values()),
+                          'maxosd': _max[0]}
+
+        return sorted(stats.keys()), stats
+
+    def get_histogram(self, width):
+        """
+        Return a sorted list of (datetime, (min, max, sum, count)) for each
+        bucket of width microseconds, where only count is meaningful.
+        """
+        if self.running and width == self.histogram:
+            return [(from_epoch_us(k), tuple(self.buckets[k]))
+                    for k in sorted(self.buckets)]
+
+        times = array('l')
         for osd in self.suicide_stats:
-            for s in self.suicide_stats[osd]['suicides']:
-                t = s['timestamp']
-                if int(t.month) == self.month:
-                    if t.day not in day_counters:
-                        day_counters[t.day] = {}
+            times.extend([to_epoch_us(s['timestamp'])
+                          for s in self.suicide_stats[osd]['suicides']])
 
-                    if osd not in day_counters[t.day]:
-                        day_counters[t.day][osd] = 0
+        return time_histogram(times, width)
 
-                    if t.day in stats:
-                        stats[t.day]['count'] += 1
-                    else:
-                        stats[t.day] = {'count': 1, 'maxosd': None}
+    def get_osd_threads(self, day, osd):
+        return [t[1] for t in sorted(self.thread_index[osd][day],
+                                     key=lambda e: e[0])]
 
-                    day_counters[t.day][osd] += 1
 
-                if osd not in self.thread_index:
-                    self.thread_index[osd] = {}
+def get_collection(args, events, states=()):
+    """
+    Return a collection of events added after merging each of states, as
+    saved by --save-state, in order.
 
-                if t.day not in self.thread_index[osd]:
-                    self.thread_index[osd][t.day] = []
+    @param args: parsed command line arguments.
+    @param events: events returned by common.get_events() for QUERY.
+    @param states: list of states returned by common.load_state().
+    """
+    collection = CephSuicideStatsCollection(args.month, [])
+    for state in states:
+        collection.merge(CephSuicideStatsCollection.from_state(
+            args.month, state))
 
-                self.thread_index[osd][t.day].append((t, s['thread']))
+    collection.update(events)
+    return collection
 
-        for day in day_counters:
-            _max = []
-            for osd in day_counters[day]:
-                if not _max or _max[1] < day_counters[day][osd]:
-                    _max = (osd, day_counters[day][osd])
 
-            stats[day]['maxosd'] = _max[0]
+def get_results(args, collection):
+    """
+    Return list of common.ResultTable of the OSD suicide stats of a parsed
+    collection for args.month.
+    """
+    keys, stats = collection.get_stats()
+    summary = ResultTable('summary', ['month', 'suicides'])
+    summary.append(args.month, sum([stats[k]['count'] for k in keys]))
 
-        return sorted(stats.keys()), stats
+    days = ResultTable('days', ['day', 'count', 'max_osd', 'host',
+                                'threads'])
+    for k in keys:
+        osd = stats[k]['maxosd']
+        days.append(k, stats[k]['count'], osd,
+                    collection.suicide_stats[osd]['host'],
+                    collection.get_osd_threads(k, osd))
 
-    def get_osd_threads(self, day, osd):
-        return [t[1] for t in sorted(collection.thread_index[osd][day],
-                                     key=lambda e: e[0])]
+    tables = [summary, days]
+    if args.histogram:
+        histogram = ResultTable('histogram', ['time', 'count'])
+        for t, s in collection.get_histogram(args.histogram):
+            histogram.append(t, s[3])
+
+        tables.append(histogram)
+
+    return tables
+
+
+def get_columns(collection):
+    """
+    Return the suicides of a parsed collection as columns for
+    common.export_columns().
+    """
+    osds = sorted(collection.suicide_stats)
+    osd_codes = array('l')
+    hosts = []
+    times = array('l')
+    threads = []
+    timeouts = []
+    for code, osd in enumerate(osds):
+        suicides = collection.suicide_stats[osd]['suicides']
+        osd_codes.extend([code] * len(suicides))
+        hosts += [collection.suicide_stats[osd]['host']] * len(suicides)
+        times.extend([to_epoch_us(s['timestamp']) for s in suicides])
+        threads += [s['thread'] for s in suicides]
+        timeouts += [s['timeout'] for s in suicides]
+
+    host_codes, hosts = encode_strings(hosts)
+    thread_codes, threads = encode_strings(threads)
+    timeout_codes, timeouts = encode_strings(timeouts)
+    return [('osd', osd_codes, osds), ('host', host_codes, hosts),
+            ('timestamp_us', times, None),
+            ('thread', thread_codes, threads),
+            ('timeout', timeout_codes, timeouts)]
+
+
+def print_report(args, collection, tables=None):
+    """
+    Print the OSD suicide stats of a parsed collection.
+
+    @param tables: results of collection returned by get_results().
+    """
+    if tables is None:
+        tables = get_results(args, collection)
+
+    tables = dict([(t.name, t) for t in tables])
+    for month, total in tables['summary']:
+        print "OSD Suicide stats for month %s" % (month)
+        print "Total suicides: %s" % total
+
+    data = ["\n    %s - %s (maxosd=%s, host=%s, threads=%s)" % r
+            for r in tables['days']] or ["\n    none"]
+    print "\n  No. suicides by day: %s" % ' '.join(data)
+
+    if args.histogram:
+        data = ["\n    %s - %s" % r for r in tables['histogram']]
+        data = data or ["\n    none"]
+        print "\n  No. suicides per %s: %s" % \
+            (format_duration(args.histogram), ' '.join(data))
+
+    print ""
+
+
+def output(args, collection, export=True):
+    """
+    Print the stats of a parsed collection in args.format and, if export,
+    export them to args.export if set.
+    """
+    tables = get_results(args, collection)
+    if export and args.export:
+        export_results(args.export, tables, get_columns(collection))
+
+    if args.format == 'text':
+        print_report(args, collection, tables)
+    else:
+        write_results(sys.stdout, tables, args.format)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--path', type=str, default=None, required=True)
+    parser.add_argument('--path', type=str, default=None)
     parser.add_argument('--month', type=int, default=None, required=True)
     parser.add_argument('--cache', action='store_true', default=False)
+    parser.add_argument('--cache-events', action='store_true', default=False,
+                        help="Cache decoded events rather than log lines.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of logfiles to scan in parallel.")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="Ignore events before this time e.g. "
+                             "'2016-05-03 10:00'.")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="Ignore events from this time onwards.")
+    parser.add_argument('--histogram', type=parse_duration, default=None,
+                        help="Also print a histogram with buckets of this "
+                             "width e.g. 1m, 5m or 1h.")
+    parser.add_argument('--follow', type=parse_duration, default=None,
+                        help="Follow the current logs under --path, "
+                             "printing refreshed stats at this interval "
+                             "e.g. 10s. Only lines appended after starting "
+                             "(or since --since) are read.")
+    parser.add_argument('--merge-state', action='append', default=[],
+                        help="Merge the state saved to this file by "
+                             "--save-state, which may be given more than "
+                             "once. States are merged in the order given "
+                             "followed by whatever is parsed from --path.")
+    parser.add_argument('--save-state', type=str, default=None,
+                        help="Save the state of the (merged) stats to this "
+                             "file.")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text',
+                        help="Format of the stats printed.")
+    parser.add_argument('--export', type=str, default=None,
+                        help="Also write each table of stats to a CSV file "
+                             "and the suicides to columnar files in this "
+                             "directory.")
     args = parser.parse_args()
+    if not args.path and not args.merge_state:
+        parser.error("--path or --merge-state is required")
 
-    keywords = '"had suicide timed out"'
-    filter = (r".+(ceph-osd\.[0-9]*)\.log.*:.*([0-9][0-9]"
-              "[0-9][0-9]-[0-9]+-[0-9]+\s[0-9]+:[0-9]+:"
-              "[0-9]+\.[0-9]*)\s*([a-z0-9]*)\s*.+had suicide timed out "
-              "after (.+)")
-
-    collection = CephSuicideStatsCollection(args.month,
-                                            get(args.path, keywords, filter,
-                                                args.cache))
-    collection.parse()
-
-    print "OSD Suicide stats for month %s" % (args.month)
-    suicides = []
-    month = int(args.month)
-    for osd in collection.suicide_stats:
-        _suicides = collection.suicide_stats[osd]['suicides']
-        suicides += [s for s in _suicides if s['timestamp'].month == month]
-    print "Total suicides: %s" % len(suicides)
+    window = TimeWindow(args.since, args.until)
+    collection = get_collection(args, [],
+                                [load_state(path, STATE_KIND)
+                                 for path in args.merge_state])
 
-    keys, stats = collection.get_stats()
-    data = ["\n    %s - %s (maxosd=%s, host=%s, threads=%s)" %
-            (k, stats[k]['count'], stats[k]['maxosd'],
-             collection.suicide_stats[stats[k]['maxosd']]['host'],
-             collection.get_osd_threads(k, stats[k]['maxosd']))
-            for k in keys] or ["\n    none"]
-    print "\n  No. suicides by day: %s" % ' '.join(data)
+    if args.follow and args.path:
+        def refresh(events):
+            collection.update(events['events'])
+            if args.format == 'text':
+                print "Updated %s\n" % datetime.datetime.now()
 
-    print ""
+            output(args, collection, export=False)
+
+        collection.track_totals(args.histogram)
+        follow_logs(args.path, {'events': QUERY}, args.follow, refresh,
+                    window)
+        # Saving the state and exporting the stats cost a pass over
+        # everything parsed so are only done once following stops.
+        if args.save_state:
+            save_state(args.save_state, STATE_KIND, collection.get_state())
+
+        if args.export:
+            export_results(args.export, get_results(args, collection),
+                           get_columns(collection))
+    else:
+        if args.path:
+            collection.update(get_events(args.path, QUERY, args.cache,
+                                         args.jobs, args.cache_events,
+                                         window))
+
+        if args.save_state:
+            save_state(args.save_state, STATE_KIND, collection.get_state())
+
+        output(args, collection)
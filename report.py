@@ -0,0 +1,166 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+
+import parse_scrubs
+import parse_smart_data
+import parse_slow_requests
+import parse_suicides
+
+from common import (
+    export_results,
+    get_multi,
+    load_state,
+    parse_duration,
+    parse_shard,
+    parse_time,
+    save_state,
+    write_results,
+    TimeWindow,
+)
+
+# Parsers included in the combined report, in the order they are printed.
+# Each must provide QUERY, STATE_KIND, get_collection(args, events, states),
+# get_results(args, collection), get_columns(collection),
+# print_report(args, collection, tables) and a collection with get_state().
+PARSERS = [('===================== Scrubs Data ======================',
+            parse_scrubs),
+           ('================== Slow Request Data ===================',
+            parse_slow_requests),
+           ('================== Suicide Timeout Data ================',
+            parse_suicides)]
+SMART_TITLE = '================= Smart Recovery Data ================='
+# Kind of state saved by --save-partial.
+PARTIAL_KIND = 'partial'
+
+
+def banner(title):
+    line = '=' * 56
+    return "%s\n%s\n%s\n" % (line, title, line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, default=None)
+    parser.add_argument('--month', type=int, default=None)
+    parser.add_argument('--cache', action='store_true', default=False)
+    parser.add_argument('--top', type=int, default=parse_slow_requests.TOP,
+                        help="Number of entries listed in top slow request "
+                             "and SMART error rankings.")
+    parser.add_argument('--cache-events', action='store_true', default=False,
+                        help="Cache decoded events rather than log lines.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of logfiles to scan in parallel.")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="Ignore events before this time e.g. "
+                             "'2016-05-03 10:00'.")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="Ignore events from this time onwards.")
+    parser.add_argument('--histogram', type=parse_duration, default=None,
+                        help="Also print a histogram with buckets of this "
+                             "width e.g. 1m, 5m or 1h.")
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="Only parse the sosreports of the hosts in this "
+                             "shard, given as INDEX/COUNT e.g. 0/4, so that "
+                             "COUNT processes or machines can each parse a "
+                             "share of the same sosreports.")
+    parser.add_argument('--save-partial', type=str, default=None,
+                        help="Save the partial results of --path to this "
+                             "file, to be merged by --merge-partial, rather "
+                             "than printing the report.")
+    parser.add_argument('--merge-partial', action='append', default=[],
+                        help="Merge the partial results saved to this file "
+                             "by --save-partial into the report, which may "
+                             "be given more than once. --since and --until "
+                             "only apply to what was parsed when saving.")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                        default='text',
+                        help="Format of the report printed.")
+    parser.add_argument('--export', type=str, default=None,
+                        help="Also write each table of stats to a CSV file "
+                             "and the events of each parser to columnar "
+                             "files in this directory.")
+    args = parser.parse_args()
+    if not args.path and not args.merge_partial:
+        parser.error("--path or --merge-partial is required")
+
+    if args.month is None and not args.save_partial:
+        parser.error("--month is required")
+
+    partials = [load_state(path, PARTIAL_KIND)
+                for path in args.merge_partial]
+    queries = {}
+    for title, module in PARSERS:
+        queries[title] = module.QUERY
+
+    if args.path:
+        events = get_multi(args.path, queries, args.cache, args.jobs,
+                           args.cache_events,
+                           TimeWindow(args.since, args.until), args.shard)
+        smart_data = list(parse_smart_data.get_smart_data(args.path,
+                                                          args.shard))
+    else:
+        events = dict([(title, []) for title in queries])
+        smart_data = []
+
+    collections = []
+    for title, module in PARSERS:
+        collections.append(module.get_collection(
+            args, events.pop(title),
+            [partial[module.STATE_KIND] for partial in partials]))
+
+    for partial in partials:
+        smart_data += partial['smart']
+
+    if args.save_partial:
+        state = {'smart': smart_data}
+        for (title, module), collection in zip(PARSERS, collections):
+            state[module.STATE_KIND] = collection.get_state()
+
+        save_state(args.save_partial, PARTIAL_KIND, state)
+    else:
+        results = {}
+        for (title, module), collection in zip(PARSERS, collections):
+            tables = results[module.STATE_KIND] = module.get_results(
+                args, collection)
+            if args.export:
+                export_results(args.export, tables,
+                               module.get_columns(collection),
+                               '%s.' % module.STATE_KIND)
+
+            if args.format == 'text':
+                print banner(title)
+                module.print_report(args, collection, tables)
+
+        collection = parse_smart_data.get_collection(args, smart_data)
+        tables = results['smart'] = parse_smart_data.get_results(args,
+                                                                 collection)
+        if args.export:
+            export_results(args.export, tables, prefix='smart.')
+
+        if args.format == 'text':
+            print banner(SMART_TITLE)
+            parse_smart_data.print_report(args, collection, tables)
+        else:
+            write_results(sys.stdout, results, args.format)
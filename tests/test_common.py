@@ -0,0 +1,294 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run from the top of the tree with: python2 -m unittest discover tests
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import common
+import parse_scrubs
+import parse_slow_requests
+import parse_suicides
+
+from common import (
+    decode_lines,
+    get_multi,
+    parse_time,
+    BundleIndex,
+    LogFollower,
+    LogQuery,
+    TimeIndex,
+    TimeWindow,
+)
+
+QUERIES = dict([(module.__name__, module.QUERY)
+                for module in [parse_scrubs, parse_slow_requests,
+                               parse_suicides]])
+PREFIX = "2016-05-%02d %02d:%02d:00.000000 7f06326585ad  "
+LINES = ["0 log_channel(cluster) log [INF] : 1.%x deep-scrub starts\n",
+         "0 log_channel(cluster) log [INF] : 1.%x deep-scrub ok\n",
+         "0 log_channel(cluster) log [WRN] : 3 slow requests, 1 included "
+         "below; oldest blocked for > %s.000000 secs\n",
+         "1 heartbeat_map is_healthy 'OSD::osd_op_tp thread 0x7f06326585ad' "
+         "had suicide timed out after %s\n"]
+
+
+def make_lines(start, count):
+    """
+    Return count log lines, a minute apart from start minutes into the
+    month, cycling through deep-scrubs, slow requests and suicides.
+    """
+    lines = []
+    for i in xrange(start, start + count):
+        lines.append(PREFIX % (1 + i / 1440, i / 60 % 24, i % 60) +
+                     LINES[i % len(LINES)] % (30 + i % 100))
+
+    return ''.join(lines)
+
+
+def count_events(events):
+    return dict([(name, len(events[name])) for name in events])
+
+
+def mid_line(data, pos):
+    """
+    Return an offset a few characters before the end of the line of data at
+    pos.
+    """
+    return data.index('\n', pos) - 5
+
+
+class LogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = common.CACHE_DIR
+        common.CACHE_DIR = os.path.join(self.tmpdir, 'cache')
+        self.path = os.path.join(self.tmpdir, 'sosreport-host0.1-20160501')
+        logdir = os.path.join(self.path, 'var', 'log', 'ceph')
+        os.makedirs(logdir)
+        self.log = os.path.join(logdir, 'ceph-osd.0.log')
+
+    def tearDown(self):
+        common.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, data):
+        with open(self.log, 'a') as fd:
+            fd.write(data)
+
+    def scan(self, data):
+        """
+        Return the events get_multi() finds in a log of another sosreport
+        of the same host holding data.
+        """
+        path = os.path.join(self.tmpdir, 'sosreport-host0.2-20160502')
+        shutil.rmtree(path, ignore_errors=True)
+        logdir = os.path.join(path, 'var', 'log', 'ceph')
+        os.makedirs(logdir)
+        with open(os.path.join(logdir, 'ceph-osd.0.log'), 'w') as fd:
+            fd.write(data)
+
+        return get_multi(path, QUERIES)
+
+
+class TestBundleIndex(LogTestCase):
+
+    def test_resumed_event_cache(self):
+        self.append(make_lines(0, 200))
+        get_multi(self.path, QUERIES, cache_events=True)
+        self.append(make_lines(200, 100))
+        BundleIndex(self.path).build([q.keywords for q in QUERIES.values()])
+        self.assertEqual(count_events(get_multi(self.path, QUERIES,
+                                                cache_events=True)),
+                         count_events(get_multi(self.path, QUERIES)))
+
+    def test_partial_line(self):
+        data = make_lines(0, 200)
+        self.append(data[:-10])
+        keywords = [q.keywords for q in QUERIES.values()]
+        BundleIndex(self.path).build(keywords)
+        self.append(data[-10:] + make_lines(200, 100))
+        expected = count_events(get_multi(self.path, QUERIES))
+        BundleIndex.find(self.path).build(keywords)
+        self.assertEqual(count_events(get_multi(self.path, QUERIES, True)),
+                         expected)
+
+    def test_only_when_caching(self):
+        self.append(make_lines(0, 20))
+        index = BundleIndex(self.path)
+        index.build([q.keywords for q in QUERIES.values()])
+        expected = count_events(get_multi(self.path, QUERIES))
+        # Empty the index so that it is clear when it has been used.
+        for lines in index.files.values()[0]['lines'].itervalues():
+            del lines[:]
+
+        index.save()
+        self.assertEqual(count_events(get_multi(self.path, QUERIES)),
+                         expected)
+        self.assertFalse(any(get_multi(self.path, QUERIES, True).values()))
+
+    def test_keywords_in_path(self):
+        self.append(make_lines(0, 20))
+        index = BundleIndex(self.path)
+        index.build(['sosreport'])
+        self.assertEqual(index.get_lines(self.log, ['sosreport']),
+                         {'sosreport': []})
+        query = LogQuery('sosreport', parse_slow_requests.FILTER)
+        with open(self.log) as fd:
+            lines = ["%s:%s" % (self.log, line.rstrip('\n')) for line in fd]
+
+        self.assertEqual(list(decode_lines(lines, {'query': query},
+                                           skip=len(self.log) + 1)), [])
+
+
+class TestResumeCache(LogTestCase):
+
+    def assertResumes(self, **kwargs):
+        data = make_lines(0, 300)
+        cut = mid_line(data, len(data) / 2)
+        self.append(data[:cut])
+        get_multi(self.path, QUERIES, **kwargs)
+        self.append(data[cut:])
+        self.assertEqual(get_multi(self.path, QUERIES, **kwargs),
+                         get_multi(self.path, QUERIES))
+
+    def test_results_cache(self):
+        self.assertResumes(cache_results=True)
+
+    def test_event_cache(self):
+        self.assertResumes(cache_events=True)
+
+    def test_growth_during_scan(self):
+        # Lines matched by a query without fields are never cached so the
+        # event caches are rebuilt from the start of the log.
+        queries = dict(QUERIES, lines=LogQuery(parse_slow_requests.KEYWORDS,
+                                               parse_slow_requests.FILTER))
+        data = make_lines(0, 300)
+        cut = data.index('\n', len(data) / 2) + 1
+        self.append(data[:cut])
+        grep_log = common.grep_log
+
+        def growing_grep_log(*args, **kwargs):
+            self.append(data[cut:])
+            return grep_log(*args, **kwargs)
+
+        common.grep_log = growing_grep_log
+        try:
+            get_multi(self.path, queries, cache_events=True)
+        finally:
+            common.grep_log = grep_log
+
+        self.assertEqual(get_multi(self.path, QUERIES, cache_events=True),
+                         get_multi(self.path, QUERIES))
+
+
+class TestTimeIndex(LogTestCase):
+
+    def setUp(self):
+        super(TestTimeIndex, self).setUp()
+        # Small enough for the index to have many points to seek between.
+        self.sizes = common.READ_BLOCK_SIZE, common.TIME_INDEX_INTERVAL
+        common.READ_BLOCK_SIZE = 4096
+        common.TIME_INDEX_INTERVAL = 16384
+        with gzip.open(self.log + '.1.gz', 'wb') as fd:
+            # A crash dump may end a log with lines without a timestamp.
+            fd.write(make_lines(0, 3000) +
+                     ''.join([" -%s> dump\n" % i for i in xrange(1000)]))
+
+    def tearDown(self):
+        common.READ_BLOCK_SIZE, common.TIME_INDEX_INTERVAL = self.sizes
+        super(TestTimeIndex, self).tearDown()
+
+    def assertSameEvents(self, window):
+        expected = get_multi(self.path, QUERIES, window=window)
+        for i in xrange(2):
+            self.assertEqual(get_multi(self.path, QUERIES, True,
+                                       window=window), expected)
+
+        return expected
+
+    def test_seek(self):
+        window = TimeWindow(parse_time('2016-05-02 06:00'),
+                            parse_time('2016-05-02 12:00'))
+        events = self.assertSameEvents(window)
+        self.assertTrue(all([events[name] for name in events]))
+        index = TimeIndex(self.log + '.1.gz')
+        self.assertTrue(index.check())
+        self.assertTrue(len(index.readlines()) > 2)
+        self.assertIsNotNone(index.get_range(*window.bounds())[1])
+        index.close()
+
+    def test_end_of_log(self):
+        events = self.assertSameEvents(TimeWindow(parse_time('2016-05-03 '
+                                                             '01:59')))
+        self.assertTrue(any([events[name] for name in events]))
+
+    def test_outside_window(self):
+        for window in [TimeWindow(parse_time('2016-06-01 00:00')),
+                       TimeWindow(None, parse_time('2016-04-01 00:00'))]:
+            events = self.assertSameEvents(window)
+            self.assertFalse(any([events[name] for name in events]))
+
+
+class TestLogFollower(LogTestCase):
+
+    def poll(self, follower, events):
+        for name, _events in follower.poll().iteritems():
+            events[name] = events.get(name, []) + _events
+
+        return events
+
+    def test_rotation(self):
+        self.append(make_lines(0, 10))
+        follower = LogFollower(self.path, QUERIES)
+        self.assertFalse(any(follower.poll().values()))
+        data = make_lines(10, 20)
+        cut = mid_line(data, len(data) / 2)
+        self.append(data[:cut])
+        events = self.poll(follower, {})
+        self.append(data[cut:])
+        os.rename(self.log, self.log + '.1')
+        self.append(make_lines(30, 10))
+        self.poll(follower, events)
+        self.assertEqual(events, self.scan(data + make_lines(30, 10)))
+
+    def test_truncation(self):
+        self.append(make_lines(0, 10))
+        follower = LogFollower(self.path, QUERIES)
+        follower.poll()
+        self.append(make_lines(10, 10))
+        follower.poll()
+        # Truncated to less than was read and then to more, where only the
+        # start of the log shows it has changed.
+        for data in [make_lines(100, 10), make_lines(200, 40)]:
+            open(self.log, 'w').close()
+            self.append(data)
+            self.assertEqual(follower.poll(), self.scan(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
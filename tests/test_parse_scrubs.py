@@ -0,0 +1,101 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run from the top of the tree with: python2 -m unittest discover tests
+
+import datetime
+import unittest
+
+from parse_scrubs import CephScrubStatsCollection, ScrubEvent
+
+MONTH = 5
+
+
+def make_events(host, osd, actions):
+    """
+    Return list of ScrubEvent for a start and completion of each of
+    actions, a list of (pg, action), a minute apart.
+    """
+    t = datetime.datetime(2016, MONTH, 1)
+    events = []
+    for pg, action in actions:
+        for status in ['starts', 'ok']:
+            t += datetime.timedelta(minutes=1)
+            events.append(ScrubEvent(host, osd, t, pg, action, status))
+
+    return events
+
+
+def parse(events):
+    collection = CephScrubStatsCollection(MONTH, events)
+    collection.parse()
+    return collection
+
+
+def merge(*parts):
+    """
+    Return a collection merged from the saved state of a collection parsed
+    from each of parts in order.
+    """
+    collection = CephScrubStatsCollection(MONTH, [])
+    for events in parts:
+        collection.merge(CephScrubStatsCollection.from_state(
+            MONTH, parse(events).get_state()))
+
+    return collection
+
+
+class TestMergeRepeats(unittest.TestCase):
+
+    def assertSameRepeats(self, events, split):
+        expected = parse(events)
+        merged = merge(events[:split], events[split:])
+        self.assertEqual(merged.repeats, expected.repeats)
+        self.assertEqual(merged.last_completed, expected.last_completed)
+
+    def test_split_at_repeat(self):
+        events = make_events('host0', 'ceph-osd.0',
+                             [('1.a', 'deep-scrub'), ('1.a', 'deep-scrub'),
+                              ('1.b', 'deep-scrub')])
+        self.assertEqual(parse(events).repeats,
+                         [{'osd': 'ceph-osd.0', 'pg': '1.b', 'count': 2}])
+        self.assertSameRepeats(events, 4)
+
+    def test_split_within_repeat(self):
+        events = make_events('host0', 'ceph-osd.0',
+                             [('1.a', 'deep-scrub'), ('1.a', 'deep-scrub'),
+                              ('1.a', 'deep-scrub'), ('1.b', 'deep-scrub'),
+                              ('1.b', 'deep-scrub'), ('1.a', 'deep-scrub')])
+        for split in xrange(len(events) + 1):
+            self.assertSameRepeats(events, split)
+
+    def test_split_in_flight(self):
+        # The second deep-scrub of 1.a starts before the split and completes
+        # after it.
+        events = make_events('host0', 'ceph-osd.0',
+                             [('1.a', 'deep-scrub'), ('1.a', 'deep-scrub'),
+                              ('1.c', 'scrub'), ('1.b', 'deep-scrub')])
+        self.assertSameRepeats(events, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
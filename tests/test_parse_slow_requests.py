@@ -0,0 +1,84 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run from the top of the tree with: python2 -m unittest discover tests
+
+import argparse
+import datetime
+import random
+import unittest
+
+from parse_slow_requests import (
+    get_collection,
+    get_results,
+    SlowRequestEvent,
+    TIMESTAMP_HORIZON,
+)
+
+HISTOGRAM = 60 * 60 * 1000000
+
+
+def make_events(count):
+    """
+    Return count SlowRequestEvent for 4 osds over a few days, some of which
+    share a timestamp.
+    """
+    rand = random.Random(0)
+    t = datetime.datetime(2016, 5, 1)
+    events = []
+    for i in xrange(count):
+        if rand.randint(0, 3):
+            t += datetime.timedelta(seconds=rand.randint(1, 600))
+
+        events.append(SlowRequestEvent('host%s' % (i % 2),
+                                       'ceph-osd.%s' % (i % 4), t,
+                                       float(rand.randint(30, 500))))
+
+    return events
+
+
+def get_rows(args, collection):
+    return dict([(table.name, [[round(v, 6) if isinstance(v, float) else v
+                                for v in row] for row in table])
+                 for table in get_results(args, collection)])
+
+
+class TestTrackTotals(unittest.TestCase):
+
+    def test_follow_equals_batch(self):
+        args = argparse.Namespace(top=2, histogram=HISTOGRAM)
+        events = make_events(2000)
+        expected = get_rows(args, get_collection(args, events))
+        collection = get_collection(args, events[:500])
+        collection.track_totals(HISTOGRAM)
+        for i in xrange(500, len(events), 100):
+            collection.update(events[i:i + 100])
+            get_results(args, collection)
+
+        self.assertEqual(get_rows(args, collection), expected)
+        newest = max(collection.timestamp_totals)
+        self.assertTrue(min(collection.timestamp_totals) >=
+                        newest - TIMESTAMP_HORIZON)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python2
+# Author: Edward Hope-Morley (opentastic@gmail.com)
+# Description: Ceph log parser
+# Copyright (C) 2016 Edward Hope-Morley
+#
+# License:
+#
+# This file is part of cephsosparser.
+#
+# cephsosparser is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cephsosparser is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cephsosparser.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run from the top of the tree with: python2 -m unittest discover tests
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPORT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'report.py')
+
+HOSTS = 4
+OSDS = 2
+PREFIX = "2016-05-%02d %02d:%02d:%02d.000000 7f06326585ad  "
+LINES = {
+    'scrub': "0 log_channel(cluster) log [INF] : %s deep-scrub %s\n",
+    'slow': "0 log_channel(cluster) log [WRN] : 3 slow requests, 1 included "
+            "below; oldest blocked for > %s.000000 secs\n",
+    'suicide': "1 heartbeat_map is_healthy 'OSD::osd_op_tp thread "
+               "0x7f06326585ad' had suicide timed out after 150\n",
+}
+
+
+def make_sosreports(root):
+    """
+    Write the ceph-osd logs of a sosreport for each of HOSTS hosts with
+    deep-scrubs, including repeats, slow requests and suicides.
+    """
+    rand = random.Random(0)
+    for host in xrange(HOSTS):
+        logdir = os.path.join(root, 'sosreport-host%s.1-2016050%s' %
+                              (host, host), 'var', 'log', 'ceph')
+        os.makedirs(logdir)
+        for osd in xrange(host * OSDS, (host + 1) * OSDS):
+            t = 0
+            lines = []
+            for i in xrange(50):
+                pg = '1.%x' % rand.randint(1, 3)
+                for status in ['starts', 'ok']:
+                    t += rand.randint(60, 3600)
+                    lines.append((t, LINES['scrub'] % (pg, status)))
+
+                lines.append((t + 1, LINES['slow'] % rand.randint(30, 500)))
+                if not rand.randint(0, 4):
+                    lines.append((t + 2, LINES['suicide']))
+
+            with open(os.path.join(logdir, 'ceph-osd.%s.log' % osd),
+                      'w') as fd:
+                for t, line in lines:
+                    fd.write(PREFIX % (1 + t / 86400, t / 3600 % 24,
+                                       t / 60 % 60, t % 60) + line)
+
+
+def report(*args):
+    return subprocess.check_output([sys.executable, REPORT] + list(args))
+
+
+class TestShardedReport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sosreports')
+        make_sosreports(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sharded_equals_single_run(self):
+        args = ['--month', '5', '--histogram', '1d']
+        expected = report('--path', self.path, '--format', 'json', *args)
+        self.assertIn('"repeats"', expected)
+        for shards in [2, 3, 7]:
+            partials = []
+            for shard in xrange(shards):
+                partial = os.path.join(self.tmpdir, '%s.partial' % shard)
+                report('--path', self.path, '--shard',
+                       '%s/%s' % (shard, shards), '--save-partial', partial)
+                partials += ['--merge-partial', partial]
+
+            self.assertEqual(report('--format', 'json', *(args + partials)),
+                             expected)
+
+
+if __name__ == "__main__":
+    unittest.main()